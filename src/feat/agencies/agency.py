@@ -85,6 +85,10 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
 
     journal_parent = None
 
+    # number of documents cached by the database connection of the agent,
+    # reloading them (the descriptor) only revalidates the cached revision
+    document_cache_size = 20
+
     def __init__(self, agency, factory, descriptor):
         log.LogProxy.__init__(self, agency)
         log.Logger.__init__(self, self)
@@ -140,7 +144,8 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
                       self.agency._messaging.get_connection, self)
         d.addCallback(setter, "_messaging")
         d.addCallback(defer.drop_param,
-                      self.agency._database.get_connection)
+                      self.agency._database.get_connection,
+                      document_cache_size=self.document_cache_size)
         d.addCallback(setter, '_database')
         d.addCallback(defer.drop_param,
                       self._reload_descriptor)
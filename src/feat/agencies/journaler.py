@@ -21,9 +21,16 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import collections
+import itertools
+import mmap
+import os
+import shutil
 import socket
 import sqlite3
+import struct
 import operator
+import tempfile
 import types
 import sys
 
@@ -36,7 +43,7 @@ from feat.common import (log, text_helper, error_handler, defer,
                          formatable, enum, decorator, time, manhole,
                          fiber, signal, error, connstr)
 from feat.agencies import common
-from feat.common.serialization import banana
+from feat.common.serialization import binary
 from feat.extern.log import log as flulog
 
 from feat.interface.journal import IJournalSideEffect, IJournalEntry
@@ -54,30 +61,107 @@ class State(enum.Enum):
     (disconnected, connected) = range(2)
 
 
+class OverflowPolicy(enum.Enum):
+    '''
+    Tells what the journaler does when its cache reaches the high-water mark.
+
+    drop_logs - log entries are discarded, journal entries are always kept
+    spill - entries exceeding the mark are written to the L{Spool} and are
+            replayed to the writer when the cache drains
+    '''
+    (drop_logs, spill) = range(2)
+
+
+class LogRecord(object):
+    '''
+    Log entry created by L{Journaler.do_log}. It can be used as the entry
+    dictionary, but formatting of the message and resolving of the file
+    path are done only when they are accessed, normally in the writer.
+    The code object and line number of the calling frame are captured
+    instead of walking the stack at logging time.
+    '''
+
+    __slots__ = ('level', 'log_name', 'category', 'line_num', 'timestamp',
+                 '_format', '_args', '_code', '_file_path', '_message')
+
+    entry_type = 'log'
+
+    keys = ('entry_type', 'level', 'log_name', 'category', 'file_path',
+            'line_num', 'message', 'timestamp')
+
+    def __init__(self, level, log_name, category, format, args,
+                 code=None, file_path=None, line_num=None, timestamp=None):
+        self.level = level
+        self.log_name = log_name
+        self.category = category
+        self.line_num = line_num
+        self.timestamp = timestamp
+        self._format = format
+        self._args = args
+        self._code = code
+        self._file_path = file_path
+        self._message = None
+
+    @property
+    def message(self):
+        if self._message is None:
+            try:
+                if self._args:
+                    self._message = self._format % self._args
+                else:
+                    self._message = str(self._format)
+            except Exception as e:
+                self._message = ("Failed to format log message %r with "
+                                 "%r: %s" % (self._format, self._args, e))
+            self._format = self._args = None
+        return self._message
+
+    @property
+    def file_path(self):
+        if self._file_path is None and self._code is not None:
+            self._file_path = flulog.scrubFilename(self._code.co_filename)
+            self._code = None
+        return self._file_path
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.keys)
+
+    def __getitem__(self, key):
+        if key not in self.keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+
 class EntriesCache(object):
     '''
     Helper class storing the data and giving the back in transactional way.
     '''
 
     def __init__(self):
-        self._cache = list()
+        self._cache = collections.deque()
         self._fetched = None
+        self._num_logs = 0
 
     def append(self, entry):
         self._cache.append(entry)
+        if entry['entry_type'] == 'log':
+            self._num_logs += 1
 
-    def fetch(self):
+    def fetch(self, limit=None):
         '''
-        Gives all the data it has stored, and remembers what it has given.
+        Gives the data it has stored, and remembers what it has given.
         Later we need to call commit() to actually remove the data from the
         cache.
+        @param limit: Optional maximum number of entries to give.
         '''
         if self._fetched is not None:
             raise RuntimeError('fetch() was called but the previous one has '
                                'not yet been applied. Not supported')
         if self._cache:
             self._fetched = len(self._cache)
-        return self._cache[0:self._fetched]
+            if limit is not None:
+                self._fetched = min(self._fetched, limit)
+        return list(itertools.islice(self._cache, 0, self._fetched))
 
     def commit(self):
         '''
@@ -85,7 +169,9 @@ class EntriesCache(object):
         '''
         if self._fetched is None:
             raise RuntimeError('commit() was called but nothing was fetched')
-        self._cache = self._cache[self._fetched:]
+        for _ in xrange(self._fetched):
+            if self._cache.popleft()['entry_type'] == 'log':
+                self._num_logs -= 1
         self._fetched = None
 
     def rollback(self):
@@ -99,10 +185,222 @@ class EntriesCache(object):
         '''
         return self._fetched is not None
 
+    def discard_logs(self, num):
+        '''
+        Removes up to num log entries, oldest first. Entries given by fetch()
+        are left untouched.
+        @returns: number of entries removed
+        '''
+        if not self._num_logs or num <= 0:
+            return 0
+        skip = self._fetched or 0
+        kept = collections.deque()
+        removed = 0
+        for index, entry in enumerate(self._cache):
+            if (index >= skip and removed < num
+                and entry['entry_type'] == 'log'):
+                removed += 1
+                continue
+            kept.append(entry)
+        self._cache = kept
+        self._num_logs -= removed
+        return removed
+
     def __len__(self):
         return len(self._cache)
 
 
+class SpoolSegment(object):
+    '''
+    Single memory-mapped file of the L{Spool}. The file starts with
+    a header (write offset, read offset, number of unread records)
+    followed by length-prefixed records.
+    '''
+
+    header = struct.Struct('!QQQ')
+    record = struct.Struct('!I')
+
+    def __init__(self, path, size=None):
+        '''
+        @param size: Size of the new segment, if None the existing file
+                     is opened.
+        '''
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if size is not None:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+        if size is not None:
+            self._write_offset = self._read_offset = self.header.size
+            self.unread = 0
+            self._store_header()
+        else:
+            self._write_offset, self._read_offset, self.unread = \
+                self.header.unpack_from(self._map, 0)
+
+    def has_room(self, data):
+        size = self.record.size + len(data)
+        return self._write_offset + size <= len(self._map)
+
+    def append(self, data):
+        offset = self._write_offset
+        self.record.pack_into(self._map, offset, len(data))
+        offset += self.record.size
+        self._map[offset:offset + len(data)] = data
+        self._write_offset = offset + len(data)
+        self.unread += 1
+        self._store_header()
+
+    def read(self, limit):
+        '''
+        Returns up to limit unread records without consuming them.
+        '''
+        result = list()
+        offset = self._read_offset
+        for _ in xrange(min(limit, self.unread)):
+            size, = self.record.unpack_from(self._map, offset)
+            offset += self.record.size
+            result.append(self._map[offset:offset + size])
+            offset += size
+        return result
+
+    def consume(self, num):
+        '''
+        Marks up to num records as read.
+        @returns: number of records consumed
+        '''
+        num = min(num, self.unread)
+        offset = self._read_offset
+        for _ in xrange(num):
+            size, = self.record.unpack_from(self._map, offset)
+            offset += self.record.size + size
+        self._read_offset = offset
+        self.unread -= num
+        self._store_header()
+        return num
+
+    def close(self):
+        self._map.close()
+
+    def remove(self):
+        self.close()
+        os.unlink(self.path)
+
+    ### private ###
+
+    def _store_header(self):
+        self.header.pack_into(self._map, 0, self._write_offset,
+                              self._read_offset, self.unread)
+
+
+class Spool(object):
+    '''
+    Append-only on-disk queue of journal entries made of memory-mapped
+    segment files. Entries are read with peek() and removed with discard()
+    once they are safely stored, segments are deleted as soon as they are
+    consumed. Segments found in the directory on creation are loaded,
+    so entries spooled by the previous run are not lost.
+    If no directory is given, a temporary one is created and removed
+    by close().
+    '''
+
+    segment_size = 4 * 1024 * 1024
+    segment_pattern = 'journal-%08d.spool'
+
+    def __init__(self, directory=None, segment_size=None, use_binary=None):
+        self.temporary = directory is None
+        if self.temporary:
+            directory = tempfile.mkdtemp(prefix='feat_journal_spool_')
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._directory = directory
+        self._segment_size = segment_size or type(self).segment_size
+        self._segments = collections.deque()
+        self._next_index = 0
+        self._count = 0
+        self._serializer = binary.Serializer(use_binary=use_binary)
+        self._unserializer = binary.Unserializer()
+        self._load()
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def append(self, entry):
+        data = self._serializer.convert(_entry_as_dict(entry))
+        if not self._segments or not self._segments[-1].has_room(data):
+            self._segments.append(self._new_segment(data))
+        self._segments[-1].append(data)
+        self._count += 1
+
+    def peek(self, limit):
+        '''
+        Returns up to limit entries from the head of the spool.
+        '''
+        result = list()
+        for segment in self._segments:
+            if len(result) >= limit:
+                break
+            result.extend(self._unserializer.convert(data)
+                          for data in segment.read(limit - len(result)))
+        return result
+
+    def discard(self, num):
+        '''
+        Removes num entries from the head of the spool.
+        '''
+        while num > 0 and self._segments:
+            segment = self._segments[0]
+            consumed = segment.consume(num)
+            num -= consumed
+            self._count -= consumed
+            if segment.unread == 0:
+                self._segments.popleft()
+                segment.remove()
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+        self._segments.clear()
+        self._count = 0
+        if self.temporary:
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def __len__(self):
+        return self._count
+
+    ### private ###
+
+    def _load(self):
+        names = sorted(x for x in os.listdir(self._directory)
+                       if x.startswith('journal-') and x.endswith('.spool'))
+        for name in names:
+            path = os.path.join(self._directory, name)
+            self._next_index = int(name[len('journal-'):-len('.spool')]) + 1
+            if os.path.getsize(path) < SpoolSegment.header.size:
+                # crashed between creating the file and writing the header
+                os.unlink(path)
+                continue
+            segment = SpoolSegment(path)
+            if segment.unread == 0:
+                segment.remove()
+                continue
+            self._segments.append(segment)
+            self._count += segment.unread
+
+    def _new_segment(self, data):
+        size = max(self._segment_size, SpoolSegment.header.size +
+                   SpoolSegment.record.size + len(data))
+        path = os.path.join(self._directory,
+                            self.segment_pattern % (self._next_index, ))
+        self._next_index += 1
+        return SpoolSegment(path, size)
+
+
 @decorator.parametrized_function
 def in_state(func, *states):
 
@@ -124,8 +422,28 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
 
     _error_handler = error_handler
 
+    # high-water mark for the number of entries kept in memory
+    max_cache_size = 100000
+    overflow_policy = OverflowPolicy.drop_logs
+
     def __init__(self, on_rotate_cb=None, on_switch_writer_cb=None,
-                 hostname=None):
+                 hostname=None, max_cache_size=None, overflow_policy=None,
+                 spool_dir=None, use_binary=None):
+        '''
+        @param max_cache_size: High-water mark of the entries cache.
+        @param overflow_policy: What to do with the entries when the cache
+                                is full.
+        @type overflow_policy: L{OverflowPolicy}
+        @param spool_dir: Directory of the on-disk spool. If given, entries
+                          inserted while there is no connected writer are
+                          kept on disk instead of in memory, and entries
+                          left there by the previous run are replayed.
+                          Without it the spool is only used by
+                          L{OverflowPolicy.spill}, in a temporary directory.
+        @param use_binary: Store the entries in the binary format instead
+                           of banana. Only enable it once every journal
+                           reader understands the binary format.
+        '''
         log.Logger.__init__(self, log.get_default() or self)
 
         common.StateMachineMixin.__init__(self, State.disconnected)
@@ -134,6 +452,20 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
         self._cache = EntriesCache()
         self._notifier = defer.Notifier()
 
+        self._max_cache_size = max_cache_size or type(self).max_cache_size
+        if overflow_policy is None:
+            overflow_policy = type(self).overflow_policy
+        self._overflow_policy = overflow_policy
+        self._use_binary = use_binary
+        self._spool_dir = spool_dir
+        self._spool = None
+        if spool_dir is not None:
+            self._spool = Spool(spool_dir, use_binary=use_binary)
+
+        # overflow counters
+        self._dropped_entries = 0
+        self._spilled_entries = 0
+
         self._on_rotate_cb = on_rotate_cb
         self._on_switch_writer_cb = on_switch_writer_cb
         # [(klass, params)]
@@ -266,29 +598,28 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
 
     def get_connection(self, externalizer):
         externalizer = IExternalizer(externalizer)
-        instance = JournalerConnection(self, externalizer)
+        instance = JournalerConnection(self, externalizer,
+                                       use_binary=self._use_binary)
         return instance
 
     def prepare_record(self):
         return Record(self)
 
     def insert_entry(self, **data):
-        self._cache.append(data)
-        self._schedule_flush()
-        return self._notifier.wait('flush')
+        self._append_entry(data)
+        return self._entries_inserted()
 
     def insert_entries(self, entries):
         for entry in entries:
-            self._cache.append(entry)
-        self._schedule_flush()
-        return self._notifier.wait('flush')
+            self._append_entry(entry)
+        return self._entries_inserted()
 
     # used by remote ProxyBrokerWriter
 
     remote_insert_entries = insert_entries
 
     def is_idle(self):
-        if len(self._cache) > 0:
+        if self.get_pending() > 0:
             self.debug("Journaler has nonempty cache, hence is not idle")
             return False
         if self._writer:
@@ -298,6 +629,21 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
             return writer_idle
         return True
 
+    @manhole.expose()
+    def get_pending(self):
+        '''Number of entries waiting to be flushed, spilled ones included.'''
+        return len(self._cache) + (len(self._spool) if self._spool else 0)
+
+    @manhole.expose()
+    def get_overflow_stats(self):
+        '''Counters of entries affected by the cache overflow policy.'''
+        return dict(policy=self._overflow_policy.name,
+                    max_cache_size=self._max_cache_size,
+                    cached=len(self._cache),
+                    spilled=len(self._spool) if self._spool else 0,
+                    dropped_entries=self._dropped_entries,
+                    spilled_entries=self._spilled_entries)
+
     ### methods called by journaler writers ###
 
     def on_rotate(self):
@@ -329,31 +675,70 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
         if level > flulog.getCategoryLevel(category):
             return
 
+        code = None
         if file_path is None and line_num is None:
-            file_path, line_num = flulog.getFileLine(where=-depth-2)
-
-        if args:
-            message = format % args
-        else:
-            message = str(format)
-
-        data = dict(
-            entry_type='log',
-            level=level,
-            log_name=object,
-            category=category,
-            file_path=file_path,
-            line_num=line_num,
-            message=message,
-            timestamp=time.time())
-        self.insert_entry(**data)
+            try:
+                frame = sys._getframe(depth + 1)
+                code, line_num = frame.f_code, frame.f_lineno
+                del frame
+            except ValueError:
+                file_path, line_num = "<unknown file>", 0
+
+        record = LogRecord(level, object, category, format, args,
+                           code=code, file_path=file_path,
+                           line_num=line_num, timestamp=time.time())
+        # nobody waits for the log entries to be flushed,
+        # so don't bother creating the notification Deferred
+        self._append_entry(record)
+        self._schedule_flush()
 
     ### private ###
 
+    def _append_entry(self, entry):
+        full = len(self._cache) >= self._max_cache_size
+
+        # checking the cheap conditions first keeps do_log() fast
+        if ((full or self._spool or self._spool_dir is not None)
+            and self._should_spool(full)):
+            if self._spool is None:
+                self._spool = Spool(self._spool_dir,
+                                    use_binary=self._use_binary)
+            self._spool.append(entry)
+            self._spilled_entries += 1
+            return
+
+        if full and self._overflow_policy == OverflowPolicy.drop_logs:
+            if entry['entry_type'] == 'log':
+                self._dropped_entries += 1
+                return
+            # make room discarding cached logs, 10% of the cache at once
+            # so that we don't rebuild it on every insert
+            self._dropped_entries += self._cache.discard_logs(
+                len(self._cache) - self._low_water_mark() + 1)
+
+        self._cache.append(entry)
+
+    def _should_spool(self, full):
+        if self._spool:
+            # spooled entries are older than the new one,
+            # appending it to the cache would break the order
+            return True
+        if full and self._overflow_policy == OverflowPolicy.spill:
+            return True
+        return (self._spool_dir is not None and
+                not self._cmp_state(State.connected))
+
+    def _entries_inserted(self):
+        self._schedule_flush()
+        return self._notifier.wait('flush')
+
+    def _low_water_mark(self):
+        return self._max_cache_size * 9 / 10
+
     def _schedule_flush(self):
-        if not self._cmp_state(State.connected):
+        if self._flush_task is not None:
             return
-        if self._flush_task is None:
+        if self._cmp_state(State.connected):
             self._flush_task = time.call_next(self._flush)
 
     def _flush(self):
@@ -372,19 +757,36 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
             d.addCallbacks(defer.drop_param, self._flush_error,
                            callbackArgs=(self._flush_complete, ))
             return d
+        elif self._spool:
+            return self._replay_spool()
         else:
             self._flush_complete()
 
+    def _replay_spool(self):
+        # entries are removed from the spool only after the writer
+        # has stored them, so that nothing is lost if it fails
+        entries = self._spool.peek(self._max_cache_size)
+        d = self._writer.insert_entries(entries)
+        d.addCallback(defer.drop_param, self._spool.discard, len(entries))
+        d.addCallbacks(defer.drop_param, self._flush_error,
+                       callbackArgs=(self._flush_complete, ))
+        return d
+
     def _flush_complete(self):
         if self._cache.is_locked():
             self._cache.commit()
+        if (self._spool is not None and self._spool.temporary and
+            not self._spool):
+            self._spool.close()
+            self._spool = None
         self._flush_task = None
         self._notifier.callback('flush', None)
-        if len(self._cache) > 0:
+        if self.get_pending() > 0:
             self._schedule_flush()
 
     def _flush_error(self, fail):
-        self._cache.rollback()
+        if self._cache.is_locked():
+            self._cache.rollback()
         error.handle_failure(self, fail,
                            'Flushing entries to the writer failed')
         self._writer = None
@@ -465,6 +867,7 @@ class BrokerProxyWriter(log.Logger, common.StateMachineMixin):
     def _push_entries(self):
         entries = self._cache.fetch()
         if entries:
+            entries = map(_entry_as_dict, entries)
             try:
                 d = self._journaler.callRemote('insert_entries', entries)
                 d = defer.Timeout(2, d, message=("Timeout expired "
@@ -495,18 +898,24 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
     _error_handler = error_handler
 
+    # maximum number of entries written in a single transaction
+    max_batch_size = 1000
+
     def __init__(self, logger, filename=":memory:", encoding=None,
-                 hostname=None):
+                 hostname=None, max_batch_size=None):
         '''
         @param encoding: Optional encoding to be used for blob fields.
         @type encoding: Should be a valid parameter for str.encode() method.
         @param filename: File to use for entries. Defaults to :memory:
         @param logger: ILogger to use
+        @param max_batch_size: Maximum number of entries inserted in
+                               one transaction.
         '''
         log.Logger.__init__(self, logger)
         log.LogProxy.__init__(self, logger)
         common.StateMachineMixin.__init__(self, State.disconnected)
 
+        self._max_batch_size = max_batch_size or type(self).max_batch_size
         self._encoding = encoding
         self._db = None
         self._filename = filename
@@ -847,9 +1256,10 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
             result[key] = data[key]
 
         for key in to_decode:
-            if data[key] is None:
-                data[key] = ""
-            result[key] = data[key].decode("utf-8")
+            value = data[key]
+            if value is None:
+                value = ""
+            result[key] = value.decode("utf-8")
 
         # encode the blobs
         for key in to_blob:
@@ -972,41 +1382,38 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
     def _perform_inserts(self, cache):
 
-        def do_insert_entry(connection, history_id, data):
-            command = text_helper.format_block("""
-            INSERT INTO entries VALUES (null, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (history_id,
-                          data['journal_id'], data['function_id'],
-                          data['fiber_id'], data['fiber_depth'],
-                          data['args'], data['kwargs'],
-                          data['side_effects'], data['result'],
-                          int(data['timestamp'])))
-
-        def do_insert_log(connection, data):
-            command = text_helper.format_block("""
-            INSERT INTO logs VALUES (null, ?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (data['message'], int(data['level']),
-                          data['category'], data['log_name'],
-                          data['file_path'], data['line_num'],
-                          int(data['timestamp'])))
-
         def transaction(connection, cache):
-            entries = cache.fetch()
+            entries = cache.fetch(self._max_batch_size)
             if not entries:
                 return
             try:
-                entries = map(self._encode, entries)
-                for data in entries:
+                journal_rows = list()
+                log_rows = list()
+                for data in map(self._encode, entries):
                     if data['entry_type'] == 'journal':
                         history_id = self._get_history_id(
                             connection, data['agent_id'], data['instance_id'])
-                        do_insert_entry(connection, history_id, data)
+                        journal_rows.append(
+                            (history_id,
+                             data['journal_id'], data['function_id'],
+                             data['fiber_id'], data['fiber_depth'],
+                             data['args'], data['kwargs'],
+                             data['side_effects'], data['result'],
+                             int(data['timestamp'])))
                     elif data['entry_type'] == 'log':
-                        do_insert_log(connection, data)
+                        log_rows.append(
+                            (data['message'], int(data['level']),
+                             data['category'], data['log_name'],
+                             data['file_path'], data['line_num'],
+                             int(data['timestamp'])))
+                if journal_rows:
+                    connection.executemany(
+                        "INSERT INTO entries VALUES "
+                        "(null, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", journal_rows)
+                if log_rows:
+                    connection.executemany(
+                        "INSERT INTO logs VALUES "
+                        "(null, ?, ?, ?, ?, ?, ?, ?)", log_rows)
                 cache.commit()
             except Exception:
                 cache.rollback()
@@ -1068,12 +1475,13 @@ class Record(object):
 class JournalerConnection(log.Logger, log.LogProxy):
     implements(IJournalerConnection)
 
-    def __init__(self, journaler, externalizer):
+    def __init__(self, journaler, externalizer, use_binary=None):
         log.LogProxy.__init__(self, journaler)
         log.Logger.__init__(self, self)
 
-        self.serializer = banana.Serializer(externalizer=externalizer)
-        self.snapshot_serializer = banana.Serializer()
+        self.serializer = binary.Serializer(externalizer=externalizer,
+                                            use_binary=use_binary)
+        self.snapshot_serializer = binary.Serializer(use_binary=use_binary)
         self.journaler = IJournaler(journaler)
 
     ### IJournalerConnection ###
@@ -1222,10 +1630,12 @@ class PostgresWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
     max_retries = 2
     max_delay = 120
     initial_delay = 1
+    # maximum number of entries written in a single transaction
+    max_batch_size = 1000
 
     def __init__(self, logger, host, database, user, password,
                  max_retries=None, initial_delay=None, max_delay=None,
-                 hostname=None):
+                 hostname=None, max_batch_size=None):
         log.LogProxy.__init__(self, logger)
         log.Logger.__init__(self, logger)
         common.StateMachineMixin.__init__(self, State.disconnected)
@@ -1248,6 +1658,7 @@ class PostgresWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         self._max_delay = max_delay or type(self).max_delay
         self._max_retries = max_retries or type(self).max_retries
         self._initial_delay = initial_delay or type(self).initial_delay
+        self._max_batch_size = max_batch_size or type(self).max_batch_size
 
         self._journaler = None
         self._initiate_defer = None
@@ -1372,60 +1783,72 @@ class PostgresWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
             return d
 
     def _perform_inserts(self, cursor):
-        entries = self._cache.fetch()
+        entries = self._cache.fetch(self._max_batch_size)
         if not entries:
             return
 
+        journal = [x for x in entries if x['entry_type'] == 'journal']
+        logs = [x for x in entries if x['entry_type'] == 'log']
+
         d = defer.succeed(None)
-        for data in entries:
-            if data['entry_type'] == 'journal':
-                d.addCallback(defer.drop_param,
-                              self._do_insert_entry, cursor, data)
-            elif data['entry_type'] == 'log':
-                d.addCallback(defer.drop_param, self._do_insert_log,
-                              cursor, data)
+        if journal:
+            d.addCallback(defer.drop_param,
+                          self._do_insert_entries, cursor, journal)
+        if logs:
+            d.addCallback(defer.drop_param,
+                          self._do_insert_logs, cursor, logs)
         d.addCallback(defer.bridge_param, self._cache.commit)
         d.addErrback(defer.bridge_param, self._cache.rollback)
         return d
 
-    def _do_insert_entry(self, cursor, data):
+    def _do_insert_entries(self, cursor, entries):
 
         def escape(binary):
             if isinstance(binary, unicode):
                 binary = binary.encode('utf8')
             return self._psycopg2.Binary(binary)
 
+        row = ('(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,'
+               ' feat.host_id_for(%s))')
+        params = list()
+        for data in entries:
+            params.extend((data['agent_id'],
+                           data['instance_id'],
+                           escape(data['journal_id']),
+                           data['function_id'],
+                           escape(data['fiber_id']),
+                           data['fiber_depth'],
+                           escape(data['args']),
+                           escape(data['kwargs']),
+                           escape(data['side_effects']),
+                           escape(data['result']),
+                           self._format_timestamp(data['timestamp']),
+                           self._hostname))
+
         return cursor.execute(
             'INSERT INTO feat.entries '
             '(agent_id, instance_id, journal_id, function_id, fiber_id,'
             ' fiber_depth, args, kwargs, side_effects, result, timestamp,'
             ' host_id) '
-            'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,'
-                     'feat.host_id_for(%s))',
-            (data['agent_id'],
-             data['instance_id'],
-             escape(data['journal_id']),
-             data['function_id'],
-             escape(data['fiber_id']),
-             data['fiber_depth'],
-             escape(data['args']),
-             escape(data['kwargs']),
-             escape(data['side_effects']),
-             escape(data['result']),
-             self._format_timestamp(data['timestamp']),
-             self._hostname))
-
-    def _do_insert_log(self, cursor, data):
+            'VALUES ' + ', '.join([row] * len(entries)),
+            params)
+
+    def _do_insert_logs(self, cursor, entries):
+        row = '(%s, %s, %s, %s, %s, %s, %s, feat.host_id_for(%s))'
+        params = list()
+        for data in entries:
+            params.extend((data['message'], int(data['level']),
+                           data['category'], data['log_name'],
+                           data['file_path'], data['line_num'],
+                           self._format_timestamp(data['timestamp']),
+                           self._hostname))
+
         return cursor.execute(
             'INSERT INTO feat.logs '
             '(message, level, category, log_name, file_path, line_num,'
             ' timestamp, host_id) '
-            'VALUES (%s, %s, %s, %s, %s, %s, %s, feat.host_id_for(%s))',
-            (data['message'], int(data['level']),
-             data['category'], data['log_name'],
-             data['file_path'], data['line_num'],
-             self._format_timestamp(data['timestamp']),
-             self._hostname))
+            'VALUES ' + ', '.join([row] * len(entries)),
+            params)
 
     def _format_timestamp(self, epoch):
         t = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(epoch))
@@ -1742,6 +2165,12 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
         self._set_state(State.connected)
 
 
+def _entry_as_dict(entry):
+    if isinstance(entry, LogRecord):
+        return entry.as_dict()
+    return entry
+
+
 def parse_connstr(conn):
     try:
         resp = connstr.parse(conn)
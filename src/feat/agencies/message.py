@@ -65,6 +65,14 @@ class BaseMessage(formatable.Formatable):
         msg.message_id = None
         return msg
 
+    def readdress(self, recipient):
+        """Returns a shallow copy of the message sent to the specified
+        recipient. The copy shares the body of the message, so it
+        SHOULD NOT be modified."""
+        msg = copy.copy(self)
+        msg.recipient = recipient
+        return msg
+
     def duplication_recipient(self):
         '''Returns a recipient to whom the duplication
         message should be send or None.'''
@@ -0,0 +1,90 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+import collections
+
+
+class Codec(object):
+    '''
+    I serialize the messages sent by the backends. When a message is posted
+    to several recipients its body is the same for all of them. With the
+    envelopes enabled it is serialized once and the copies after the first
+    one are sent as the recipient serialized in an envelope next to it.
+    The first copy, and every message when the envelopes are disabled,
+    is serialized as a whole, the way the agencies not knowing
+    the envelopes expect it. Both formats are always understood.
+    '''
+
+    # number of the last serialized bodies kept to be reused
+    cache_size = 20
+    # the envelopes can only be enabled once all the agencies sharing
+    # the backend understand them
+    use_envelopes = False
+
+    def __init__(self, serializer, unserializer, cache_size=None,
+                 use_envelopes=None):
+        self._serializer = serializer
+        self._unserializer = unserializer
+        if cache_size is not None:
+            self.cache_size = cache_size
+        if use_envelopes is not None:
+            self.use_envelopes = use_envelopes
+        # message_id -> serialized body, None before the second copy
+        self._bodies = collections.OrderedDict()
+
+    def encode(self, message):
+        if not self.use_envelopes:
+            return self._serializer.convert(message)
+        body = self._get_body(message)
+        if body is None:
+            return self._serializer.convert(message)
+        return self._serializer.convert((message.recipient, body))
+
+    def decode(self, data):
+        result = self._unserializer.convert(data)
+        if not isinstance(result, tuple):
+            return result
+        recipient, body = result
+        message = self._unserializer.convert(body)
+        message.recipient = recipient
+        return message
+
+    ### private ###
+
+    def _get_body(self, message):
+        # the copies of the message sent to different recipients
+        # have the same message_id, and the agents rely on it to
+        # recognize the duplicates
+        message_id = message.message_id
+        if message_id is None or not self.cache_size:
+            return None
+        if message_id not in self._bodies:
+            body = None
+        else:
+            body = self._bodies.pop(message_id)
+            if body is None:
+                body = self._serializer.convert(message.readdress(None))
+        self._bodies[message_id] = body
+        while len(self._bodies) > self.cache_size:
+            self._bodies.popitem(last=False)
+        return body
@@ -29,10 +29,10 @@ class Channel(log.Logger):
         self._bindings = []
 
         # traversal_id -> True
-        self._traversal_ids = container.ExpDict(self)
+        self._traversal_ids = container.HeapExpDict(self)
 
         # message_id -> True
-        self._message_ids = container.ExpDict(self)
+        self._message_ids = container.HeapExpDict(self)
 
     def initiate(self):
         return defer.succeed(self)
@@ -52,11 +52,12 @@ class Channel(log.Logger):
             if message.reply_to is None:
                 message.reply_to = self._get_own_address()
 
+        # the body is copied once, the routing table clones the messages
+        # it delivers and the backends serialize the body once
+        message = message.clone()
         for recip in recipients:
             self.log('Sending message to %r', recip)
-            msg = message.clone()
-            msg.recipient = recip
-            self._messaging.dispatch(msg)
+            self._messaging.dispatch(message.readdress(recip))
 
     def release(self):
         for binding in self._bindings:
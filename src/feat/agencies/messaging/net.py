@@ -28,11 +28,12 @@ from feat.extern.txamqp.protocol import AMQClient
 from feat.extern.txamqp.content import Content
 from feat.extern.txamqp import queue as txamqp_queue
 from twisted.internet import reactor, protocol
+from twisted.python import failure
 from zope.interface import implements
 
 from feat.common import log, defer, enum, time, error, container
 from feat.common.serialization import banana
-from feat.agencies.messaging import debug_message
+from feat.agencies.messaging import debug_message, envelope
 from feat.agencies.messaging.rabbitmq import Connection, Queue
 from feat.agencies.common import StateMachineMixin, ConnectionManager
 from feat.agencies.message import BaseMessage
@@ -169,7 +170,8 @@ class RabbitMQ(ConnectionManager, log.Logger, log.LogProxy):
     log_category = "net-rabbitmq"
 
     def __init__(self, host, port, user='guest', password='guest',
-                 timeout=5):
+                 timeout=5, publish_batch_size=None,
+                 publish_batch_latency=None, use_envelopes=None):
         ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, log.get_default() or log.FluLogKeeper())
         log.Logger.__init__(self, self)
@@ -179,6 +181,9 @@ class RabbitMQ(ConnectionManager, log.Logger, log.LogProxy):
         self._host = host
         self._port = port
         self._timeout_connecting = timeout
+        self._publish_batch_size = publish_batch_size
+        self._publish_batch_latency = publish_batch_latency
+        self._use_envelopes = use_envelopes
 
         self._factory = AMQFactory(self, TwistedDelegate(),
                                    self._user, self._password,
@@ -217,7 +222,11 @@ class RabbitMQ(ConnectionManager, log.Logger, log.LogProxy):
 
     def new_channel(self, agent, queue_name=None):
         d = self._factory.get_client()
-        channel_wrapped = Channel(self, d, self._factory)
+        channel_wrapped = Channel(
+            self, d, self._factory,
+            publish_batch_size=self._publish_batch_size,
+            publish_batch_latency=self._publish_batch_latency,
+            use_envelopes=self._use_envelopes)
 
         return Connection(channel_wrapped, agent, queue_name)
 
@@ -272,7 +281,15 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
 
     channel_type = "default"
 
-    def __init__(self, messaging, client_defer, factory):
+    # maximum number of messages published in a single transaction
+    publish_batch_size = 100
+    # maximum time in seconds a published message waits for the commit,
+    # 0 commits the messages published during the same reactor iteration
+    publish_batch_latency = 0
+
+    def __init__(self, messaging, client_defer, factory,
+                 publish_batch_size=None, publish_batch_latency=None,
+                 use_envelopes=None):
         StateMachineMixin.__init__(self, ChannelState.recording)
         log.Logger.__init__(self, messaging)
         log.LogProxy.__init__(self, messaging)
@@ -284,11 +301,19 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
         self._queues = []
         self._is_processing = False
         self._processing_chain = []
-        self._seen_messages = container.ExpDict(self)
+        self._seen_messages = container.HeapExpDict(self)
         # holds list of messages to send in case we are disconnected
-        self._to_send = container.ExpQueue(self, max_size=50)
+        self._to_send = container.HeapExpQueue(self)
         self._notifier = defer.Notifier()
 
+        if publish_batch_size is not None:
+            self.publish_batch_size = publish_batch_size
+        if publish_batch_latency is not None:
+            self.publish_batch_latency = publish_batch_latency
+        # deferreds of the published messages waiting for the commit
+        self._uncommitted = []
+        self._commit_call = None
+
         # RabbitMQ behaviour for creating/deleting bindings has a following
         # issue: if you call create binding two times, and than delete ones
         # there will be no binding. This is a problem for us if two agents
@@ -299,6 +324,8 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
 
         self.serializer = banana.Serializer()
         self.unserializer = banana.Unserializer()
+        self.codec = envelope.Codec(self.serializer, self.unserializer,
+                                    use_envelopes=use_envelopes)
 
         client_defer.addCallback(self._setup_with_client)
 
@@ -358,7 +385,7 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
                                      remember_between_connections=False)
 
     def parse_message(self, msg):
-        result = self.unserializer.convert(msg.content.body)
+        result = self.codec.decode(msg.content.body)
 
         if result.message_id in self._seen_messages:
             debug_message(">>>X", result, "DUPLICATED")
@@ -398,7 +425,7 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
                          'key=%s, delta=%r', message, shard, key, delta)
                 return
 
-        serialized = self.serializer.convert(message)
+        serialized = self.codec.encode(message)
         content = Content(serialized)
         content.properties['delivery mode'] = 1  # non-persistent
 
@@ -414,14 +441,50 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
 
         d = self.channel.basic_publish(exchange=shard, content=content,
                                        routing_key=key, immediate=False)
-        d.addCallback(defer.drop_param, self.channel.tx_commit)
+        d.addCallback(defer.drop_param, self._wait_committed)
         d.addCallback(defer.override_result, message)
         return d
 
+    def _wait_committed(self):
+        # The messages are published in a transaction which is committed
+        # when enough of them are waiting or when the latency expires,
+        # so there is one broker round-trip per batch instead of per message
+        d = defer.Deferred()
+        self._uncommitted.append(d)
+        if len(self._uncommitted) >= self.publish_batch_size:
+            self._commit()
+        elif self._commit_call is None:
+            self._commit_call = time.callLater(self.publish_batch_latency,
+                                               self._commit)
+        return d
+
+    def _commit(self):
+        self._cancel_commit_call()
+        waiting, self._uncommitted = self._uncommitted, []
+        if not waiting:
+            return defer.succeed(None)
+        d = defer.maybeDeferred(self.channel.tx_commit)
+        d.addBoth(self._committed, waiting)
+        return d
+
+    def _committed(self, result, waiting):
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+
+    def _cancel_commit_call(self):
+        if self._commit_call is not None:
+            if self._commit_call.active():
+                self._commit_call.cancel()
+            self._commit_call = None
+
     def _disconnect(self):
         # Both methods needs to be called. Closes channel locally the other
         # one sends channel close. Yes, it is very bizzare.
-        d = self.channel.channel_close()
+        d = self._commit()
+        d.addCallback(defer.drop_param, self.channel.channel_close)
         d.addCallback(self.channel.close)
         return d
 
@@ -577,6 +640,11 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
         self.info("Connection lost")
         self._set_state(ChannelState.recording)
 
+        # the broker discards the transaction which was not committed
+        self._cancel_commit_call()
+        waiting, self._uncommitted = self._uncommitted, []
+        self._committed(failure.Failure(Closed("Connection lost")), waiting)
+
         self.client = None
         self.channel = None
         for queue in self._queues:
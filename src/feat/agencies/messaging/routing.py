@@ -1,10 +1,11 @@
-import operator
+import collections
+import heapq
 
 from zope.interface import implements
 
 from feat.agencies.message import BaseMessage
 
-from feat.common import log, container, time
+from feat.common import log, time
 
 from feat.agencies.messaging.interface import ISink
 from feat.interface.generic import ITimeProvider
@@ -62,7 +63,10 @@ class Table(log.Logger):
     def __init__(self, logger, time_provider=None):
         log.Logger.__init__(self, logger)
 
-        self._routes = list()
+        # (key, shard) -> routes ordered by priority
+        self._routes = dict()
+        # ISink -> routes it owns
+        self._sinks = dict()
         self._outgoing_sink = None
 
         self._time_provider = time_provider and ITimeProvider(time_provider)
@@ -97,33 +101,46 @@ class Table(log.Logger):
         for message in to_deliver:
                 self._send_to_route(message, route)
 
-        self._routes.append(route)
-        self._fix_order()
+        routes = self._routes.setdefault(route.key, list())
+        # keep the order of appending among the routes of the same priority
+        index = len(routes)
+        while index > 0 and routes[index - 1].priority > route.priority:
+            index -= 1
+        routes.insert(index, route)
+        self._sinks.setdefault(route.owner, list()).append(route)
 
     def remove_route(self, route):
         try:
-            self._routes.remove(route)
-        except ValueError:
+            routes = self._routes[route.key]
+            routes.remove(route)
+        except (KeyError, ValueError):
             self.warning("Trying to remove nonexisting route: %r", route)
+            return
+        if not routes:
+            del self._routes[route.key]
+
+        owned = self._sinks.get(route.owner)
+        if owned is not None:
+            owned.remove(route)
+            if not owned:
+                del self._sinks[route.owner]
 
     def remove_sink(self, sink):
-        for route in self._routes:
-            if route.owner == sink:
-                self.remove_route(route)
+        for route in list(self._sinks.get(sink, ())):
+            self.remove_route(route)
 
         if self._outgoing_sink == sink:
             self.info("Outgoing sink removed, setting to None.")
             self._outgoing_sink = None
 
     def dispatch(self, message, outgoing=True):
-
-        for route in self._routes:
-            self.log("Analizing route %r, matching=%r", route,
-                     route.match(message))
-            if route.match(message):
-                self._send_to_route(message, route)
-                if route.final:
-                    return
+        # the routes only match the messages with the same key
+        key = (message.recipient.key, message.recipient.route)
+        for route in self._routes.get(key, ()):
+            self.log("Matching route %r", route)
+            self._send_to_route(message, route)
+            if route.final:
+                return
 
         self._message_store.insert(message)
 
@@ -134,10 +151,6 @@ class Table(log.Logger):
 
     ### private ###
 
-    def _fix_order(self):
-        self._routes = sorted(self._routes,
-                              key=operator.attrgetter('priority'))
-
     def _send_to_route(self, message, route):
         message = message.clone()
         route.owner.on_message(message)
@@ -147,31 +160,72 @@ class MessageStore(object):
     """
     I'm a class responsible for holding the message until they expiration
     time and match them to correct routes.
+    The messages are indexed by the (key, shard) of their recipient, so
+    appending the route only touches the messages addressed to it.
     """
 
     def __init__(self, time_provider):
-        self._store = container.ExpDict(time_provider)
+        self._time = ITimeProvider(time_provider)
+        # (key, shard) -> {message_id: message} in order of insertion
+        self._store = dict()
+        # heap of (expiration_time, (key, shard), message_id)
+        self._expirations = list()
 
     def insert(self, message):
         if not isinstance(message, BaseMessage):
             raise TypeError('Expected BaseMessage got %r' % (message, ))
 
         # ignore messages without expiration time (would leak)
-        if message.expiration_time is not None:
-            self._store.set(message.message_id, message,
-                            message.expiration_time)
+        if message.expiration_time is None:
+            return
+        self._expire()
+        if message.expiration_time <= self._time.get_time():
+            return
+        key = self._get_key(message)
+        messages = self._store.get(key)
+        if messages is None:
+            messages = self._store[key] = collections.OrderedDict()
+        messages[message.message_id] = message
+        heapq.heappush(self._expirations,
+                       (message.expiration_time, key, message.message_id))
 
     def remove(self, message):
         if not isinstance(message, BaseMessage):
             raise TypeError('Expected BaseMessage got %r' % (message, ))
 
-        self._store.pop(message.message_id, None)
+        self._remove(self._get_key(message), message.message_id)
 
     def match_to_route(self, route):
         if not isinstance(route, Route):
             raise TypeError('Expected Route got %r' % (route, ))
 
-        matching = [x for x in self._store.itervalues() if route.match(x)]
+        self._expire()
         if route.final:
-            [self.remove(x) for x in matching]
-        return matching
+            messages = self._store.pop(route.key, None)
+        else:
+            messages = self._store.get(route.key)
+        return messages.values() if messages else []
+
+    ### private ###
+
+    def _get_key(self, message):
+        return (message.recipient.key, message.recipient.route)
+
+    def _remove(self, key, message_id):
+        messages = self._store.get(key)
+        if messages is None:
+            return None
+        message = messages.pop(message_id, None)
+        if not messages:
+            del self._store[key]
+        return message
+
+    def _expire(self):
+        now = self._time.get_time()
+        heap = self._expirations
+        while heap and heap[0][0] <= now:
+            expiration, key, message_id = heapq.heappop(heap)
+            message = self._store.get(key, {}).get(message_id)
+            # the message could have been removed and inserted again
+            if message is not None and message.expiration_time <= now:
+                self._remove(key, message_id)
@@ -4,9 +4,9 @@ from zope.interface import implements
 from twisted.spread import pb
 
 from feat.common import log, defer, first
-from feat.common.serialization import banana
+from feat.common.serialization import binary
 
-from feat.agencies.messaging import routing, debug_message
+from feat.agencies.messaging import routing, envelope, debug_message
 from feat.agencies.messaging.interface import IChannelBinding
 from feat.agencies import common, recipient
 
@@ -20,7 +20,7 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
 
     channel_type = 'unix'
 
-    def __init__(self, broker):
+    def __init__(self, broker, use_envelopes=None, use_binary=None):
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, broker)
         log.Logger.__init__(self, self)
@@ -30,9 +30,10 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
         # routing key -> SlaveReference
         self._slaves = dict()
 
-        # We do banana over banana ...
-        self._serializer = banana.Serializer()
-        self._unserializer = banana.Unserializer()
+        # Messages are sent as banana or binary strings over banana
+        self._codec = envelope.Codec(binary.Serializer(use_binary=use_binary),
+                                     binary.Unserializer(),
+                                     use_envelopes=use_envelopes)
 
     ### IBackend ###
 
@@ -75,7 +76,7 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
                          key, self._slaves.keys())
         else:
             debug_message("<--M", message)
-            data = self._serializer.convert(message)
+            data = self._codec.encode(message)
             d = [s.dispatch(data) for s in self._slaves[key]]
             return defer.DeferredList(d, consumeErrors=True)
 
@@ -93,7 +94,7 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
         self._remove(key, slave)
 
     def remote_dispatch(self, data):
-        message = self._unserializer.convert(data)
+        message = self._codec.decode(data)
         debug_message("M-->", message)
         self._messaging.dispatch(message, outgoing=True)
 
@@ -182,7 +183,7 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
 
     channel_type = 'unix'
 
-    def __init__(self, broker):
+    def __init__(self, broker, use_envelopes=None, use_binary=None):
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, broker)
         log.Logger.__init__(self, self)
@@ -192,9 +193,10 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
         # PBReference to Master137
         self._master = None
 
-        # We do banana over banana ...
-        self._serializer = banana.Serializer()
-        self._unserializer = banana.Unserializer()
+        # Messages are sent as banana or binary strings over banana
+        self._codec = envelope.Codec(binary.Serializer(use_binary=use_binary),
+                                     binary.Unserializer(),
+                                     use_envelopes=use_envelopes)
 
     ### IBackend ###
 
@@ -241,12 +243,12 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
 
     def on_message(self, message):
         debug_message("<--S", message)
-        data = self._serializer.convert(message)
+        data = self._codec.encode(message)
         return self._master.callRemote('dispatch', data)
 
     ### Called by Master ###
 
     def remote_dispatch(self, data):
-        message = self._unserializer.convert(data)
+        message = self._codec.decode(data)
         debug_message("S-->", message)
         self._messaging.dispatch(message, outgoing=False)
@@ -121,7 +121,7 @@ class BaseInterest(log.Logger):
         self.agency_agent = agency_agent
 
         if self._concurrency is not None:
-            self._queue = container.ExpQueue(agency_agent)
+            self._queue = container.HeapExpQueue(agency_agent)
 
         self.bind()
 
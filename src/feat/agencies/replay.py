@@ -27,7 +27,7 @@ from zope.interface import implements, classProvides
 
 from feat.common import serialization, log, text_helper, deep_compare, error
 from feat.agents.base import replay
-from feat.common.serialization import banana
+from feat.common.serialization import banana, binary
 
 from feat.interface.agent import IAgencyAgent
 from feat.interface.generic import ITimeProvider
@@ -305,14 +305,14 @@ class JournalReplayEntry(object):
             raise ReplayError("Side-effect %s called instead of %s"
                               % (unexpected_desc, expected_desc))
 
-        frozen_args = self._replay.serializer.freeze(args)
+        frozen_args = self._replay.freeze_as(args, exp_args)
         if exp_args != frozen_args:
             unexpected_desc = current_effect_as_string()
             expected_desc = expected_effect_as_string(raw_side_effect)
             raise ReplayError("Bad side-effect arguments in %s, expecting %s."
                               % (unexpected_desc, expected_desc))
 
-        kwargs = self._replay.serializer.freeze(kwargs)
+        kwargs = self._replay.freeze_as(kwargs, exp_kwargs)
         if exp_kwargs != kwargs:
             unexpected_desc = current_effect_as_string()
             expected_desc = expected_effect_as_string(raw_side_effect)
@@ -342,8 +342,12 @@ class Replay(log.LogProxy, log.Logger):
         log.Logger.__init__(self, self)
 
         self.journal = journal
-        self.unserializer = banana.Unserializer(externalizer=self)
-        self.serializer = banana.Serializer(externalizer=self)
+        # The binary unserializer also reads the banana journal entries
+        # recorded before the binary format was used
+        self.unserializer = binary.Unserializer(externalizer=self)
+        self.serializer = binary.Serializer(externalizer=self,
+                                            use_binary=True)
+        self.legacy_serializer = banana.Serializer(externalizer=self)
         self.inject_dummy_externals = inject_dummy_externals
 
         self.agent_type = None
@@ -386,13 +390,22 @@ class Replay(log.LogProxy, log.Logger):
         Give the dictionary of recorders detached from the existing instances.
         It is safe to store those references for future use. Used by feattool.
         '''
-        unserializer = banana.Unserializer(externalizer=self)
-        serializer = banana.Serializer(externalizer=self)
+        unserializer = binary.Unserializer(externalizer=self)
+        serializer = binary.Serializer(externalizer=self)
         return unserializer.convert(serializer.convert(self.registry))
 
     def get_agent_type(self):
         return self.agent_type
 
+    def freeze_as(self, value, recorded):
+        '''
+        Freezes the value in the format of the recorded data it is going
+        to be compared with.
+        '''
+        if binary.is_binary(recorded):
+            return self.serializer.freeze(value)
+        return self.legacy_serializer.freeze(value)
+
     ### endof public section ###
 
     def get_time(self):
@@ -762,6 +775,10 @@ class Connection(BaseReplayDummy):
     def bulk_get(self, doc_ids, consume_errors=True):
         raise RuntimeError('bulk_get() should never be called!')
 
+    @serialization.freeze_tag('IDatabaseClient.iter_bulk_get')
+    def iter_bulk_get(self, doc_ids, consume_errors=True):
+        raise RuntimeError('iter_bulk_get() should never be called!')
+
 
 class AgencyAgent(BaseReplayDummy):
 
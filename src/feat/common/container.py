@@ -30,7 +30,7 @@ from feat.interface.generic import ITimeProvider
 
 
 __all__ = ("MroDict", "MroList", "MroDictOfList",
-           "Empty", "ExpDict", "ExpQueue")
+           "Empty", "ExpDict", "ExpQueue", "HeapExpDict", "HeapExpQueue")
 
 PRECISION = 1e3
 MAX_LAZY_PACK_PER_SECOND = 1
@@ -711,6 +711,322 @@ class ExpQueue(ExpBase):
         self._last_pack = now
 
 
+@serialization.register
+class HeapExpDict(ExpBase):
+    """
+    Expiration dictionary keeping the expiration times in a heap.
+    Every operation removes the entries which expired since the previous
+    one, so getting the length doesn't iterate over the elements.
+    The snapshot has the same format as the one of L{ExpDict}.
+    """
+
+    DEFAULT_MAX_SIZE = 100
+
+    type_name = "xheapdict"
+
+    classProvides(serialization.IRestorator)
+    implements(serialization.ISerializable)
+
+    __slots__ = ("_time", "_items", "_heap", "_max_size")
+
+    def __init__(self, time_provider, max_size=None):
+        """Create an expiration dictionary.
+        @param time_provider: who provide the time
+        @type time_provider: L{ITimeProvider}
+        @param max_size: number of outdated expiration entries tolerated
+                         in the heap before rebuilding it
+        @type max_size: int"""
+        self._time = ITimeProvider(time_provider)
+        self._items = {} # {KEY: ExpItem(TIME, VALUE)}
+        self._heap = [] # [(TIME, KEY, ExpItem(TIME, VALUE))]
+        self._max_size = max_size or self.DEFAULT_MAX_SIZE
+
+    def clear(self):
+        """Removes all items from the dictionary."""
+        self._items.clear()
+        self._heap = []
+
+    def pack(self):
+        """Removes all expired items."""
+        self._expire()
+
+    def set(self, key, value=None, expiration=None, relative=False):
+        """Adds an entry to the dictionary with specified expiration and value.
+        @param key: unique key of the entry, used to remove or test ownership
+        @type key: any immutable
+        @param value: black box associated with the key
+        @type value: any python structure or L{ISerializable}
+        @param expiration: the time at which the entry will expire.
+        @type expiration: float
+        @param relative: if the specified expiration time is relative
+                         to EPOC UTC or from now.
+        @type relative: bool
+        @return: nothing"""
+        now = self._expire()
+        if expiration is not None:
+            if relative:
+                expiration = now + expiration
+            if expiration <= now:
+                return
+        self._store(key, ExpItem(expiration, value))
+
+    def remove(self, key):
+        """Removes the dictionary entry with with specified key .
+        @param key: unique key of the entry, used to remove or test ownership
+        @type key: any immutable
+        @return: item value
+        @rtype: any python structure or L{ISerializable}"""
+        self._expire()
+        return self._items.pop(key).value
+
+    def pop(self, key, *default):
+        """Pops and returns the dictionary entry with with specified key.
+        @param key: unique key of the entry, used to remove or test ownership
+        @type key: any immutable
+        @return: value
+        @rtype: any python structure or L{ISerializable}"""
+        self._expire()
+        try:
+            return self._items.pop(key).value
+        except KeyError:
+            if len(default) == 1:
+                return default[0]
+            raise
+
+    def get(self, key, default=None):
+        """Retrieve value from the entry with specified key.
+        @param key: unique key of the entry, used to remove or test ownership
+        @type key: any immutable
+        @param default: value returned if no entry is found with specified key
+        @type default: any python structure or L{ISerializable}
+        @return: entry value or default value
+        @rtype: any python structure or L{ISerializable}"""
+        self._expire()
+        item = self._items.get(key)
+        return default if item is None else item.value
+
+    def get_expiration(self, key):
+        self._expire()
+        return self._items[key].exp
+
+    def iterkeys(self):
+        """Returns an iterator over the dictionary keys."""
+        self._expire()
+        return iter(self._items.keys())
+
+    def itervalues(self):
+        """Returns an iterator over the dictionary values."""
+        self._expire()
+        return iter([i.value for i in self._items.itervalues()])
+
+    def values(self):
+        return list(self.itervalues())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iteritems(self):
+        """Returns an iterator over tuples (key, value)."""
+        self._expire()
+        return iter([(k, i.value) for k, i in self._items.iteritems()])
+
+    def size(self):
+        """Returns the current size, the same as the length."""
+        return len(self)
+
+    def __setitem__(self, key, value):
+        self._expire()
+        self._store(key, ExpItem(None, value))
+
+    def __getitem__(self, key):
+        self._expire()
+        return self._items[key].value
+
+    def __delitem__(self, key):
+        self._expire()
+        del self._items[key]
+
+    def __contains__(self, key):
+        self._expire()
+        return key in self._items
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        self._expire()
+        return len(self._items)
+
+    def __eq__(self, other):
+        if not issubclass(type(other), type(self)):
+            return NotImplemented
+        self._expire()
+        other._expire()
+        a = [(k, i.pri, i.value) for k, i in self._items.iteritems()]
+        b = [(k, i.pri, i.value) for k, i in other._items.iteritems()]
+        a.sort()
+        b.sort()
+        return a == b
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq == NotImplemented else not eq
+
+    def __repr__(self):
+        values = ["%s=%s" % (k, v) for k, v in self.iteritems()]
+        return "<xheapdict: {%s}>" % (", ".join(values), )
+
+    ### ISerializable Method ###
+
+    def snapshot(self):
+        now = self._time.get_time()
+        return (self._time, self._max_size,
+                dict([(k, i.snapshot()) for k, i in self._items.iteritems()
+                      if i.exp is None or i.exp > now]))
+
+    def recover(self, snapshot):
+        self._time, self._max_size, data = snapshot
+        self._items = dict([(k, ExpItem.restore(s))
+                            for k, s in data.iteritems()])
+        self._rebuild_heap()
+
+    ### Private Methods ###
+
+    def _store(self, key, item):
+        self._items[key] = item
+        if item.exp is not None:
+            heapq.heappush(self._heap, (item.exp, key, item))
+            # the entries of the removed and replaced items stay
+            # in the heap until they expire, unless there is too many
+            if len(self._heap) > 2 * len(self._items) + self._max_size:
+                self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [(i.exp, k, i) for k, i in self._items.iteritems()
+                      if i.exp is not None]
+        heapq.heapify(self._heap)
+
+    def _expire(self):
+        now = self._time.get_time()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _exp, key, item = heapq.heappop(heap)
+            if self._items.get(key) is item:
+                del self._items[key]
+        return now
+
+
+@serialization.register
+class HeapExpQueue(ExpBase):
+    """
+    Expiration queue removing the expired values from the top of the heap
+    by every operation, so getting the length doesn't iterate over
+    the elements.
+    The snapshot has the same format as the one of L{ExpQueue}.
+    """
+
+    type_name = "xheapqueue"
+
+    classProvides(serialization.IRestorator)
+    implements(serialization.ISerializable)
+
+    __slots__ = ("_time", "_heap")
+
+    def __init__(self, time_provider):
+        """Create an expiration queue.
+        @param time_provider: who provide the time
+        @type time_provider: L{ITimeProvider}"""
+        self._time = ITimeProvider(time_provider)
+        self._heap = []
+
+    def pack(self):
+        """Removes all expired values."""
+        self._expire()
+
+    def clear(self):
+        """Removes all the values from the queue."""
+        self._heap = []
+
+    def add(self, value, expiration=None, relative=False):
+        """Adds an entry to the queue with specified expiration and value.
+        @param value: black box associated with the key
+        @type value: any python structure or L{ISerializable}
+        @param expiration: the time at which the entry will expire.
+        @type expiration: float
+        @param relative: if the specified expiration time is relative
+                         to EPOC UTC or from now.
+        @type relative: bool
+        @return: nothing"""
+        now = self._expire()
+        if expiration is not None:
+            if relative:
+                expiration = now + expiration
+            if expiration <= now:
+                return
+        heapq.heappush(self._heap, ExpItem(expiration, value))
+
+    def pop(self):
+        """Pops and returns the value with the smaller expiration.
+        @returns: value
+        @rtype: any python structure or L{ISerializable}"""
+        self._expire()
+        try:
+            return heapq.heappop(self._heap).value
+        except IndexError:
+            raise Empty(), None, sys.exc_info()[2]
+
+    def size(self):
+        """Returns the current size, the same as the length."""
+        return len(self)
+
+    def __iter__(self):
+        """Returns an iterator over queue's values."""
+        self._expire()
+        return iter([i.value for i in self._heap])
+
+    def __len__(self):
+        self._expire()
+        return len(self._heap)
+
+    def __eq__(self, other):
+        if not issubclass(type(other), type(self)):
+            return NotImplemented
+        self._expire()
+        other._expire()
+        a = [(i.pri, i.value) for i in self._heap]
+        b = [(i.pri, i.value) for i in other._heap]
+        a.sort()
+        b.sort()
+        return a == b
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq == NotImplemented else not eq
+
+    ### ISerializable Method ###
+
+    def snapshot(self):
+        now = self._time.get_time()
+        return self._time, [i.snapshot()
+                            for i in self._heap
+                            if i.exp is None or i.exp > now]
+
+    def recover(self, snapshot):
+        self._time, data = snapshot
+        self._heap = [ExpItem.restore(d) for d in data]
+        heapq.heapify(self._heap)
+
+    ### Private Methods ###
+
+    def _expire(self):
+        # the values without expiration are at the bottom of the heap
+        now = self._time.get_time()
+        heap = self._heap
+        while heap and heap[0].exp is not None and heap[0].exp <= now:
+            heapq.heappop(heap)
+        return now
+
+
 ## Private Stuff ###
 
 
@@ -55,6 +55,7 @@ class Formatable(serialization.Serializable, annotate.Annotable):
     @classmethod
     def __class__init__(cls, name, bases, dct):
         cls._fields = list()
+        cls._snapshot_plan = None
 
         for base in bases:
             if not issubclass(type(base), MetaFormatable):
@@ -66,6 +67,17 @@ class Formatable(serialization.Serializable, annotate.Annotable):
         # remove field with this name if already present (overriding defaults)
         [cls._fields.remove(x) for x in cls._fields if x.name == field.name]
         cls._fields.append(field)
+        cls._snapshot_plan = None
+
+    @classmethod
+    def _get_snapshot_plan(cls):
+        # Cached list of (ATTRIBUTE_NAME, SNAPSHOT_KEY), reset every time
+        # a field is registered
+        plan = cls._snapshot_plan
+        if plan is None:
+            plan = tuple((f.name, f.serialize_as) for f in cls._fields)
+            cls._snapshot_plan = plan
+        return plan
 
     def __init__(self, **fields):
         self._set_fields(fields)
@@ -116,10 +128,10 @@ class Formatable(serialization.Serializable, annotate.Annotable):
 
     def snapshot(self):
         res = dict()
-        for field in self._fields:
-            value = getattr(self, field.name)
+        for name, key in self._get_snapshot_plan():
+            value = getattr(self, name)
             if value is not None:
-                res[field.serialize_as] = value
+                res[key] = value
         return res
 
     def recover(self, snapshot):
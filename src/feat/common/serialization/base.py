@@ -24,6 +24,7 @@ import operator
 import copy
 import sys
 import types
+import weakref
 
 from zope.interface import implements
 from zope.interface.interface import InterfaceClass
@@ -318,6 +319,24 @@ def referenceable(method):
     return wrapper
 
 
+def _leaf_emitter(flattener):
+    """Builds an emitting method packing the value returned by
+    the specified flatten method of a non-container type."""
+
+    def emitter(self, value, caps, freezing):
+        packer, data = flattener(self, value, caps, freezing)
+        if packer is not None:
+            return packer(data)
+        return data
+
+    return emitter
+
+
+class _TwoPassRequired(Exception):
+    """Raised to abort a single pass serialization when a value
+    would need to be referenced."""
+
+
 class Serializer(object):
     """Base class for serializers handling references.
 
@@ -372,12 +391,28 @@ class Serializer(object):
     should be moved to the constructor and self should not be passed anymore
     as the first parameter because the function would be then bound.
 
+    Sub-classes can set the class attribute single_pass to True to emit
+    the packed structure directly while walking the values, without
+    building the intermediate flattened structure. Because packed values
+    cannot be mutated into references afterward, the single pass is
+    aborted as soon as a referenceable value is seen a second time, and
+    the conversion is started over using the two pass algorithm.
+    While emitting, the instances of types directly implementing
+    ISerializable (or ISnapshotable when freezing) use a snapshot plan
+    cached per type, remembering the packed snapshot keys so they are
+    not flattened and packed again for every instance.
+    The single pass is disabled if a sub-class overrides one of
+    flatten_value, flatten_item, flatten_unknown_value, flatten_instance
+    or flatten_external, because the emitting methods would bypass them.
+
     #FIXME: Add datetime types datetime, date, time and timedelta
 
     """
 
     implements(IFreezer, IConverter)
 
+    single_pass = False
+
     pack_str = None
     pack_unicode = None
     pack_int = None
@@ -416,6 +451,10 @@ class Serializer(object):
         self._registry = IRegistry(registry) if registry else _global_registry
         self._source_ver = source_ver
         self._target_ver = target_ver
+        self._single_pass = self.single_pass and self._can_emit()
+        # {FREEZING: {TYPE: {SNAPSHOT_KEY: PACKED_KEY}}}
+        self._plans = {False: weakref.WeakKeyDictionary(),
+                       True: weakref.WeakKeyDictionary()}
         self.reset()
 
     ### IFreezer ###
@@ -471,6 +510,7 @@ class Serializer(object):
         self._references = {} # {OBJ_ID: REFERENCE_CONTAINER}
         self._memory = []
         self._refid = 0
+        self._emitted = {} # {OBJ_ID: VALUE}
 
     def flatten_unknown_value(self, value, caps, freezing):
         # Flatten enums
@@ -486,33 +526,8 @@ class Serializer(object):
             if extid is not None:
                 return self.flatten_external(extid, caps, freezing)
 
-        # Checks if value support the current required protocol
-        # Could be ISnapshotable or ISerializable
-        if freezing:
-
-            try:
-                snapshotable = ISnapshotable(value)
-            except TypeError:
-                raise TypeError("Freezing of type %s values "
-                                "not supported by %s. Value = %r."
-                                % (type(value).__name__,
-                                   reflect.canonical_name(self), value)), \
-                      None, sys.exc_info()[2]
-
-            return self.flatten_instance(snapshotable, caps, freezing)
-
-        else:
-
-            try:
-                serializable = ISerializable(value)
-            except TypeError:
-                raise TypeError("Serialization of type %s values "
-                                "not supported by %s. Value = %r."
-                                % (type(value).__name__,
-                                   reflect.canonical_name(self), value)), \
-                      None, sys.exc_info()[2]
-
-            return self.flatten_instance(serializable, caps, freezing)
+        return self.flatten_instance(self._adapt_instance(value, freezing),
+                                     caps, freezing)
 
     def flatten_unknown_key(self, value, caps, freezing):
         # Flatten enums
@@ -696,16 +711,7 @@ class Serializer(object):
             if deref is not None:
                 return deref
 
-        snapshot = value.snapshot()
-
-        if self._source_ver is not None:
-            #TODO: If external adapter is needed change this to a cast
-            if IVersionAdapter.providedBy(value):
-                adapter = IVersionAdapter(value)
-                snapshot = adapter.adapt_version(snapshot,
-                                                 self._source_ver,
-                                                 self._target_ver)
-
+        snapshot = self._snapshot(value)
         dump = self.flatten_value(snapshot, caps, freezing)
 
         if freezing:
@@ -727,6 +733,118 @@ class Serializer(object):
             return self.pack_external, flatened
         return self.pack_frozen_external, flatened
 
+    ### single pass emitting ###
+
+    def emit_value(self, value, caps, freezing):
+        vtype = type(value)
+        emitter = self._emit_lookup.get(vtype)
+        if emitter is not None:
+            return emitter(self, value, caps, freezing)
+        if self._externalizer is None:
+            plan = self._plans[freezing].get(vtype)
+            if plan is not None:
+                return self.emit_instance(value, caps, freezing, plan)
+        return self.emit_unknown_value(value, caps, freezing)
+
+    def emit_key(self, key, caps, freezing):
+        if type(key) is tuple:
+            # Referenceable keys are left to the two pass algorithm
+            raise _TwoPassRequired()
+        packer, data = self.flatten_key(key, caps, freezing)
+        return self._pack(packer, data)
+
+    def emit_unknown_value(self, value, caps, freezing):
+        if isinstance(value, enum.Enum):
+            packer, data = self.flatten_enum_value(value, caps, freezing)
+            return self._pack(packer, data)
+
+        if isinstance(value, (type, InterfaceClass)):
+            packer, data = self.flatten_type_value(value, caps, freezing)
+            return self._pack(packer, data)
+
+        if self._externalizer is not None:
+            extid = self._externalizer.identify(value)
+            if extid is not None:
+                return self.emit_external(extid, caps, freezing)
+
+        plan = self._get_plan(value, freezing)
+        if plan is not None:
+            return self.emit_instance(value, caps, freezing, plan)
+
+        return self.emit_instance(self._adapt_instance(value, freezing),
+                                  caps, freezing)
+
+    def emit_tuple_value(self, value, caps, freezing):
+        self.check_capabilities(Capabilities.tuple_values, value,
+                                caps, freezing)
+        self._retain(value)
+        return self._pack(self.pack_tuple,
+                          [self.emit_value(v, caps, freezing)
+                           for v in value])
+
+    def emit_list_value(self, value, caps, freezing):
+        self.check_capabilities(Capabilities.list_values, value,
+                                caps, freezing)
+        self._retain(value)
+        return self._pack(self.pack_list,
+                          [self.emit_value(v, caps, freezing)
+                           for v in value])
+
+    def emit_set_value(self, value, caps, freezing):
+        self.check_capabilities(Capabilities.set_values, value,
+                                caps, freezing)
+        self._retain(value)
+        return self._pack(self.pack_set,
+                          [self.emit_value(v, caps, freezing)
+                           for v in value])
+
+    def emit_dict_value(self, value, caps, freezing, plan=None):
+        self.check_capabilities(Capabilities.dict_values, value,
+                                caps, freezing)
+        self._retain(value)
+        items = value.items()
+        if freezing:
+            items = sorted(items, key=operator.itemgetter(0))
+        pack_item = self.pack_item
+        data = []
+        for key, item in items:
+            if plan is not None and type(key) is str:
+                packed = plan.get(key)
+                if packed is None:
+                    packed = self._plan_key(plan, key, caps, freezing)
+            else:
+                packed = self.emit_key(key, caps, freezing)
+            pair = [packed, self.emit_value(item, caps, freezing)]
+            data.append(pack_item(pair) if pack_item is not None else pair)
+        return self._pack(self.pack_dict, data)
+
+    def emit_instance(self, value, caps, freezing, plan=None):
+        self.check_capabilities(Capabilities.instance_values, value,
+                                caps, freezing)
+
+        if getattr(value, "referenceable", True):
+            self._retain(value)
+
+        snapshot = self._snapshot(value)
+        if plan is not None and type(snapshot) is dict:
+            dump = self.emit_dict_value(snapshot, caps, freezing, plan)
+        else:
+            dump = self.emit_value(snapshot, caps, freezing)
+
+        if freezing:
+            return self._pack(self.pack_frozen_instance, [dump])
+
+        type_name = self._pack(self.pack_type_name, value.type_name)
+        return self._pack(self.pack_instance, [type_name, dump])
+
+    def emit_external(self, value, caps, freezing):
+        self.check_capabilities(Capabilities.external_values, value,
+                                caps, freezing)
+        data = [self.emit_value(value, caps, freezing)]
+        if not freezing:
+            return self._pack(self.pack_external, data)
+        return self._pack(self.pack_frozen_external, data)
+
     ### lookup tables ###
 
     _value_lookup = {tuple: flatten_tuple_value,
@@ -753,10 +871,36 @@ class Serializer(object):
                    bool: flatten_bool_key,
                    type(None): flatten_none_key}
 
+    # Scalar values are packed right after being flattened
+    _emit_lookup = dict((t, _leaf_emitter(f))
+                        for t, f in _value_lookup.iteritems())
+    _emit_lookup.update({tuple: emit_tuple_value,
+                         list: emit_list_value,
+                         set: emit_set_value,
+                         dict: emit_dict_value})
+
+    # Maximum number of packed keys remembered by a snapshot plan
+    _plan_max_keys = 256
+
+    # Methods the emitting methods are replacing
+    _emit_replaces = ("flatten_value", "flatten_item",
+                      "flatten_unknown_value", "flatten_instance",
+                      "flatten_external")
+
     ### private ###
 
     def _convert(self, data, caps, freezing):
         try:
+            if self._single_pass:
+                try:
+                    # Pack the values while walking the structure
+                    packed = self.emit_value(data, caps, freezing)
+                except _TwoPassRequired:
+                    # Some value is referenced multiple times,
+                    # start over with the two pass algorithm
+                    self.reset()
+                else:
+                    return self.post_convertion(packed)
             # Flatten the value to the list-only format with packer function
             flattened = self.flatten_value(data, caps, freezing)
             # Pack all the value with there own packer functions
@@ -767,6 +911,86 @@ class Serializer(object):
             # Reset the state to cleanup all references
             self.reset()
 
+    def _can_emit(self):
+        cls = type(self)
+        for name in self._emit_replaces:
+            method = getattr(cls, name).im_func
+            if method is not getattr(Serializer, name).im_func:
+                return False
+        return True
+
+    def _pack(self, packer, data):
+        if packer is not None:
+            return packer(data)
+        return data
+
+    def _get_plan(self, value, freezing):
+        vtype = type(value)
+        plans = self._plans[freezing]
+        plan = plans.get(vtype)
+        if plan is None:
+            iface = ISnapshotable if freezing else ISerializable
+            if not iface.implementedBy(vtype):
+                # Instances have to be adapted
+                return None
+            # Plans are keyed by the type itself so a redefined class
+            # gets a new one and the old one is dropped along with it.
+            plan = plans[vtype] = {}
+        return plan
+
+    def _plan_key(self, plan, key, caps, freezing):
+        packed = self.emit_key(key, caps, freezing)
+        # Only share immutable packed keys between conversions
+        if isinstance(packed, basestring) and len(plan) < self._plan_max_keys:
+            plan[key] = packed
+        return packed
+
+    def _retain(self, value):
+        ident = id(value)
+        if ident in self._emitted:
+            raise _TwoPassRequired()
+        # Keep a reference to the value to prevent it to be garbage-collected
+        # and another value with the same id to be taken for a reference.
+        self._emitted[ident] = value
+
+    def _adapt_instance(self, value, freezing):
+        # Checks if value support the current required protocol
+        # Could be ISnapshotable or ISerializable
+        if freezing:
+
+            try:
+                return ISnapshotable(value)
+            except TypeError:
+                raise TypeError("Freezing of type %s values "
+                                "not supported by %s. Value = %r."
+                                % (type(value).__name__,
+                                   reflect.canonical_name(self), value)), \
+                      None, sys.exc_info()[2]
+
+        else:
+
+            try:
+                return ISerializable(value)
+            except TypeError:
+                raise TypeError("Serialization of type %s values "
+                                "not supported by %s. Value = %r."
+                                % (type(value).__name__,
+                                   reflect.canonical_name(self), value)), \
+                      None, sys.exc_info()[2]
+
+    def _snapshot(self, value):
+        snapshot = value.snapshot()
+
+        if self._source_ver is not None:
+            #TODO: If external adapter is needed change this to a cast
+            if IVersionAdapter.providedBy(value):
+                adapter = IVersionAdapter(value)
+                snapshot = adapter.adapt_version(snapshot,
+                                                 self._source_ver,
+                                                 self._target_ver)
+
+        return snapshot
+
     def _next_refid(self):
         self._refid += 1
         return self._refid
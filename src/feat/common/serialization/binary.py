@@ -0,0 +1,290 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+from __future__ import absolute_import
+
+import struct
+
+from feat.common.serialization import sexp, banana
+from feat.interface.serialization import *
+
+
+# Prefix of all the encoded data, used to recognize legacy banana data
+MAGIC = "\xff\x01"
+
+# Strings up to this size are interned in the per-stream table
+MAX_INTERNED_SIZE = 64
+
+LIST = "\x01"
+STR = "\x02"
+ATOM = "\x03"
+ATOM_REF = "\x04"
+INT = "\x05"
+NEG_INT = "\x06"
+LONG = "\x07"
+NEG_LONG = "\x08"
+FLOAT = "\x09"
+
+# Integers from 0 to 127 are encoded as a single byte with the high bit set
+SMALL_INT_BASE = 0x80
+
+
+def is_binary(data):
+    '''Tells if the specified data has been encoded by L{BinaryCodec}.'''
+    return isinstance(data, str) and data.startswith(MAGIC)
+
+
+class BinaryCodec(object):
+    '''Encodes the s-expressions produced by L{sexp.Serializer} to a
+    compact binary format. Every value is prefixed by a type tag,
+    lengths and integers are encoded as variable length integers and
+    short strings (atoms, type names, dictionary keys) are only written
+    the first time they appear, later occurrences referencing them
+    by index. Data encoded with L{banana.BananaCodec} is still
+    decoded for backward compatibility.'''
+
+    def __init__(self):
+        self._legacy = banana.BananaCodec()
+
+    def encode(self, lst):
+        parts = [MAGIC]
+        _encode(lst, parts.append, {})
+        return "".join(parts)
+
+    def decode(self, data):
+        if not is_binary(data):
+            return self._legacy.decode(data)
+        try:
+            value, index = _decode(data, len(MAGIC), [])
+        except (IndexError, struct.error):
+            raise ValueError("Truncated binary data")
+        if index != len(data):
+            raise ValueError("Unexpected trailing data at byte %d" % index)
+        return value
+
+
+class Serializer(sexp.Serializer, BinaryCodec):
+    '''Serializes to the binary format only when use_binary is set,
+    otherwise to the banana format. The data is unserialized by
+    L{Unserializer} in both cases.'''
+
+    # the binary format can only be enabled once all the peers reading
+    # the serialized data understand it
+    use_binary = False
+
+    def __init__(self, externalizer=None, source_ver=None, target_ver=None,
+                 use_binary=None):
+        sexp.Serializer.__init__(self, externalizer=externalizer,
+                                 source_ver=source_ver, target_ver=target_ver)
+        BinaryCodec.__init__(self)
+        if use_binary is not None:
+            self.use_binary = use_binary
+
+    ### Overridden Methods ###
+
+    def post_convertion(self, data):
+        if not self.use_binary:
+            return self._legacy.encode(data)
+        return self.encode(data)
+
+
+class Unserializer(sexp.Unserializer, BinaryCodec):
+
+    def __init__(self, registry=None, externalizer=None,
+                 source_ver=None, target_ver=None):
+        sexp.Unserializer.__init__(self, registry=registry,
+                                   externalizer=externalizer,
+                                   source_ver=source_ver,
+                                   target_ver=target_ver)
+        BinaryCodec.__init__(self)
+
+    ### Overridden Methods ###
+
+    def pre_convertion(self, data):
+        return self.decode(data)
+
+
+def serialize(value):
+    global _serializer
+    return _serializer.convert(value)
+
+
+def freeze(value):
+    global _serializer
+    return _serializer.freeze(value)
+
+
+def unserialize(data):
+    global _unserializer
+    return _unserializer.convert(data)
+
+
+### Private Stuff ###
+
+_double = struct.Struct("!d")
+_small_ints = [chr(SMALL_INT_BASE + i) for i in range(0x80)]
+_varints = [chr(i) for i in range(0x80)]
+
+
+def _varint(value):
+    if value < 0x80:
+        return _varints[value]
+    result = []
+    while value >= 0x80:
+        result.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    result.append(chr(value))
+    return "".join(result)
+
+
+def _read_varint(data, index):
+    value = ord(data[index])
+    if value < 0x80:
+        return value, index + 1
+    value &= 0x7f
+    shift = 7
+    while True:
+        index += 1
+        byte = ord(data[index])
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, index + 1
+        shift += 7
+
+
+def _encode(value, write, table):
+    vtype = type(value)
+
+    if vtype is list:
+        write(LIST)
+        write(_varint(len(value)))
+        for item in value:
+            _encode(item, write, table)
+        return
+
+    if vtype is str:
+        size = len(value)
+        if size <= MAX_INTERNED_SIZE:
+            index = table.get(value)
+            if index is not None:
+                write(ATOM_REF)
+                write(_varint(index))
+                return
+            table[value] = len(table)
+            write(ATOM)
+        else:
+            write(STR)
+        write(_varint(size))
+        write(value)
+        return
+
+    if vtype is int:
+        if 0 <= value < 0x80:
+            write(_small_ints[value])
+        elif value >= 0:
+            write(INT)
+            write(_varint(value))
+        else:
+            write(NEG_INT)
+            write(_varint(-value))
+        return
+
+    if vtype is long:
+        if value >= 0:
+            write(LONG)
+            write(_varint(value))
+        else:
+            write(NEG_LONG)
+            write(_varint(-value))
+        return
+
+    if vtype is float:
+        write(FLOAT)
+        write(_double.pack(value))
+        return
+
+    # Sub-classes of the supported types
+    for base in (list, str, long, float):
+        if isinstance(value, base):
+            return _encode(base(value), write, table)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return _encode(int(value), write, table)
+
+    raise TypeError("Type %s values not supported by the binary codec: %r"
+                    % (vtype.__name__, value))
+
+
+def _decode(data, index, table):
+    tag = data[index]
+    index += 1
+    code = ord(tag)
+
+    if code >= SMALL_INT_BASE:
+        return code - SMALL_INT_BASE, index
+
+    if tag == LIST:
+        size, index = _read_varint(data, index)
+        result = []
+        for _ in xrange(size):
+            item, index = _decode(data, index, table)
+            result.append(item)
+        return result, index
+
+    if tag == ATOM_REF:
+        ref, index = _read_varint(data, index)
+        return table[ref], index
+
+    if tag == ATOM or tag == STR:
+        size, index = _read_varint(data, index)
+        end = index + size
+        if end > len(data):
+            raise IndexError(end)
+        value = data[index:end]
+        if tag == ATOM:
+            table.append(value)
+        return value, end
+
+    if tag == INT:
+        value, index = _read_varint(data, index)
+        return int(value), index
+
+    if tag == NEG_INT:
+        value, index = _read_varint(data, index)
+        return int(-value), index
+
+    if tag == LONG:
+        value, index = _read_varint(data, index)
+        return long(value), index
+
+    if tag == NEG_LONG:
+        value, index = _read_varint(data, index)
+        return long(-value), index
+
+    if tag == FLOAT:
+        end = index + _double.size
+        return _double.unpack(data[index:end])[0], end
+
+    raise ValueError("Unknown binary type tag %r at byte %d"
+                     % (tag, index - 1))
+
+
+_serializer = Serializer()
+_unserializer = Unserializer()
@@ -19,6 +19,8 @@
 # See "LICENSE.GPL" in the source distribution for more information.
 
 # Headers in this file shall remain intact.
+import re
+
 from feat import hacks
 
 json = hacks.import_json()
@@ -75,6 +77,8 @@ JSON_FREEZER_CAPS = JSON_CONVERTER_CAPS \
 
 class PreSerializer(base.Serializer):
 
+    single_pass = True
+
     pack_dict = dict
 
     def __init__(self, force_unicode=False, externalizer=None,
@@ -324,7 +328,50 @@ def unserialize(data):
     return _unserializer.convert(data)
 
 
+def iter_rows(data, key=u"rows"):
+    '''Decodes incrementally the list stored under the specified key of
+    a JSON object, like the rows of a CouchDB view response, yielding
+    the items one at a time without decoding the full object first.
+    The other values of the object are skipped.'''
+    decode = _decoder.raw_decode
+    skip = _whitespace.match
+
+    index = _expect(data, skip(data, 0).end(), '{')
+    while data[index:index + 1] != '}':
+        name, index = decode(data, index)
+        index = _expect(data, skip(data, index).end(), ':')
+
+        if name != key:
+            _, index = decode(data, index)
+            index = skip(data, index).end()
+            if data[index:index + 1] == ',':
+                index = skip(data, index + 1).end()
+            continue
+
+        index = _expect(data, index, '[')
+        if data[index:index + 1] == ']':
+            return
+        while True:
+            item, index = decode(data, index)
+            yield item
+            index = skip(data, index).end()
+            if data[index:index + 1] == ']':
+                return
+            index = _expect(data, index, ',')
+
+    raise ValueError("No %r found in JSON object" % (key, ))
+
+
 ### Private Stuff ###
 
 _serializer = Serializer()
 _unserializer = Unserializer()
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _expect(data, index, char):
+    if data[index:index + 1] != char:
+        raise ValueError("Expecting %r at char %d" % (char, index))
+    return _whitespace.match(data, index + 1).end()
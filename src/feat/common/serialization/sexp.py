@@ -48,6 +48,8 @@ class Serializer(base.Serializer):
     '''Serialize any python structure into s-expression compatible
     with twisted.spread.jelly.'''
 
+    single_pass = True
+
     def __init__(self, post_converter=None, externalizer=None,
                  source_ver=None, target_ver=None):
         base.Serializer.__init__(self, post_converter=post_converter,
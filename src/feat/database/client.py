@@ -21,18 +21,21 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import collections
+import itertools
+import json
 import uuid
 import urllib
 
 from twisted.internet import reactor
 from zope.interface import implements
 
-from feat.common import log, defer, time, journal, serialization
+from feat.common import log, defer, time, journal, serialization, container
 from feat.database import document, query
 
 from feat.database.interface import IDatabaseClient, IDatabaseDriver
 from feat.database.interface import IRevisionStore, IDocument, IViewFactory
-from feat.database.interface import NotFoundError
+from feat.database.interface import NotFoundError, DatabaseError
 from feat.interface.generic import ITimeProvider
 from feat.interface.serialization import ISerializable
 
@@ -72,14 +75,23 @@ class ViewFilter(object):
 
 class DocIdFilter(object):
 
+    # maximum number of the document ids passed to the builtin filter
+    # in the query of the changes feed, more of them are filtered here
+    MAX_FILTERED_IDS = 100
+
     def  __init__(self):
         self.name = 'doc_ids'
         # doc_ids -> [(callback, listener_id)]
         self._listeners = {}
+        # listener_id -> doc_ids
+        self._doc_ids = {}
+        # doc_ids passed to the builtin filter, the ids of the cancelled
+        # listeners are kept there not to restart the feed
+        self._filtered = set()
 
     def match(self, doc):
         # used only by emu
-        return doc['_id'] in self._listeners.keys()
+        return doc['_id'] in self._listeners
 
     def notified(self, doc_id, rev, deleted):
         listeners = self._listeners.get(doc_id, list())
@@ -91,28 +103,39 @@ class DocIdFilter(object):
             cur = self._listeners.get(doc_id, list())
             cur.append((callback, listener_id, ))
             self._listeners[doc_id] = cur
+        self._doc_ids.setdefault(listener_id, list()).extend(doc_ids)
 
     def cancel_listener(self, listener_id):
-        changed = False
-        for values in self._listeners.itervalues():
-            iterator = (x for x in values if x[1] == listener_id)
-            for matching in iterator:
-                changed = True
-                values.remove(matching)
-        for key, values in self._listeners.items():
-            # cleanup empty entry
-            if not values:
-                del(self._listeners[key])
-
-        return changed
+        doc_ids = self._doc_ids.pop(listener_id, None)
+        if doc_ids is None:
+            return False
+        for doc_id in doc_ids:
+            values = self._listeners.get(doc_id)
+            if values is None:
+                continue
+            values = [x for x in values if x[1] != listener_id]
+            if values:
+                self._listeners[doc_id] = values
+            else:
+                # cleanup empty entry
+                del(self._listeners[doc_id])
+        return True
 
     def extract_params(self):
         if not self._listeners:
+            self._filtered.clear()
             # returning None prevents channel for being established
             return
-        # FIXME: after upgrading couchdb to a version supporting builting
-        # filter for doc_ids, pass here the correct params to trigger using it
-        return dict()
+        if not self._filtered.issuperset(self._listeners):
+            self._filtered = set(self._listeners)
+        if len(self._filtered) > self.MAX_FILTERED_IDS:
+            # the changes of all the documents are received, the params
+            # don't change with the listeners
+            return dict()
+        # builtin filter of CouchDB, the driver falls back to the
+        # unfiltered feed if the server doesn't support it
+        doc_ids = json.dumps(sorted(self._filtered))
+        return dict(filter='_doc_ids', doc_ids=doc_ids)
 
 
 class ChangeListener(log.Logger):
@@ -173,7 +196,19 @@ class Connection(log.Logger, log.LogProxy):
 
     implements(IDatabaseClient, ITimeProvider, IRevisionStore, ISerializable)
 
-    def __init__(self, database, unserializer=None):
+    # maximum number of documents saved with a single request
+    WRITE_BATCH_SIZE = 100
+
+    # Seconds the revisions of the documents modified by the connection
+    # are remembered to recognize the notifications of own changes.
+    # It has to cover the notifications delayed by reconnecting to
+    # the database, the reconnection is retried at least every 5 minutes.
+    KNOWN_REVISIONS_EXPIRATION = 3600
+    # maximum number of remembered revisions
+    KNOWN_REVISIONS_SIZE = 10000
+
+    def __init__(self, database, unserializer=None, write_batch_window=None,
+                 document_cache_size=None):
         log.Logger.__init__(self, database)
         log.LogProxy.__init__(self, database)
         self._database = IDatabaseDriver(database)
@@ -184,13 +219,23 @@ class Connection(log.Logger, log.LogProxy):
         # listner_id -> doc_ids
         self._listeners = dict()
         self._change_cb = None
-        # Changed to use a normal dictionary.
-        # It will grow boundless up to the number of documents
-        # modified by the connection. It is a kind of memory leak
-        # done to temporarily resolve the problem of notifications
-        # received after the expiration time due to reconnection
-        # killing agents.
-        self._known_revisions = {} # {DOC_ID: (REV_INDEX, REV_HASH)}
+        # {DOC_ID: (REV_INDEX, REV_HASH)}
+        self._known_revisions = KnownRevisions(
+            self, self.KNOWN_REVISIONS_EXPIRATION, self.KNOWN_REVISIONS_SIZE)
+
+        # Opt-in write batching. The documents saved within this number
+        # of seconds are written with a single request, None disables it.
+        self.write_batch_window = write_batch_window
+        # [(serialized doc, doc_id, Deferred)]
+        self._pending_writes = list()
+        self._flush_call = None
+
+        # Opt-in cache of the fetched documents, None disables it.
+        # The entries are revalidated with conditional requests and
+        # dropped when the documents change.
+        self.document_cache_size = document_cache_size
+        # doc_id -> (rev, json document), least recently used first
+        self._document_cache = collections.OrderedDict()
 
     ### IRevisionStore ###
 
@@ -198,6 +243,11 @@ class Connection(log.Logger, log.LogProxy):
     def known_revisions(self):
         return self._known_revisions
 
+    def document_changed(self, doc_id, rev):
+        cached = self._document_cache.get(doc_id)
+        if cached is not None and cached[0] != rev:
+            del self._document_cache[doc_id]
+
     ### ITimeProvider ###
 
     def get_time(self):
@@ -215,7 +265,7 @@ class Connection(log.Logger, log.LogProxy):
         doc = IDocument(doc)
 
         serialized = self._serializer.convert(doc)
-        resp = yield self._database.save_doc(serialized, doc.doc_id)
+        resp = yield self._save_doc(serialized, doc.doc_id)
         self._update_id_and_rev(resp, doc)
 
         for name, attachment in doc.get_attachments().iteritems():
@@ -233,17 +283,14 @@ class Connection(log.Logger, log.LogProxy):
 
     @serialization.freeze_tag('IDatabaseClient.get_document')
     def get_document(self, doc_id):
-        d = self._database.open_doc(doc_id)
+        d = self._open_doc(doc_id)
         d.addCallback(self._unserializer.convert)
         d.addCallback(self._notice_doc_revision)
         return d
 
     @serialization.freeze_tag('IDatabaseClient.get_revision')
     def get_revision(self, doc_id):
-        # FIXME: this could be done by lightweight HEAD request
-        d = self._database.open_doc(doc_id)
-        d.addCallback(lambda doc: doc['_rev'])
-        return d
+        return self._database.get_revision(doc_id)
 
     @serialization.freeze_tag('IDatabaseClient.reload_database')
     def reload_document(self, doc):
@@ -292,6 +339,8 @@ class Connection(log.Logger, log.LogProxy):
     @serialization.freeze_tag('IDatabaseClient.disconnect')
     @journal.named_side_effect('IDatabaseClient.disconnect')
     def disconnect(self):
+        self._flush_writes()
+        self._document_cache.clear()
         if hasattr(self, '_query_cache'):
             self._query_cache.empty()
         for l_id in self._listeners.keys():
@@ -311,26 +360,14 @@ class Connection(log.Logger, log.LogProxy):
 
     @serialization.freeze_tag('IDatabaseClient.bulk_get')
     def bulk_get(self, doc_ids, consume_errors=True):
+        d = self.iter_bulk_get(doc_ids, consume_errors)
+        d.addCallback(list)
+        return d
 
-        def parse_bulk_response(resp):
-            assert isinstance(resp, dict), repr(resp)
-            assert 'rows' in resp, repr(resp)
-
-            result = list()
-            for doc_id, row in zip(doc_ids, resp['rows']):
-                if 'error' in row or 'deleted' in row['value']:
-                    if not consume_errors:
-                        result.append(NotFoundError(doc_id))
-                    else:
-                        self.debug("Bulk get parser consumed error row: %r",
-                                   row)
-                else:
-                    result.append(self._unserializer.convert(row['doc']))
-            return result
-
-
+    @serialization.freeze_tag('IDatabaseClient.iter_bulk_get')
+    def iter_bulk_get(self, doc_ids, consume_errors=True):
         d = self._database.bulk_get(doc_ids)
-        d.addCallback(parse_bulk_response)
+        d.addCallback(self._parse_bulk_response, doc_ids, consume_errors)
         return d
 
     ### public method used by query mechanism ###
@@ -349,6 +386,17 @@ class Connection(log.Logger, log.LogProxy):
                 return None
         return self._query_cache
 
+    def get_query_cache_stats(self):
+        cache = self.get_query_cache(create=False)
+        if cache is None:
+            return dict()
+        return cache.get_stats()
+
+    def bulk_get_raw(self, doc_ids):
+        d = self._database.bulk_get(doc_ids)
+        d.addCallback(self._parse_raw_bulk_response)
+        return d
+
     ### ISerializable Methods ###
 
     def snapshot(self):
@@ -356,6 +404,89 @@ class Connection(log.Logger, log.LogProxy):
 
     ### private
 
+    def _open_doc(self, doc_id):
+        if not self.document_cache_size:
+            return self._database.open_doc(doc_id)
+        cached = self._document_cache.pop(doc_id, None)
+        if cached is None:
+            d = self._database.open_doc(doc_id)
+        else:
+            d = self._database.open_doc_if_modified(doc_id, cached[0])
+        d.addCallback(self._cache_document, doc_id, cached)
+        return d
+
+    def _cache_document(self, doc, doc_id, cached):
+        if doc is None:
+            # not modified, the unserializer gets its own copy
+            rev, serialized = cached
+            doc = json.loads(serialized)
+        else:
+            rev, serialized = doc['_rev'], json.dumps(doc)
+        self._document_cache[doc_id] = (rev, serialized)
+        while len(self._document_cache) > self.document_cache_size:
+            self._document_cache.popitem(last=False)
+        return doc
+
+    def _save_doc(self, serialized, doc_id):
+        if self.write_batch_window is None:
+            return self._database.save_doc(serialized, doc_id)
+
+        if doc_id is not None and any(doc_id == x[1]
+                                      for x in self._pending_writes):
+            # the same document cannot be saved twice in one request
+            self._flush_writes()
+        d = defer.Deferred()
+        self._pending_writes.append((serialized, doc_id, d))
+        if len(self._pending_writes) >= self.WRITE_BATCH_SIZE:
+            self._flush_writes()
+        elif self._flush_call is None:
+            self._flush_call = time.callLater(self.write_batch_window,
+                                              self._flush_writes)
+        return d
+
+    def _flush_writes(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        writes, self._pending_writes = self._pending_writes, list()
+        if not writes:
+            return
+
+        self.log("Saving %d documents in a single request.", len(writes))
+        d = self._database.save_docs([(x[0], x[1]) for x in writes])
+        d.addCallbacks(self._dispatch_writes, self._fail_writes,
+                       callbackArgs=(writes, ), errbackArgs=(writes, ))
+
+    def _dispatch_writes(self, results, writes):
+        for (_, _, d), (success, result) in zip(writes, results):
+            if success:
+                d.callback(result)
+            else:
+                d.errback(result)
+
+    def _fail_writes(self, fail, writes):
+        for _, _, d in writes:
+            d.errback(fail)
+
+    def _parse_bulk_response(self, resp, doc_ids, consume_errors):
+        assert isinstance(resp, dict), repr(resp)
+        assert 'rows' in resp, repr(resp)
+        return self._iter_bulk_rows(doc_ids, resp['rows'], consume_errors)
+
+    def _iter_bulk_rows(self, doc_ids, rows, consume_errors):
+        for doc_id, row in itertools.izip(doc_ids, rows):
+            if _is_bulk_row_found(row):
+                yield self._unserializer.convert(row['doc'])
+            elif not consume_errors:
+                yield NotFoundError(doc_id)
+            else:
+                self.debug("Bulk get parser consumed error row: %r", row)
+
+    def _parse_raw_bulk_response(self, resp):
+        return [row['doc'] for row in resp['rows']
+                if _is_bulk_row_found(row)]
+
     def _cancel_listener(self, lister_id):
         self._database.cancel_listener(lister_id)
         try:
@@ -378,6 +509,7 @@ class Connection(log.Logger, log.LogProxy):
     def _update_id_and_rev(self, resp, doc):
         doc.doc_id = unicode(resp.get('id', None))
         doc.rev = unicode(resp.get('rev', None))
+        self._document_cache.pop(doc.doc_id, None)
         self._notice_doc_revision(doc)
         return doc
 
@@ -388,6 +520,92 @@ class Connection(log.Logger, log.LogProxy):
         return doc
 
 
+class KnownRevisions(container.ExpDict):
+    '''
+    Expiration dictionary of the revisions of the documents modified by
+    the connection. All the entries live for the same time after being
+    stored and the least recently stored ones are dropped if there are
+    more of them than the limit, so the memory stays bounded no matter
+    how many documents the connection modifies. Entries stored with set()
+    without an expiration get the lifetime of the other ones too.
+    '''
+
+    __slots__ = ("_expiration", "_limit", "_order")
+
+    def __init__(self, time_provider, expiration, limit):
+        container.ExpDict.__init__(self, time_provider, max_size=limit)
+        self._expiration = expiration
+        self._limit = limit
+        # key -> expiration time, least recently stored first which
+        # with the same lifetime of all the entries means expiring first
+        self._order = collections.OrderedDict()
+
+    def clear(self):
+        container.ExpDict.clear(self)
+        self._order.clear()
+
+    def set(self, key, value=None, expiration=None, relative=False):
+        # the entries are dropped in the order they are stored in,
+        # so the expiration should be the same for all of them
+        if expiration is None:
+            expiration, relative = self._expiration, True
+        self._expire()
+        self._order.pop(key, None)
+        container.ExpDict.set(self, key, value, expiration, relative)
+        if key not in self._items:
+            # expired right away
+            return
+        self._order[key] = self._items[key].exp
+        if len(self._order) > self._limit:
+            key, _ = self._order.popitem(last=False)
+            self._items.pop(key, None)
+
+    def remove(self, key):
+        self._order.pop(key, None)
+        return container.ExpDict.remove(self, key)
+
+    def pop(self, key, *default):
+        self._order.pop(key, None)
+        return container.ExpDict.pop(self, key, *default)
+
+    def __setitem__(self, key, value):
+        self.set(key, value, self._expiration, relative=True)
+
+    def __delitem__(self, key):
+        container.ExpDict.__delitem__(self, key)
+        self._order.pop(key, None)
+
+    ### private ###
+
+    def _expire(self):
+        # the expired entries are all at the beginning
+        now = self._time.get_time()
+        while self._order:
+            key, exp = next(self._order.iteritems())
+            if exp > now:
+                break
+            del self._order[key]
+            self._items.pop(key, None)
+
+
+def _is_bulk_row_found(row):
+    '''
+    Tells if the row of the bulk_get response contains the document.
+    The missing and deleted documents are reported as not found,
+    the malformed rows raise L{DatabaseError}.
+    '''
+    if not isinstance(row, dict):
+        raise DatabaseError("bulk_get: malformed row %r" % (row, ))
+    if 'error' in row:
+        return False
+    value = row.get('value')
+    if isinstance(value, dict) and 'deleted' in value:
+        return False
+    if not isinstance(value, dict) or 'doc' not in row:
+        raise DatabaseError("bulk_get: malformed row %r" % (row, ))
+    return True
+
+
 def _parse_doc_revision(rev):
     rev_index, rev_hash = rev.split("-", 1)
     return int(rev_index), rev_hash
@@ -412,11 +630,13 @@ class RevisionAnalytic(log.Logger):
     def on_change(self, doc_id, rev, deleted):
         self.log('Change notification received doc_id: %r, rev: %r, '
                  'deleted: %r', doc_id, rev, deleted)
+        self.connection.document_changed(doc_id, rev)
 
         own_change = False
-        if doc_id in self.connection.known_revisions:
+        known = self.connection.known_revisions.get(doc_id)
+        if known is not None:
             rev_index, rev_hash = _parse_doc_revision(rev)
-            last_index, last_hash = self.connection.known_revisions[doc_id]
+            last_index, last_hash = known
 
             if last_index > rev_index:
                 own_change = True
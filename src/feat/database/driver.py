@@ -19,7 +19,9 @@
 # See "LICENSE.GPL" in the source distribution for more information.
 
 # Headers in this file shall remain intact.
+import re
 import urllib
+import urlparse
 import os
 import sys
 
@@ -30,12 +32,13 @@ from twisted.web._newclient import ResponseDone
 from twisted.python import failure
 
 from feat.database.client import Connection, ChangeListener
-from feat.common import log, defer, time
+from feat.common import log, defer, time, serialization
 from feat.agencies import common
+from feat.web import http, httpclient
 
 from feat.database.interface import IDatabaseDriver, IDbConnectionFactory
 from feat.database.interface import NotFoundError, NotConnectedError
-from feat.database.interface import ConflictError, IViewFactory
+from feat.database.interface import ConflictError, IViewFactory, DatabaseError
 from feat.database.interface import IAttachmentPrivate
 
 from feat import extern
@@ -52,41 +55,50 @@ DEFAULT_DB_NAME = "feat"
 
 
 class Notifier(object):
+    '''
+    Keeps the changes feed of a filter. All the listeners of the document
+    ids share the feed of the single DocIdFilter, which dispatches the changes
+    by the document id. Each view filter has a feed filtered by CouchDB.
+    The restarts of a running feed are delayed, so that the listeners
+    registered meanwhile share them, and the restarted feed resumes from
+    the last change received.
+    '''
+
+    # seconds a running feed waits before it's restarted
+    restart_delay = 0.5
 
     def __init__(self, db, filter_):
         self._db = db
         self._filter = filter_
         self.name = self._filter.name
         self._params = None
+        # sequence number of the last change received
+        self._since = None
+        self._restart_call = None
+        self._notifier = defer.Notifier()
 
         self.reconfigure()
 
     def reconfigure(self):
         # called after changing the database
-        self._changes = ChangeNotifier(self._db.paisley, self._db.db_name)
+        self._since = None
+        self._changes = ChangeNotifier(self._db.paisley_notifier,
+                                       self._db.db_name)
         self._changes.addListener(self)
 
     def setup(self):
-        new_params = self._filter.extract_params()
-        if self._params is not None and \
-           new_params == self._params and \
-           self._changes.isRunning():
+        new_params = self._get_params()
+        if new_params is None or not self._changes.isRunning():
+            self._cancel_restart()
+            d = self._start(new_params)
+            d.addCallback(self._restarted)
+            return d
+        if new_params == self._params and self._restart_call is None:
             return defer.succeed(None)
-
-        self._params = new_params
-
-        if self._changes.isRunning():
-            self._changes.stop()
-        d = defer.succeed(None)
-        if new_params is not None:
-            d.addCallback(defer.drop_param, self._db.wait_connected)
-            d.addCallback(defer.drop_param, self._changes.start,
-                           heartbeat=1000, **new_params)
-        else:
-            self._db.log("Stopping notifier: %r", self.name)
-        d.addErrback(self.connectionLost)
-        d.addErrback(failure.Failure.trap, NotConnectedError)
-        return d
+        if self._restart_call is None:
+            self._restart_call = time.callLater(
+                self.restart_delay, self._restart)
+        return self._notifier.wait('restarted')
 
     ### paisleys ChangeListener interface
 
@@ -97,17 +109,114 @@ class Notifier(object):
         if "changes" in change:
             doc_id = change['id']
             deleted = change.get('deleted', False)
+            self._since = change.get('seq', self._since)
             for line in change['changes']:
                 # The changes are analized when there is not http request
                 # pending. Otherwise it can result in race condition problem.
                 self._db.process_notifications(
                     self._filter, doc_id, line['rev'], deleted)
         else:
-            self.info('Bizare notification received from CouchDB: %r', change)
+            self._db.info('Bizare notification received from CouchDB: %r',
+                          change)
 
     def connectionLost(self, reason):
         self._db.connectionLost(reason)
 
+    ### private ###
+
+    def _get_params(self):
+        params = self._filter.extract_params()
+        if (params is not None and params.get('filter') == '_doc_ids' and
+            not self._db.doc_ids_filter):
+            # the server doesn't support the builtin filter
+            params = dict()
+        return params
+
+    def _restart(self):
+        self._restart_call = None
+        d = self._start(self._get_params())
+        d.addCallbacks(self._restarted, self._restart_failed)
+        return d
+
+    def _restarted(self, _):
+        self._notifier.callback('restarted', None)
+
+    def _restart_failed(self, fail):
+        self._notifier.errback('restarted', fail)
+
+    def _cancel_restart(self):
+        if self._restart_call is not None:
+            self._restart_call.cancel()
+            self._restart_call = None
+
+    def _start(self, new_params):
+        if (self._params is not None and new_params == self._params and
+            self._changes.isRunning()):
+            return defer.succeed(None)
+
+        self._params = new_params
+
+        if self._changes.isRunning():
+            self._changes.stop()
+        d = defer.succeed(None)
+        if new_params is not None:
+            params = dict(new_params, heartbeat=1000)
+            if self._since is not None:
+                params['since'] = self._since
+            d.addCallback(defer.drop_param, self._db.wait_connected)
+            d.addCallback(defer.drop_param, self._changes.start, **params)
+        else:
+            self._db.log("Stopping notifier: %r", self.name)
+        d.addErrback(self.connectionLost)
+        d.addErrback(failure.Failure.trap, NotConnectedError)
+        return d
+
+
+class PooledAgent(object):
+    '''
+    Used by paisley in place of twisted.web.client.Agent, sends the requests
+    through the pool of persistent connections.
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        parts = urlparse.urlsplit(uri)
+        location = parts.path
+        if parts.query:
+            location += '?' + parts.query
+        request_headers = dict()
+        if headers is not None:
+            for name, values in headers.getAllRawHeaders():
+                name = name.lower()
+                if http.is_header_multifield(name):
+                    request_headers[name] = values
+                else:
+                    request_headers[name] = values[-1]
+        body = bodyProducer.body if bodyProducer is not None else None
+        d = self.pool.request(http.Methods[method], location,
+                              request_headers, body)
+        d.addCallback(PooledResponse)
+        return d
+
+
+class PooledResponse(object):
+    '''
+    The response received through the connection pool, it looks like
+    the twisted.web.client.Response to paisley.
+    '''
+
+    def __init__(self, response):
+        self.code = int(response.status)
+        self.headers = response.headers
+        self.length = response.length
+        self._body = response.body or ''
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self._body)
+        protocol.connectionLost(failure.Failure(ResponseDone()))
+
 
 class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
 
@@ -115,17 +224,30 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
 
     log_category = "database"
 
+    # number of persistent connections used for the requests
+    connection_pool_size = 4
+    # number of idempotent requests pipelined on a single connection
+    connection_pipeline = 2
+    # seconds after which the unused connections are closed
+    connection_idle_time = 60
+
     def __init__(self, host, port, db_name):
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, log.get_default() or log.FluLogKeeper())
         ChangeListener.__init__(self, self)
 
         self.paisley = None
+        # the changes feeds are kept open, they don't use the pool
+        self.paisley_notifier = None
+        self._pool = None
         self.db_name = None
         self.host = None
         self.port = None
         # name -> Notifier
         self.notifiers = dict()
+        # whether the server supports the builtin _doc_ids filter,
+        # None until the server has been pinged
+        self.doc_ids_filter = None
 
         self.retry = 0
         self.reconnector = None
@@ -155,8 +277,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
 
     ### IDbConnectionFactory
 
-    def get_connection(self):
-        return Connection(self)
+    def get_connection(self, document_cache_size=None):
+        return Connection(self, document_cache_size=document_cache_size)
 
     ### IDatabaseDriver
 
@@ -164,11 +286,34 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         return self._paisley_call(doc_id, self.paisley.openDoc,
                                   self.db_name, doc_id)
 
+    def open_doc_if_modified(self, doc_id, revision):
+        headers = {'if-none-match': '"%s"' % (revision.encode('utf-8'), )}
+        d = self._paisley_call(doc_id, self._document_request,
+                               http.Methods.GET, doc_id, headers)
+        d.addCallback(self._parse_conditional_response)
+        return d
+
+    def get_revision(self, doc_id):
+        d = self._paisley_call(doc_id, self._document_request,
+                               http.Methods.HEAD, doc_id)
+        d.addCallback(self._parse_etag)
+        return d
+
     def save_doc(self, doc, doc_id=None):
         return self._lock_document(doc_id, self._paisley_call,
                                    doc_id, self.paisley.saveDoc,
                                    self.db_name, doc, doc_id)
 
+    def save_docs(self, docs):
+        body = '{"docs": [%s]}' % (", ".join(doc for doc, _ in docs), )
+        url = '/%s/_bulk_docs' % (self.db_name, )
+        d = self._lock_documents([doc_id for _, doc_id in docs],
+                                 self._paisley_call, 'bulk_docs',
+                                 self.paisley.post, url, body)
+        d.addCallback(self.paisley.parseResult)
+        d.addCallback(self._parse_bulk_docs_result)
+        return d
+
     def delete_doc(self, doc_id, revision):
         return self._lock_document(doc_id, self._paisley_call,
                                    doc_id, self.paisley.deleteDoc,
@@ -191,6 +336,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
 
     def disconnect(self):
         self._cancel_reconnector()
+        if self._pool is not None:
+            self._pool.disconnect()
 
     # listen_chagnes from ChangeListener
 
@@ -249,7 +396,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         url = '/%s/_all_docs?include_docs=true' % (self.db_name, )
         d = self._paisley_call('bulk_get', self.paisley.post,
                                url, pjson.dumps(body))
-        d.addCallback(self.paisley.parseResult)
+        d.addCallback(self._parse_bulk_result)
         return d
 
     ### public ###
@@ -266,7 +413,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         if self.reconnector is None or not self.reconnector.active():
             d = defer.Deferred()
             d.addCallback(defer.drop_param, self._paisley_call,
-                           None, self.paisley.listDB)
+                           None, self._ping)
             d.addErrback(failure.Failure.trap, NotConnectedError)
             self.reconnector = time.callLater(wait, d.callback, None)
             return d
@@ -302,19 +449,27 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
     ### private
 
     def _lock_document(self, doc_id, method, *args, **kwargs):
-        lock_value = self._document_locks.get(doc_id, 0) + 1
-        self._document_locks[doc_id] = lock_value
+        return self._lock_documents([doc_id], method, *args, **kwargs)
+
+    def _lock_documents(self, doc_ids, method, *args, **kwargs):
+        for doc_id in doc_ids:
+            lock_value = self._document_locks.get(doc_id, 0) + 1
+            self._document_locks[doc_id] = lock_value
 
-        if lock_value == 1:
-            assert doc_id not in self._pending_notifications, \
-                   "lock_value == 1 and _pending_notifications has a entry"\
-                   ". Something is leaking."
-            self._pending_notifications[doc_id] = list()
+            if lock_value == 1:
+                assert doc_id not in self._pending_notifications, \
+                       "lock_value == 1 and _pending_notifications has a "\
+                       "entry. Something is leaking."
+                self._pending_notifications[doc_id] = list()
 
         d = method(*args, **kwargs)
-        d.addBoth(defer.bridge_param, self._unlock_document, doc_id)
+        d.addBoth(defer.bridge_param, self._unlock_documents, doc_ids)
         return d
 
+    def _unlock_documents(self, doc_ids):
+        for doc_id in doc_ids:
+            self._unlock_document(doc_id)
+
     def _unlock_document(self, doc_id):
         lock_value = self._document_locks.get(doc_id, None)
         assert lock_value is not None, \
@@ -337,19 +492,84 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         d.addErrback(self._error_handler, tag)
         return d
 
+    def _document_request(self, method, doc_id, headers=None):
+        # unlike paisley this gives access to the response headers
+        # and doesn't treat 304 Not Modified as an error
+        location = '/%s/%s' % (self.db_name,
+                               urllib.quote(doc_id.encode('utf-8')))
+        headers = dict(headers or {}, accept=['application/json'])
+        d = self._pool.request(method, location, headers)
+        d.addCallback(self._check_response)
+        return d
+
+    def _check_response(self, response):
+        if response.status >= 400:
+            raise web_error.Error(int(response.status), response.body)
+        return response
+
+    def _parse_conditional_response(self, response):
+        if response.status == http.Status.NOT_MODIFIED:
+            return None
+        return self.paisley.parseResult(response.body)
+
+    def _parse_etag(self, response):
+        etag = response.headers.get('etag')
+        if etag is None:
+            raise DatabaseError("CouchDB didn't send the ETag header")
+        return unicode(etag.strip('"'))
+
     def _configure(self, host, port, name):
         self._cancel_reconnector()
         self.host, self.port = host, port
+        if self._pool is not None:
+            self._pool.disconnect()
+        self._pool = httpclient.ConnectionPool(
+            host, port, logger=self,
+            max_connections=self.connection_pool_size,
+            max_pipeline=self.connection_pipeline,
+            max_idle_time=self.connection_idle_time)
         self.paisley = CouchDB(host, port)
+        self.paisley.client = PooledAgent(self._pool)
+        self.paisley_notifier = CouchDB(host, port)
         self.db_name = name
 
         self._pending_notifications.clear()
         self._document_locks.clear()
 
+        self.doc_ids_filter = None
         [notifier.reconfigure() for notifier in self.notifiers.values()]
         self.reconnect()
         self._setup_notifiers()
 
+    def _parse_bulk_result(self, body):
+        # The rows are only decoded while being iterated over,
+        # so they can be unserialized one at a time by the connection
+        return dict(rows=self._iter_bulk_rows(body))
+
+    def _iter_bulk_rows(self, body):
+        # the errors are raised after the Deferred has fired,
+        # they can't go through _error_handler()
+        try:
+            for row in serialization.json.iter_rows(body):
+                yield row
+        except ValueError as e:
+            raise DatabaseError("bulk_get: malformed response: %s" % (e, ))
+
+    def _parse_bulk_docs_result(self, rows):
+        result = list()
+        for row in rows:
+            if 'error' not in row:
+                result.append((True, dict(ok=True, id=row['id'],
+                                          rev=row['rev'])))
+                continue
+            msg = "bulk_docs %s: %s" % (row.get('id'), row.get('reason'))
+            if row['error'] == 'conflict':
+                error = ConflictError(msg)
+            else:
+                error = DatabaseError(msg)
+            result.append((False, failure.Failure(error)))
+        return result
+
     def _parse_view_result(self, resp):
         assert "rows" in resp
 
@@ -378,6 +598,22 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
 
         return notifier.setup()
 
+    def _ping(self):
+        d = self.paisley.get('/')
+        d.addCallback(self.paisley.parseResult)
+        d.addCallback(self._got_server_info)
+        return d
+
+    def _got_server_info(self, info):
+        # the builtin _doc_ids filter of changes feed is there since 1.1
+        version = tuple(int(x) for x in
+                        re.findall(r'\d+', info.get('version', ''))[:2])
+        supported = version >= (1, 1)
+        if supported != self.doc_ids_filter:
+            self.doc_ids_filter = supported
+            self._setup_notifiers()
+        return info
+
     def _on_connected(self):
         common.ConnectionManager._on_connected(self)
         self._cancel_reconnector()
@@ -21,7 +21,9 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import bisect
 import copy
+import itertools
 import uuid
 import json
 import operator
@@ -58,8 +60,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         self._documents = {}
         # id -> name -> body
         self._attachments = {}
-        # id -> view_name -> (key, value)
-        self._view_cache = {}
+        # view_name -> ViewIndex
+        self._views = {}
 
         self._on_connected()
 
@@ -72,8 +74,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
     ### IDbConnectionFactory
 
-    def get_connection(self):
-        return Connection(self)
+    def get_connection(self, document_cache_size=None):
+        return Connection(self, document_cache_size=document_cache_size)
 
     ### IDatabaseDriver
 
@@ -101,24 +103,24 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
             self.increase_stat('save_doc')
 
-            self._documents[doc['_id']] = doc
-            if doc['_id'] not in self._attachments:
-                self._attachments[doc['_id']] = dict()
+            self._store_doc(doc)
+            stored = self._list_attachments(doc['_id'])
             attachments = doc.get('_attachments', dict())
             for name in attachments:
-                if name not in self._attachments[doc['_id']]:
+                if name not in stored:
                     raise ValueError("Document id %s body has attachment "
                                      "named %s "
                                      "but it is not in our cache " %
                                      (doc['_id'], name))
-            for name in self._attachments[doc['_id']].keys():
-                if name not in attachments:
-                    del self._attachments[doc['_id']][name]
+            removed = [name for name in stored if name not in attachments]
+            if removed:
+                self._delete_attachments(doc['_id'], removed)
+                for name in removed:
                     self.log('Deleted attachment %s of the doc: %s because '
                              'its not in the _attachments key' %
                              (name, doc['_id']))
 
-            self._expire_cache(doc['_id'])
+            self._expire_views(doc['_id'])
 
             r = Response(ok=True, id=doc['_id'], rev=doc['_rev'])
             self._analize_changes(doc)
@@ -128,6 +130,10 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
         return d
 
+    def save_docs(self, docs):
+        defers = [self.save_doc(doc, doc_id) for doc, doc_id in docs]
+        return defer.DeferredList(defers, consumeErrors=True)
+
     def _analize_changes(self, doc):
         for filter_i in self._filters.itervalues():
             if filter_i.match(doc):
@@ -142,8 +148,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         d = defer.Deferred()
         self.increase_stat('open_doc')
         try:
-            doc = self._get_doc(doc_id)
-            doc = copy.deepcopy(doc)
+            doc = self._copy_doc(self._get_doc(doc_id))
             if doc.get('_deleted', None):
                 raise NotFoundError('%s deleted' % doc_id)
             d.callback(Response(doc))
@@ -152,6 +157,37 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
         return d
 
+    def open_doc_if_modified(self, doc_id, revision):
+        '''Imitates the GET request with If-None-Match header.'''
+        d = defer.Deferred()
+        self.increase_stat('open_doc_if_modified')
+        try:
+            doc = self._get_doc(doc_id)
+            if doc.get('_deleted', None):
+                raise NotFoundError('%s deleted' % doc_id)
+            if doc['_rev'] == revision:
+                d.callback(None)
+            else:
+                d.callback(Response(self._copy_doc(doc)))
+        except NotFoundError as e:
+            d.errback(e)
+
+        return d
+
+    def get_revision(self, doc_id):
+        '''Imitates the HEAD request reading the ETag header.'''
+        d = defer.Deferred()
+        self.increase_stat('get_revision')
+        try:
+            doc = self._get_doc(doc_id)
+            if doc.get('_deleted', None):
+                raise NotFoundError('%s deleted' % doc_id)
+            d.callback(doc['_rev'])
+        except NotFoundError as e:
+            d.errback(e)
+
+        return d
+
     def delete_doc(self, doc_id, revision):
         '''Imitates sending DELETE request to CouchDB server'''
         d = defer.Deferred()
@@ -165,14 +201,15 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             if doc.get('_deleted', None):
                 raise NotFoundError('%s deleted' % doc_id)
             doc['_deleted'] = True
-            self._expire_cache(doc['_id'])
+            self._expire_views(doc['_id'])
             for key in doc.keys():
                 if key in ['_rev', '_deleted', '_id']:
                     continue
                 del(doc[key])
             self.log('Marking document %r as deleted', doc_id)
-            del self._attachments[doc['_id']]
+            self._delete_attachments(doc['_id'])
             self._update_rev(doc)
+            self._store_doc(doc)
             self._analize_changes(doc)
             d.callback(Response(ok=True, id=doc_id, rev=doc['_rev']))
         except (ConflictError, NotFoundError, ) as e:
@@ -191,25 +228,18 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             raise ValueError("Query parameter 'include_docs' is invalid for "
                              "reduce views.")
 
-        iterator = (self._perform_map(doc, factory)
-                    for doc in self._iterdocs())
-        d = defer.succeed(iterator)
-        d.addCallback(self._flatten, **options)
-        if use_reduce:
-            d.addCallback(self._perform_reduce, factory, group=group,
-                          group_level=group_level)
-        if include_docs:
-            d.addCallback(self._include_docs)
-        d.addCallback(self._apply_slice, **options)
-        d.addCallback(self._sort_by_key)
-        return d
+        # errors of the map and reduce functions and the invalid options
+        # are reported through the deferred
+        return defer.maybeDeferred(self._query_view, factory, use_reduce,
+                                   group, group_level, include_docs,
+                                   **options)
 
     def disconnect(self):
         pass
 
     def save_attachment(self, doc_id, revision, attachment):
         attachment = IAttachmentPrivate(attachment)
-        doc = self._documents.get(doc_id)
+        doc = self._find_doc(doc_id)
         if not doc:
             return defer.fail(NotFoundError(doc_id))
         if '_attachments' not in doc:
@@ -218,30 +248,34 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             stub=True,
             content_type=attachment.content_type,
             length=attachment.length)
-        self._attachments[doc['_id']][attachment.name] = attachment.get_body()
+        self._store_attachment(doc['_id'], attachment.name,
+                               attachment.get_body())
         self._set_id_and_revision(doc, doc_id)
+        self._store_doc(doc)
+        self._expire_views(doc['_id'])
         r = Response(ok=True, id=doc['_id'], rev=doc['_rev'])
         return defer.succeed(r)
 
     def get_attachment(self, doc_id, name):
-        if doc_id not in self._attachments:
+        doc = self._find_doc(doc_id)
+        if not doc or doc.get('_deleted', False):
             return defer.fail(NotFoundError(doc_id))
-        if name not in self._attachments[doc_id]:
+        body = self._get_attachment(doc_id, name)
+        if body is None:
             return defer.fail(NotFoundError('%s/%s' % (doc_id, name)))
-        return defer.succeed(self._attachments[doc_id][name])
+        return defer.succeed(body)
 
     def get_update_seq(self):
-        return defer.succeed(len(self._changes))
+        return defer.succeed(self._get_update_seq())
 
     def get_changes(self, filter_, limit=None, since=0):
         results = list()
-        for seq in range(since, len(self._changes)):
-            doc = self._changes[seq]
+        for seq, doc in self._iter_changes(since):
             if filter_ and not filter_.match(doc):
                 continue
             results.append(
                 dict(seq=seq, id=doc['_id'], changes=[{'rev': doc['_rev']}]))
-        result = dict(results=results, last_seq=len(self._changes))
+        result = dict(results=results, last_seq=self._get_update_seq())
         return defer.succeed(result)
 
     def bulk_get(self, doc_ids):
@@ -249,8 +283,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         for doc_id in doc_ids:
             self.increase_stat('open_doc')
             try:
-                doc = self._get_doc(doc_id)
-                doc = copy.deepcopy(doc)
+                doc = self._copy_doc(self._get_doc(doc_id))
                 value = dict(rev=doc['_rev'])
                 if doc.get('_deleted', None):
                     value['deleted'] = True
@@ -266,14 +299,27 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         Loads the document into the database from json string. Fakes the
         attachments if necessary.'''
         doc = json.loads(body)
-        self._documents[doc['_id']] = doc
-        self._attachments[doc['_id']] = dict()
+        self._store_doc(doc)
+        self._delete_attachments(doc['_id'])
         for name in doc.get('_attachments', list()):
             attachment_body = attachment_bodies.get(name, 'stub')
-            self._attachments[doc['_id']][name] = attachment_body
+            self._store_attachment(doc['_id'], name, attachment_body)
+        self._expire_views(doc['_id'])
 
     ### private ###
 
+    def _query_view(self, factory, use_reduce, group, group_level,
+                    include_docs, **options):
+        index = self._get_view_index(factory)
+        if use_reduce:
+            rows = index.reduce(group=group, group_level=group_level,
+                                **options)
+        else:
+            rows = index.query(**options)
+        if include_docs:
+            rows = self._include_docs(rows)
+        return rows
+
     def _include_docs(self, rows):
         '''rows here are tuples (key, value, id), returns a list of tuples
         (key, value, id, doc)'''
@@ -284,8 +330,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             else:
                 d_id = row[2]
             try:
-                doc = self._get_doc(d_id)
-                doc = copy.deepcopy(doc)
+                doc = self._copy_doc(self._get_doc(d_id))
                 if doc.get('_deleted', None):
                     raise NotFoundError('%s deleted' % d_id)
             except NotFoundError:
@@ -297,123 +342,19 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             resp.append(row + (doc, ))
         return resp
 
-    def _apply_slice(self, rows, **slice_options):
-        skip = slice_options.get('skip', 0)
-        limit = slice_options.get('limit', None)
-        descend = slice_options.get('descending', False)
-
-        if skip > 0 or limit is not None:
-            if limit is None:
-                index = slice(skip, -1)
-            else:
-                index = slice(skip, skip + limit)
-            rows = rows[index]
-
-        if descend:
-            rows.reverse()
-
-        return rows
-
-    def _sort_by_key(self, rows):
-        return sorted(rows, key=operator.itemgetter(0))
-
-    def _matches_filter(self, tup, **filter_options):
-        if 'key' in filter_options:
-            if filter_options['key'] != tup[0]:
-                return False
-        if 'keys' in filter_options:
-            if tup[0] not in filter_options['keys']:
-                return False
-        descending = filter_options.get('descending', False)
-        if 'startkey' in filter_options:
-            if ((not descending and filter_options['startkey'] > tup[0]) or
-                (descending and filter_options['startkey'] < tup[0])):
-                return False
-        if 'endkey' in filter_options:
-            if ((not descending and filter_options['endkey'] < tup[0]) or
-                (descending and filter_options['endkey'] > tup[0])):
-                return False
-        return True
-
-    def _flatten(self, iterator, **filter_options):
-        '''
-        iterator here gives as lists of tuples. Method flattens the structure
-        to a single list of tuples.
-        '''
-        resp = list()
-        for entry in iterator:
-            for tup in entry:
-                if self._matches_filter(tup, **filter_options):
-                    resp.append(tup)
-        return resp
-
-    def _perform_map(self, doc, factory):
-        cached = self._get_cache(doc['_id'], factory.name)
-        if cached:
-            return cached
-        res = list(x + (doc['_id'], ) for x in factory.map(doc))
-        self._set_cache(doc['_id'], factory.name, res)
-        return res
-
-    def _perform_reduce(self, map_results, factory, group=False,
-                        group_level=None):
-        '''
-        map_results here is a list of tuples (key, value, id)
-        '''
-
-        def get_group_key(key, group, group_level):
-            if group:
-                return key
-            return key[0:group_level]
-
-        if not group and group_level is None:
-            keys = map(operator.itemgetter(0), map_results)
-            values = map(operator.itemgetter(1), map_results)
-            return self._reduce_values(factory, None, keys, values)
-        else:
-            groups = dict()
-            for row in map_results:
-                key, value = row[:2]
-                group_key = get_group_key(key, group, group_level)
-                if group_key not in groups:
-                    groups[group_key] = list()
-                groups[group_key].append((key, value))
-            resp = list()
-            for group_key, results in groups.iteritems():
-                keys = map(operator.itemgetter(0), results)
-                values = map(operator.itemgetter(1), results)
-                resp.extend(
-                    self._reduce_values(factory, group_key, keys, values))
-            return resp
-
-    def _reduce_values(self, factory, group_key, keys, values):
-        if not values:
-            return []
-        if callable(factory.reduce):
-            result = factory.reduce(keys, values)
-        elif factory.reduce == '_sum':
-            result = sum(values)
-        elif factory.reduce == '_count':
-            result = len(values)
-
-        return [(group_key, result, )]
-
-    def _iterdocs(self):
-        for did, doc in self._documents.iteritems():
-            if doc.get('_deleted', False):
-                continue
-            yield doc
-
-    def _get_cache(self, doc_id, view_name):
-        return self._view_cache.get(doc_id, {}).get(view_name, None)
+    def _get_view_index(self, factory):
+        index = self._views.get(factory.name)
+        if index is None or index.factory is not factory:
+            index = self._create_view_index(factory)
+            self._views[factory.name] = index
+        remapped = index.refresh(self._find_doc)
+        if remapped:
+            self._store_view_rows(index, remapped)
+        return index
 
-    def _set_cache(self, doc_id, view_name, value):
-        if doc_id not in self._view_cache:
-            self._view_cache[doc_id] = dict()
-        self._view_cache[doc_id][view_name] = value
-
-    def _expire_cache(self, doc_id):
-        self._view_cache.pop(doc_id, None)
+    def _expire_views(self, doc_id):
+        for index in self._views.itervalues():
+            index.expire(doc_id)
 
     def _set_id_and_revision(self, doc, doc_id):
         doc_id = doc_id or doc.get('_id', None)
@@ -421,7 +362,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             doc_id = self._generate_id(doc)
             self.log("Generating new id for the document: %r", doc_id)
         else:
-            old_doc = self._documents.get(doc_id, None)
+            old_doc = self._find_doc(doc_id)
             if old_doc:
                 self.log('Checking the old document revision')
                 if not old_doc.get('_deleted', False):
@@ -435,7 +376,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         return doc
 
     def _get_doc(self, docId):
-        doc = self._documents.get(docId, None)
+        doc = self._find_doc(docId)
         if not doc:
             raise NotFoundError("%s missing" % docId)
         return doc
@@ -460,8 +401,312 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             counter = int(counter) + 1
         rand = unicode(uuid.uuid1()).replace('-', '')
         doc['_rev'] = unicode("%d-%s" % (counter, rand))
+        self._append_change(doc)
+
+    ### storage, overloaded by the persistent databases ###
+
+    def _find_doc(self, doc_id):
+        return self._documents.get(doc_id, None)
+
+    def _copy_doc(self, doc):
+        return copy.deepcopy(doc)
+
+    def _store_doc(self, doc):
+        self._documents[doc['_id']] = doc
+
+    def _iter_doc_ids(self):
+        return self._documents.iterkeys()
+
+    def _create_view_index(self, factory):
+        index = ViewIndex(factory)
+        index.expire(*self._iter_doc_ids())
+        return index
+
+    def _store_view_rows(self, index, remapped):
+        pass
+
+    def _list_attachments(self, doc_id):
+        return self._attachments.get(doc_id, dict()).keys()
+
+    def _get_attachment(self, doc_id, name):
+        return self._attachments.get(doc_id, dict()).get(name, None)
+
+    def _store_attachment(self, doc_id, name, body):
+        self._attachments.setdefault(doc_id, dict())[name] = body
+
+    def _delete_attachments(self, doc_id, names=None):
+        if names is None:
+            self._attachments.pop(doc_id, None)
+            return
+        for name in names:
+            del self._attachments[doc_id][name]
+
+    def _append_change(self, doc):
         self._changes.append(copy.deepcopy(doc))
 
+    def _iter_changes(self, since):
+        for seq in range(since, len(self._changes)):
+            yield seq, self._changes[seq]
+
+    def _get_update_seq(self):
+        return len(self._changes)
+
+
+class ViewIndex(object):
+    '''
+    Keeps the rows emitted by a single view sorted by (key, doc_id), so that
+    key ranges can be found with bisect instead of mapping and filtering
+    the whole database on every query. Documents changed since the last
+    query are remapped lazily by refresh(). Reduce results are cached per
+    group and only the groups touched by the changed documents are
+    recalculated.
+    '''
+
+    def __init__(self, factory):
+        self.factory = factory
+
+        # sorted list of (key, doc_id, emit_number)
+        self._entries = list()
+        # keys of the entries above, used for bisecting
+        self._keys = list()
+        # doc_id -> list of rows (key, value, doc_id)
+        self._rows = dict()
+        # doc_ids which need to be remapped
+        self._pending = set()
+        # grouping -> ReduceCache, see _get_grouping() for the keys
+        self._reduced = dict()
+
+    def expire(self, *doc_ids):
+        self._pending.update(doc_ids)
+
+    def load(self, rows):
+        '''
+        Fills the index with the rows mapped before, rows is a dictionary
+        doc_id -> list of (key, value, doc_id).
+        '''
+        self._rows = dict(rows)
+        self._reduced.clear()
+        self._rebuild()
+
+    def refresh(self, get_doc):
+        '''
+        Remaps the expired documents, get_doc(doc_id) should return the
+        document or None. Returns the list of (doc_id, rows) remapped.
+        '''
+        if not self._pending:
+            return []
+        mapped = [(doc_id, self._map(get_doc(doc_id)))
+                  for doc_id in self._pending]
+        self._pending.clear()
+        # inserting into the sorted list one by one is quadratic, if a big
+        # part of the index changed it is cheaper to sort it again
+        rebuild = len(mapped) * 4 > len(self._entries)
+        for doc_id, new in mapped:
+            old = self._rows.pop(doc_id, ())
+            if new:
+                self._rows[doc_id] = new
+            self._invalidate_reduced(old, new)
+            if rebuild:
+                continue
+            for number, row in enumerate(old):
+                self._remove((row[0], doc_id, number))
+            for number, row in enumerate(new):
+                self._insert((row[0], doc_id, number))
+        if rebuild:
+            self._rebuild()
+        return mapped
+
+    def query(self, **options):
+        '''Returns the list of map rows (key, value, doc_id).'''
+        positions = self._iter_positions(options)
+        rows = (self._get_row(index) for index in positions)
+        return self._apply_slice(rows, **options)
+
+    def reduce(self, group=False, group_level=None, **options):
+        '''Returns the list of reduced rows (group_key, value).'''
+        grouping = self._get_grouping(group, group_level)
+        if self._is_filtered(options):
+            rows = self._reduce_rows(self._iter_positions(options), grouping)
+        else:
+            rows = self._get_reduced(grouping)
+        if options.get('descending', False):
+            rows = reversed(rows)
+        return self._apply_slice(rows, **options)
+
+    ### private ###
+
+    def _map(self, doc):
+        if doc is None or doc.get('_deleted', False):
+            return ()
+        return [x + (doc['_id'], ) for x in self.factory.map(doc)]
+
+    def _rebuild(self):
+        self._entries = sorted((row[0], doc_id, number)
+                               for doc_id, rows in self._rows.iteritems()
+                               for number, row in enumerate(rows))
+        self._keys = map(operator.itemgetter(0), self._entries)
+
+    def _insert(self, entry):
+        index = bisect.bisect_left(self._entries, entry)
+        self._entries.insert(index, entry)
+        self._keys.insert(index, entry[0])
+
+    def _remove(self, entry):
+        index = bisect.bisect_left(self._entries, entry)
+        if index >= len(self._entries) or self._entries[index] != entry:
+            # keys which do not compare consistently, fallback to search
+            index = self._entries.index(entry)
+        del self._entries[index]
+        del self._keys[index]
+
+    def _get_row(self, index):
+        key, doc_id, number = self._entries[index]
+        return self._rows[doc_id][number]
+
+    def _is_filtered(self, options):
+        return ('key' in options or 'keys' in options or
+                'startkey' in options or 'endkey' in options)
+
+    def _iter_positions(self, options):
+        ranges = self._get_ranges(options)
+        if options.get('descending', False):
+            return (i for lo, hi in reversed(ranges)
+                    for i in xrange(hi - 1, lo - 1, -1))
+        return (i for lo, hi in ranges for i in xrange(lo, hi))
+
+    def _get_ranges(self, options):
+        '''
+        Returns the list of ascending (lo, hi) ranges of the indexes of the
+        entries matching the query options.
+        '''
+        lo, hi = 0, len(self._keys)
+        if options.get('descending', False):
+            upper, lower = 'startkey', 'endkey'
+        else:
+            lower, upper = 'startkey', 'endkey'
+        if lower in options:
+            lo = bisect.bisect_left(self._keys, options[lower])
+        if upper in options:
+            hi = bisect.bisect_right(self._keys, options[upper], lo)
+        if 'key' in options:
+            lo, hi = self._narrow(lo, hi, options['key'])
+        if 'keys' not in options:
+            return [(lo, hi)] if lo < hi else []
+        keys = (key for key, _ in itertools.groupby(sorted(options['keys'])))
+        ranges = (self._narrow(lo, hi, key) for key in keys)
+        return [(start, end) for start, end in ranges if start < end]
+
+    def _narrow(self, lo, hi, key):
+        start = bisect.bisect_left(self._keys, key, lo, hi)
+        return start, bisect.bisect_right(self._keys, key, start, hi)
+
+    def _apply_slice(self, rows, skip=0, limit=None, **_options):
+        if limit is not None:
+            return list(itertools.islice(rows, skip, skip + limit))
+        return list(itertools.islice(rows, skip, None))
+
+    ### reduce ###
+
+    def _get_grouping(self, group, group_level):
+        if not group and group_level is None:
+            return None
+        return (bool(group), group_level)
+
+    def _get_group_key(self, key, grouping):
+        if grouping is None:
+            return None
+        group, group_level = grouping
+        if group:
+            return key
+        return key[0:group_level]
+
+    def _reduce_rows(self, positions, grouping):
+        if grouping is None:
+            return self._reduce_group(None, positions)
+        groups = dict()
+        for index in positions:
+            group_key = self._get_group_key(self._keys[index], grouping)
+            groups.setdefault(group_key, list()).append(index)
+        resp = list()
+        for group_key in sorted(groups):
+            resp.extend(self._reduce_group(group_key, groups[group_key]))
+        return resp
+
+    def _reduce_group(self, group_key, positions):
+        rows = [self._get_row(index) for index in positions]
+        if not rows:
+            return []
+        keys = map(operator.itemgetter(0), rows)
+        values = map(operator.itemgetter(1), rows)
+        reduce = self.factory.reduce
+        if callable(reduce):
+            result = reduce(keys, values)
+        elif reduce == '_sum':
+            result = sum(values)
+        elif reduce == '_count':
+            result = len(values)
+        return [(group_key, result, )]
+
+    def _get_reduced(self, grouping):
+        cache = self._reduced.get(grouping)
+        if cache is None:
+            positions = xrange(len(self._entries))
+            cache = ReduceCache(self._reduce_rows(positions, grouping))
+            self._reduced[grouping] = cache
+        elif cache.dirty:
+            dirty, cache.dirty = cache.dirty, set()
+            for group_key in dirty:
+                positions = self._get_group_positions(group_key, grouping)
+                cache.update(group_key,
+                             self._reduce_group(group_key, positions))
+        return cache.get_rows()
+
+    def _get_group_positions(self, group_key, grouping):
+        if grouping is None:
+            return xrange(len(self._entries))
+        group, group_level = grouping
+        lo = bisect.bisect_left(self._keys, group_key)
+        if group:
+            return xrange(lo, bisect.bisect_right(self._keys, group_key, lo))
+        # keys sharing the prefix are contiguous and sort after the prefix
+        hi = lo
+        while (hi < len(self._keys) and
+               self._keys[hi][0:group_level] == group_key):
+            hi += 1
+        return xrange(lo, hi)
+
+    def _invalidate_reduced(self, old, new):
+        for grouping, cache in self._reduced.items():
+            try:
+                for row in itertools.chain(old, new):
+                    cache.dirty.add(self._get_group_key(row[0], grouping))
+            except TypeError:
+                # key which cannot be grouped, the next query will raise
+                del self._reduced[grouping]
+
+
+class ReduceCache(object):
+    '''
+    Reduced rows of the view for a single grouping, sorted by the group key.
+    '''
+
+    def __init__(self, rows):
+        self.dirty = set()
+        self._values = dict(rows)
+        self._keys = sorted(self._values)
+
+    def update(self, group_key, rows):
+        if rows:
+            if group_key not in self._values:
+                bisect.insort(self._keys, group_key)
+            self._values[group_key] = rows[0][1]
+        elif group_key in self._values:
+            del self._values[group_key]
+            self._keys.remove(group_key)
+
+    def get_rows(self):
+        return [(key, self._values[key]) for key in self._keys]
+
 
 class Response(dict):
 
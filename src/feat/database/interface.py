@@ -64,10 +64,12 @@ class IDbConnectionFactory(Interface):
     Should be implemented by database drivers passed to the agency.
     '''
 
-    def get_connection():
+    def get_connection(document_cache_size=None):
         '''
         Instantiate the connection for the agent.
 
+        @param document_cache_size: number of documents cached by the
+                                    connection, None disables the cache
         @returns: L{IDatabaseClient}
         '''
 
@@ -200,6 +202,15 @@ class IDatabaseDriver(Interface):
         @return: Deferred fired with the HTTP response body (keys: id, rev)
         '''
 
+    def save_docs(docs):
+        '''
+        Create or update multiple documents in a single request.
+        @param docs: C{list} of tuples (json document, doc_id)
+        @return: Deferred fired with the list of tuples (success, result)
+                 like DeferredList, result is the response body of the
+                 document (keys: id, rev) or the Failure (ConflictError)
+        '''
+
     def open_doc(doc_id):
         '''
         Fetch document from database.
@@ -207,6 +218,24 @@ class IDatabaseDriver(Interface):
         @return: Deferred fired with json parsed document.
         '''
 
+    def open_doc_if_modified(doc_id, revision):
+        '''
+        Fetch document from database unless its revision is still the
+        one specified.
+        @param doc_id: id of the document to fetch
+        @param revision: revision of the document known to the caller
+        @return: Deferred fired with json parsed document or None if
+                 the document has not been modified.
+        '''
+
+    def get_revision(doc_id):
+        '''
+        Fetch the current revision of the document without its body.
+        @param doc_id: id of the document
+        @return: Deferred fired with the revision or errbacked with
+                 NotFoundError
+        '''
+
     def delete_doc(doc_id, revision):
         '''
         Mark document as delete.
@@ -285,6 +314,17 @@ class IDatabaseDriver(Interface):
         @callback: list of documents
         '''
 
+    def iter_bulk_get(doc_ids, consume_errors=True):
+        '''
+        Like bulk_get() but the documents are decoded and unserialized
+        one at a time while iterating over the result. The errors found
+        in the response are raised by the iteration, a malformed response
+        or row raises L{DatabaseError}.
+        @param doc_ids: C{list} of doc_ids to fetch
+        @rtype: Deferred
+        @callback: iterator of documents
+        '''
+
     def get_query_cache(self, create=True):
         '''Called by methods inside feat.database.query module to obtain
         the query cache.
@@ -292,6 +332,20 @@ class IDatabaseDriver(Interface):
                        exist yet, returns None otherwise
         '''
 
+    def get_query_cache_stats():
+        '''
+        Returns the C{dict} with the counters of the query cache: hits,
+        misses, evictions, invalidations, entries and size.
+        '''
+
+    def bulk_get_raw(doc_ids):
+        '''Called by the query cache to map the changed documents.
+        @param doc_ids: C{list} of doc_ids to fetch
+        @rtype: Deferred
+        @callback: list of the documents as C{dict}, missing and deleted
+                   documents are skipped
+        '''
+
 
 class IDocument(Interface):
     '''Interface implemented by objects stored in database.'''
@@ -378,7 +432,14 @@ class IRevisionStore(Interface):
     RevisionFilter to obtain the information about the documents changed
     by this connection.'''
 
-    known_revisions = Attribute('dict of doc_id -> (last_index, last_hash)')
+    known_revisions = Attribute('dict-like of doc_id -> '
+                                '(last_index, last_hash)')
+
+    def document_changed(doc_id, rev):
+        '''
+        Called for the change notifications received by the listeners
+        of the connection.
+        '''
 
 
 class IViewFactory(Interface):
@@ -463,6 +524,9 @@ class IQueryCache(Interface):
         @param connection: L{IDatabaseClient}
         @param factory: L{IQueryViewFactory}
         @param subquery: C{tuple} (field_name, Evaluator, value)
+                         for the compound indexes field_name is
+                         the tuple of the fields and value the tuple
+                         of their values
         '''
 
 
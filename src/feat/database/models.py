@@ -60,12 +60,24 @@ class QueryView(model.Collection):
     def _set_connection(self, connection):
         self.connection = IDatabaseClient(connection)
 
+    def _store_token(self, cursor):
+        self._next_token = cursor.token
+
     ### action body implementation ###
 
-    def do_select(self, value, skip, sorting=None, limit=None):
+    def do_select(self, value, skip, sorting=None, limit=None, token=None):
         if sorting:
             value.set_sorting(sorting)
         cls = type(self)
+        self._next_token = None
+        if limit is not None or token is not None:
+            # paged select, the response includes the continuation token
+            cursor = query.select_iter(
+                self.connection, value, limit, token=token, skip=skip,
+                include_docs=not cls._fetch_documents_set)
+            d = cursor.next_page()
+            d.addCallback(defer.bridge_param, self._store_token, cursor)
+            return d
         if cls._fetch_documents_set:
             method = query.select_ids
         else:
@@ -78,6 +90,8 @@ class QueryView(model.Collection):
             self._query_set_factory = factory
         items = [(self.get_child_name(x), x) for x in value]
         result = self._query_set_factory(self.source, items)
+        if getattr(self, '_next_token', None) is not None:
+            result.put_meta('next_token', self._next_token)
         return result.initiate(view=self.view, officer=self.officer,
                                aspect=self.aspect)
 
@@ -156,7 +170,9 @@ class QueryView(model.Collection):
             params=[action.Param('query', QueryValue()),
                     action.Param('sorting', SortingValue(), is_required=False),
                     action.Param('skip', value.Integer(0), is_required=False),
-                    action.Param('limit', value.Integer(), is_required=False)])
+                    action.Param('limit', value.Integer(), is_required=False),
+                    action.Param('token', value.String(),
+                                 is_required=False)])
         cls.annotate_action(u"select", SelectAction)
 
         # define count action
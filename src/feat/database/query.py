@@ -1,6 +1,10 @@
-import operator
+import base64
+import copy
+import json
 import sys
 
+from collections import OrderedDict
+
 from zope.interface import implements
 
 from feat.common import serialization, enum, first, defer, annotate, log
@@ -10,30 +14,75 @@ from feat.database.interface import IQueryViewFactory
 from feat.database.interface import IPlanBuilder, IQueryCache
 
 
+class Response(list):
+    '''
+    List of doc_ids returned for the subquery. The positions of the
+    documents are calculated once and kept together with the cached list.
+    '''
+
+    _positions = None
+
+    def get_positions(self):
+        '''
+        Returns the C{dict} doc_id -> index of its first appearance.
+        '''
+        if self._positions is None:
+            positions = dict()
+            for index, doc_id in enumerate(self):
+                positions.setdefault(doc_id, index)
+            self._positions = positions
+        return self._positions
+
+
 class CacheEntry(object):
 
     def __init__(self, seq_num, entries):
         self.seq_num = seq_num
-        self.entries = entries
-        self.size = sys.getsizeof(entries)
+        self.entries = Response(entries)
+        # the positions are used to expire the entry and sort the results,
+        # they are kept for as long as the entry
+        positions = self.entries.get_positions()
+        self.size = sys.getsizeof(entries) + sys.getsizeof(positions)
+
+    def contains_any(self, doc_ids):
+        positions = self.entries.get_positions()
+        return any(doc_id in positions for doc_id in doc_ids)
 
 
 class Cache(log.Logger):
+    '''
+    LRU cache of the responses to subqueries. When the database changes
+    the documents changed are mapped again and only the responses they
+    can affect are expired.
+    '''
 
     implements(IQueryCache)
 
     CACHE_LIMIT = 1024 * 1024 * 20 # 20 MB of memory max
+    # above this number of changed documents the cache of the view is
+    # cleared instead of analyzing each document
+    CHANGES_LIMIT = 100
 
     def __init__(self, logger):
         log.Logger.__init__(self, logger)
         # name -> query -> CacheEntry
         self._cache = dict()
+        # (name, query) -> CacheEntry, least recently used first
+        self._lru = OrderedDict()
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
 
     ### IQueryCache ###
 
     def empty(self):
         self.debug("Emptying query cache.")
         self._cache.clear()
+        self._lru.clear()
+        self._size = 0
 
     def query(self, connection, factory, subquery):
         self.debug("query() called for %s view and subquery %r", factory.name,
@@ -46,102 +95,164 @@ class Cache(log.Logger):
     ### public ###
 
     def get_cache_size(self):
-        size = 0
-        for name, subcache in self._cache.iteritems():
-            for query, entry in subcache.iteritems():
-                size += entry.size
-        return size
+        return self._size
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    invalidations=self.invalidations,
+                    entries=len(self._lru), size=self._size)
 
     ### private, continuations of query process ###
 
     def _got_seq_num(self, connection, factory, subquery, seq_num):
-        if factory.name in self._cache:
-            entry = self._cache[factory.name].get(subquery)
-            if not entry:
-                return self._fetch_subquery(
-                    connection, factory, subquery, seq_num)
-            elif entry.seq_num == seq_num:
-                self.debug("Query served from the cache hit, %d rows",
-                           len(entry.entries))
-                return entry.entries
-            else:
-                d = connection.get_changes(factory, limit=2,
-                                           since=entry.seq_num)
-                d.addCallback(defer.inject_param, 4,
-                              self._analyze_changes,
-                              connection, factory, subquery, entry, seq_num)
-                return d
-        else:
+        entry = self._get_entry(factory, subquery)
+        if not entry:
             return self._fetch_subquery(connection, factory, subquery, seq_num)
+        elif entry.seq_num >= seq_num:
+            self.debug("Query served from the cache hit, %d rows",
+                       len(entry.entries))
+            self.hits += 1
+            return entry.entries
+        else:
+            d = connection.get_changes(factory, limit=self.CHANGES_LIMIT + 1,
+                                       since=entry.seq_num)
+            d.addCallback(defer.inject_param, 4,
+                          self._analyze_changes,
+                          connection, factory, subquery, entry, seq_num)
+            return d
 
     def _fetch_subquery(self, connection, factory, subquery, seq_num):
+        self.misses += 1
         keys = self._generate_keys(*subquery)
         self.log("Will query view %s, with keys %r, as a result of"
                  " subquery: %r", factory.name, keys, subquery)
         d = connection.query_view(factory, **keys)
-        d.addCallback(defer.keep_param,
-                      self._cache_response, factory, subquery, seq_num)
+        d.addCallback(self._cache_response, factory, subquery, seq_num)
         return d
 
     def _cache_response(self, entries, factory, subquery, seq_num):
         self.debug("Caching response for %r at seq_num: %d, %d rows",
                    subquery, seq_num, len(entries))
-        if factory.name not in self._cache:
-            self._cache[factory.name] = dict()
-        self._cache[factory.name][subquery] = CacheEntry(seq_num, entries)
+        self._remove_entry(factory.name, subquery)
+        entry = CacheEntry(seq_num, entries)
+        self._cache.setdefault(factory.name, dict())[subquery] = entry
+        self._lru[(factory.name, subquery)] = entry
+        self._size += entry.size
         self._check_size_limit()
+        return entry.entries
 
     def _analyze_changes(self, connection, factory, subquery, entry, changes,
                          seq_num):
-        if changes['results']:
-            self.debug("View %s has changed, expiring cache.", factory.name)
-            if factory.name in self._cache: # this is not to fail on
-                                            # concurrent checks expiring cache
-                self._cache[factory.name].clear()
-            d = self._fetch_subquery(connection, factory, subquery, seq_num)
-            d.addCallback(defer.keep_param,
-                          self._cache_response, factory, subquery, seq_num)
-            return d
-        else:
+        doc_ids = set(x['id'] for x in changes['results'])
+        if not doc_ids:
             self.debug("View %s has not changed, marking cached fragments as "
                        "fresh. %d rows", factory.name, len(entry.entries))
-            result = entry.entries
-            if factory.name in self._cache:
-                for entry in self._cache[factory.name].itervalues():
-                    entry.seq_num = seq_num
-            return result
+            self._mark_fresh(factory, entry.seq_num, seq_num)
+            return self._got_seq_num(connection, factory, subquery, seq_num)
+        if (len(doc_ids) > self.CHANGES_LIMIT or
+            not callable(getattr(factory, 'map', None))):
+            self.debug("View %s has changed, expiring cache.", factory.name)
+            self._invalidate(factory, entry.seq_num, lambda *_: True)
+            return self._got_seq_num(connection, factory, subquery, seq_num)
+
+        d = connection.bulk_get_raw(list(doc_ids))
+        d.addCallback(self._get_changed_keys, factory)
+        d.addCallback(self._expire_changed, factory, entry.seq_num, doc_ids)
+        d.addCallback(defer.drop_param, self._mark_fresh, factory,
+                      entry.seq_num, seq_num)
+        d.addCallback(defer.drop_param, self._got_seq_num,
+                      connection, factory, subquery, seq_num)
+        return d
+
+    def _get_changed_keys(self, docs, factory):
+        keys = dict()
+        for doc in docs:
+            for key, _ in factory.map(doc):
+                if not isinstance(key, (list, tuple)):
+                    continue
+                if len(key) == 2:
+                    keys.setdefault(key[0], list()).append(key[1])
+                elif len(key) > 2 and isinstance(key[0], (list, tuple)):
+                    # row of the compound index
+                    keys.setdefault(tuple(key[0]), list()).append(
+                        tuple(key[1:]))
+        return keys
+
+    def _expire_changed(self, keys, factory, since, doc_ids):
+
+        def is_affected(entry, subquery):
+            field, evaluator, value = subquery
+            if entry.contains_any(doc_ids):
+                return True
+            if isinstance(field, tuple):
+                fixed = tuple(value[:-1])
+                return any(x[:-1] == fixed and
+                           _may_match(evaluator, value[-1], x[-1])
+                           for x in keys.get(field, ()))
+            return any(_may_match(evaluator, value, x)
+                       for x in keys.get(field, ()))
+
+        self._invalidate(factory, since, is_affected)
+
+    def _invalidate(self, factory, since, predicate):
+        subcache = self._cache.get(factory.name, dict())
+        for subquery, entry in subcache.items():
+            if entry.seq_num >= since and predicate(entry, subquery):
+                self.debug("Expiring cached response for %r", subquery)
+                self.invalidations += 1
+                self._remove_entry(factory.name, subquery)
+
+    def _mark_fresh(self, factory, since, seq_num):
+        # the changes since the given seq_num have been analyzed, this only
+        # applies to the fragments which were fresh at that point
+        for entry in self._cache.get(factory.name, dict()).itervalues():
+            if entry.seq_num >= since:
+                entry.seq_num = max(entry.seq_num, seq_num)
 
     def _generate_keys(self, field, evaluator, value):
+        if isinstance(field, tuple):
+            # compound index, all the values but the last one are fixed
+            prefix = (field, ) + tuple(value[:-1])
+            value = value[-1]
+        else:
+            prefix = (field, )
         if evaluator == Evaluator.equals:
-            return dict(key=(field, value))
+            return dict(key=prefix + (value, ))
         if evaluator == Evaluator.le:
-            return dict(startkey=(field, ), endkey=(field, value))
+            return dict(startkey=prefix, endkey=prefix + (value, ))
         if evaluator == Evaluator.ge:
-            return dict(startkey=(field, value), endkey=(field, {}))
+            return dict(startkey=prefix + (value, ), endkey=prefix + ({}, ))
         if evaluator == Evaluator.between:
-            return dict(startkey=(field, value[0]), endkey=(field, value[1]))
+            return dict(startkey=prefix + (value[0], ),
+                        endkey=prefix + (value[1], ))
         if evaluator == Evaluator.inside:
-            return dict(keys=[(field, x) for x in value])
+            return dict(keys=[prefix + (x, ) for x in value])
         if evaluator == Evaluator.none:
-            return dict(startkey=(field, ), endkey=(field, {}))
+            return dict(startkey=prefix, endkey=prefix + ({}, ))
+
+    ### private, LRU bookkeeping ###
+
+    def _get_entry(self, factory, subquery):
+        key = (factory.name, subquery)
+        entry = self._lru.pop(key, None)
+        if entry is not None:
+            self._lru[key] = entry
+        return entry
 
-    ### private, check that the cache is not too big ###
+    def _remove_entry(self, name, subquery):
+        entry = self._lru.pop((name, subquery), None)
+        if entry is None:
+            return
+        self._size -= entry.size
+        del self._cache[name][subquery]
 
     def _check_size_limit(self):
-        size = self.get_cache_size()
-        if size > self.CACHE_LIMIT:
-            self._cleanup_old_cache(size - self.CACHE_LIMIT)
-
-    def _cleanup_old_cache(self, to_release):
-        entries = [(x.seq_num, x.size, name, subquery)
-                   for name, subcache in self._cache.iteritems()
-                   for subquery, x in subcache.iteritems()]
-        entries.sort(key=operator.itemgetter(0))
-        released = 0
-        while released < to_release:
-            entry = entries.pop(0)
-            released += entry[1]
-            del self._cache[entry[2]][entry[3]]
+        while self._size > self.CACHE_LIMIT and self._lru:
+            name, subquery = next(iter(self._lru))
+            self.debug("Releasing cached response for %r", subquery)
+            self.evictions += 1
+            self._remove_entry(name, subquery)
 
 
 class QueryViewMeta(type(view.BaseView)):
@@ -151,6 +262,7 @@ class QueryViewMeta(type(view.BaseView)):
     def __init__(cls, name, bases, dct):
         cls.HANDLERS = HANDLERS = dict()
         cls.DOCUMENT_TYPES = DOCUMENT_TYPES = list()
+        cls.COMPOUND_INDEXES = COMPOUND_INDEXES = list()
 
         # map() and filter() function have to be generated separetely for
         # each subclass, because they will have different constants attached
@@ -164,6 +276,7 @@ class QueryViewMeta(type(view.BaseView)):
             for field, handler in HANDLERS.iteritems():
                 for value in handler(doc):
                     yield (field, value), None
+        custom_map = 'map' in dct
         cls.map = cls._querymethod(dct.pop('map', map))
 
         def filter(doc, request):
@@ -173,6 +286,42 @@ class QueryViewMeta(type(view.BaseView)):
         # this processes all the annotations
         super(QueryViewMeta, cls).__init__(name, bases, dct)
 
+        for fields in cls.COMPOUND_INDEXES:
+            for field in fields:
+                if field not in cls.HANDLERS:
+                    raise ValueError("Compound index %r uses unknown "
+                                     "field: '%s'" % (fields, field))
+
+        if cls.COMPOUND_INDEXES and custom_map:
+            # the planner would rewrite the queries to the keys which only
+            # the generated map() function emits
+            raise ValueError("Compound index %r cannot be used together "
+                             "with the custom map() function of the view "
+                             "%s" % (cls.COMPOUND_INDEXES[0], name))
+
+        if cls.COMPOUND_INDEXES:
+            # in composite-index mode the rows for the declared combination
+            # of fields are emitted with the keys:
+            # ((field1, field2, ...), value1, value2, ...)
+
+            def map(doc):
+                if doc['.type'] not in DOCUMENT_TYPES:
+                    return
+                for field, handler in HANDLERS.iteritems():
+                    for value in handler(doc):
+                        yield (field, value), None
+                for fields in COMPOUND_INDEXES:
+                    keys = [(fields, )]
+                    for field in fields:
+                        values = list(HANDLERS[field](doc))
+                        keys = [key + (value, )
+                                for key in keys for value in values]
+                    for key in keys:
+                        yield key, None
+            cls.map = cls._querymethod(map)
+            cls.attach_constant(
+                cls.map, 'COMPOUND_INDEXES', cls.COMPOUND_INDEXES)
+
         # we cannot use normal mechanism for attaching code to query methods,
         # because we want to build a complex object out of it, so we need to
         # inject it after all the annotations have been processed
@@ -215,6 +364,13 @@ class QueryView(view.BaseView):
     def _annotate_document_types(cls, types):
         cls.DOCUMENT_TYPES.extend(types)
 
+    @classmethod
+    def _annotate_compound_index(cls, fields):
+        if len(fields) < 2:
+            raise ValueError("Compound index needs at least two fields, "
+                             "%r given" % (fields, ))
+        cls.COMPOUND_INDEXES.append(tuple(fields))
+
 
 def field(name, extract=None):
     if callable(extract):
@@ -236,6 +392,18 @@ def document_types(types):
         'document_types', 3, '_annotate_document_types', types)
 
 
+def compound_index(*fields):
+    '''
+    Declares the combination of fields queried together. The queries with
+    the conditions on all these fields joined with the AND operator are
+    answered with a single range request instead of intersecting
+    the results of each field. All the conditions but the one on the
+    last field have to use the equals evaluator.
+    '''
+    annotate.injectClassCallback(
+        'compound_index', 3, '_annotate_compound_index', fields)
+
+
 class Evaluator(enum.Enum):
     '''
     equals: ==
@@ -351,7 +519,8 @@ class Query(serialization.Serializable):
         # we will need to query for the full range of the index
         if self.sorting:
             for sortby, _ in self.sorting:
-                included = first(x[0] for x in temp if x[0] == sortby)
+                included = first(x[0] for x in temp
+                                 if _uses_field(x[0], sortby))
                 if not included:
                     temp.append((sortby, Evaluator.none, None))
 
@@ -399,17 +568,135 @@ def count(connection, query):
     defer.returnValue(len(temp))
 
 
+def select_iter(connection, query, page_size=None, token=None, skip=0,
+                include_docs=True):
+    '''
+    Returns the L{Cursor} iterating over the result of the query.
+    @param token: continuation token of the cursor to resume.
+    '''
+    return Cursor(connection, query, page_size, token, skip, include_docs)
+
+
+class Cursor(object):
+    '''
+    I iterate over the result of the query page by page, so that only
+    one page of documents is kept in memory at the same time. Usage:
+
+      cursor = query.select_iter(connection, query, page_size)
+      while True:
+          page = yield cursor.next_page()
+          if not page:
+              break
+
+    The iteration can be resumed later by the other cursor created with
+    the continuation token taken from the L{token} attribute.
+    '''
+
+    DEFAULT_PAGE_SIZE = 100
+
+    def __init__(self, connection, query, page_size=None, token=None,
+                 skip=0, include_docs=True):
+        if page_size is None:
+            page_size = self.DEFAULT_PAGE_SIZE
+        if page_size < 0:
+            raise ValueError("Page size can't be negative, got %r"
+                             % (page_size, ))
+        self.connection = connection
+        self.query = query
+        self.page_size = page_size
+        self.include_docs = include_docs
+
+        # continuation token of the next page, None after the last one
+        self.token = token
+        self._skip = skip
+        self._ids = None
+        self._position = None
+
+    def next_page(self):
+        '''
+        Returns the Deferred fired with the list of documents (or doc_ids
+        if include_docs is False) of the next page. The list is empty
+        after the result has been exhausted.
+        '''
+        if self._ids is None:
+            d = select_ids(self.connection, self.query)
+            d.addCallback(self._got_ids)
+        else:
+            d = defer.succeed(None)
+        d.addCallback(defer.drop_param, self._get_page)
+        return d
+
+    ### private ###
+
+    def _got_ids(self, ids):
+        self._ids = ids
+        if self.token is None:
+            self._position = min(self._skip, len(ids))
+        else:
+            self._position = _resume_position(ids, self.token)
+
+    def _get_page(self):
+        start = self._position
+        page = self._ids[start:start + self.page_size]
+        self._position = start + len(page)
+        if self._position < len(self._ids):
+            last_id = self._ids[self._position - 1] if self._position else None
+            self.token = _encode_token(self._position, last_id)
+        else:
+            self.token = None
+        if page and self.include_docs:
+            return self.connection.bulk_get(page)
+        return page
+
+
 ### private ###
 
 
+def _encode_token(position, last_id):
+    return base64.urlsafe_b64encode(json.dumps([position, last_id]))
+
+
+def _decode_token(token):
+    try:
+        position, last_id = json.loads(base64.urlsafe_b64decode(str(token)))
+        return int(position), last_id
+    except (TypeError, ValueError):
+        raise ValueError("Invalid continuation token: %r" % (token, ))
+
+
+def _resume_position(ids, token):
+    position, last_id = _decode_token(token)
+    if 0 < position <= len(ids) and ids[position - 1] == last_id:
+        return position
+    # the result has changed since the token was issued, continue after
+    # the last document returned if it is still there
+    try:
+        return ids.index(last_id) + 1
+    except ValueError:
+        return max(0, min(position, len(ids)))
+
+
+# maximum number of subqueries of a single query being run at the same time
+MAX_CONCURRENT_SUBQUERIES = 8
+
+
 @defer.inlineCallbacks
 def _get_query_response(connection, query):
     cache = connection.get_query_cache()
+    query = _plan_query(query)
+    # get_basic_queries() returns each distinct subquery of the tree once
+    subqueries = query.get_basic_queries()
+    semaphore = defer.DeferredSemaphore(MAX_CONCURRENT_SUBQUERIES)
+    defers = [semaphore.run(cache.query, connection, query.factory, subquery)
+              for subquery in subqueries]
+    results = yield defer.DeferredList(defers, consumeErrors=True)
+
+    # subquery -> list of doc ids
     responses = dict()
-    for subquery in query.get_basic_queries():
-        # subquery -> list of doc ids
-        responses[subquery] = yield cache.query(
-            connection, query.factory, subquery)
+    for subquery, (success, result) in zip(subqueries, results):
+        if not success:
+            result.raiseException()
+        responses[subquery] = result
     defer.returnValue((_calculate_query_response(responses, query), responses))
 
 
@@ -417,37 +704,228 @@ def _calculate_query_response(responses, query):
     for_parts = []
 
     for part in query.parts:
-        if isinstance(part, Condition):
+        if isinstance(part, (Condition, CompoundCondition)):
             for_parts.append(set(responses[part.get_basic_queries()[0]]))
         elif isinstance(part, Query):
             for_parts.append(_calculate_query_response(responses, part))
+
+    # operators are applied from left to right, the chains of ANDs
+    # are intersected starting from the smallest set
+    result = for_parts[0]
     operators = list(query.operators)
-    while True:
-        if len(for_parts) == 1:
-            return for_parts[0]
-        oper = operators.pop(0)
+    index = 0
+    while index < len(operators):
+        oper = operators[index]
         if oper == Operator.AND:
-            for_parts[0] = for_parts[0].intersection(for_parts.pop(1))
+            chain = [result]
+            while index < len(operators) and operators[index] == Operator.AND:
+                index += 1
+                chain.append(for_parts[index])
+            chain.sort(key=len)
+            result = chain[0]
+            for part in chain[1:]:
+                if not result:
+                    break
+                result = result.intersection(part)
         elif oper == Operator.OR:
-            for_parts[0] = for_parts[0].union(for_parts.pop(1))
+            index += 1
+            result = result.union(for_parts[index])
         else:
-            raise ValueError("Unkown operator '%r' %" (oper, ))
+            raise ValueError("Unkown operator '%r'" % (oper, ))
+    return result
+
+
+class CompoundCondition(object):
+    '''
+    Conditions on the fields of the compound index, answered with
+    a single request. Created by the planner, it is never serialized.
+    '''
+
+    implements(IPlanBuilder)
+
+    def __init__(self, fields, conditions):
+        self.fields = fields
+        self.evaluator = conditions[-1].evaluator
+        self.value = tuple(x.value for x in conditions)
+
+    ### IPlanBuilder ###
+
+    def get_basic_queries(self):
+        return [(self.fields, self.evaluator, self.value)]
+
+    def __str__(self):
+        return "%s %s %s" % (self.fields, self.evaluator.name, self.value)
+
+
+def _plan_query(query):
+    '''
+    Returns the query with the conditions covered by the compound indexes
+    of the view replaced by the L{CompoundCondition}s.
+    '''
+    indexes = getattr(query.factory, 'COMPOUND_INDEXES', None)
+    if not indexes:
+        return query
+    # the longest indexes are the most selective
+    indexes = sorted(indexes, key=len, reverse=True)
+    return _apply_compound_indexes(query, indexes)
+
+
+def _apply_compound_indexes(query, indexes):
+    parts = [_apply_compound_indexes(x, indexes)
+             if isinstance(x, Query) else x
+             for x in query.parts]
+    changed = any(x is not y for x, y in zip(parts, query.parts))
+
+    # the operators are evaluated from left to right, so only the queries
+    # joined together with AND can be reordered
+    if all(x == Operator.AND for x in query.operators):
+        conditions = dict()
+        for part in parts:
+            if isinstance(part, Condition):
+                conditions.setdefault(part.field, list()).append(part)
+
+        for fields in indexes:
+            matched = [conditions.get(x, ()) for x in fields]
+            if any(len(x) != 1 for x in matched):
+                continue
+            matched = [x[0] for x in matched]
+            if any(x.evaluator != Evaluator.equals for x in matched[:-1]):
+                continue
+            for condition in matched:
+                parts.remove(condition)
+                del conditions[condition.field]
+            parts.append(CompoundCondition(fields, matched))
+            changed = True
+
+    if not changed:
+        return query
+    planned = copy.copy(query)
+    planned.parts = parts
+    if len(parts) == len(query.parts):
+        planned.operators = list(query.operators)
+    else:
+        planned.operators = [Operator.AND] * (len(parts) - 1)
+    return planned
+
+
+def _uses_field(queried, field):
+    '''
+    Tells if the response to the subquery on the queried field(s) is
+    ordered by the field, compound indexes are ordered by the last field.
+    '''
+    if isinstance(queried, tuple):
+        return field in queried
+    return queried == field
+
+
+def _may_match(evaluator, value, emitted):
+    '''
+    Tells if the value emitted by the view might be in the range of the
+    subquery. When in doubt it answers True.
+    '''
+    if evaluator == Evaluator.none:
+        return True
+    if evaluator == Evaluator.equals:
+        return _compare(emitted, value) in (0, None)
+    if evaluator == Evaluator.inside:
+        return any(_compare(emitted, x) in (0, None) for x in value)
+    if evaluator == Evaluator.le:
+        return _compare(emitted, value) != 1
+    if evaluator == Evaluator.ge:
+        return _compare(emitted, value) != -1
+    if evaluator == Evaluator.between:
+        return (_compare(emitted, value[0]) != -1 and
+                _compare(emitted, value[1]) != 1)
+    return True
+
+
+def _compare(a, b):
+    '''
+    Compares the keys the way both CouchDB and python do. Returns -1, 0, 1
+    or None if the order cannot be told (it differs or depends on the
+    unicode collation used by CouchDB).
+    '''
+    couch = _couch_compare(a, b)
+    if couch is None or couch != cmp(a, b):
+        return None
+    return couch
+
+
+def _couch_compare(a, b):
+    rank_a, rank_b = _couch_rank(a), _couch_rank(b)
+    if rank_a != rank_b:
+        return cmp(rank_a, rank_b)
+    if rank_a == 3:
+        return cmp(a, b)
+    if rank_a == 4:
+        if a == b:
+            return 0
+        try:
+            a, b = str(a), str(b)
+        except UnicodeError:
+            return None
+        if not (a.isalnum() and b.isalnum()):
+            return None
+        # case insensitive first, lowercase before uppercase, digits
+        # before letters
+        return cmp((a.lower(), a.swapcase()), (b.lower(), b.swapcase()))
+    if rank_a == 5:
+        for x, y in zip(a, b):
+            result = _couch_compare(x, y)
+            if result != 0:
+                return result
+        return cmp(len(a), len(b))
+    if rank_a == 6:
+        return 0 if a == b else None
+    return 0
+
+
+def _couch_rank(value):
+    if value is None:
+        return 0
+    if value is False:
+        return 1
+    if value is True:
+        return 2
+    if isinstance(value, (int, long, float)):
+        return 3
+    if isinstance(value, basestring):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    return 6
+
+
+def _get_positions(response):
+    if isinstance(response, Response):
+        return response.get_positions()
+    return Response(response).get_positions()
 
 
 def _generate_sort_key(responses, sorting):
+    # name -> list of doc_id -> position maps of the responses for the field
+    relevant = dict()
+    for name, _ in sorting:
+        if name in relevant:
+            continue
+        relevant[name] = list()
+        for k, v in responses.iteritems():
+            if not _uses_field(k[0], name):
+                continue
+            if isinstance(k[0], tuple) and k[0][-1] != name:
+                # the value of the field is fixed for all the rows
+                relevant[name].append(dict.fromkeys(v, 0))
+            else:
+                relevant[name].append(_get_positions(v))
 
     def sort_key(row):
         positions = list()
 
         for name, direction in sorting:
-            relevant = [v for k, v in responses.iteritems()
-                        if k[0] == name]
-            for r in relevant:
-                try:
-                    index = r.index(row)
+            for r in relevant[name]:
+                index = r.get(row)
+                if index is not None:
                     break
-                except ValueError:
-                    continue
             else:
                 index = sys.maxint
             if direction == Direction.DESC:
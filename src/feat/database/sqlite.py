@@ -0,0 +1,277 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+import cPickle
+import json
+import sqlite3
+
+from feat.common import text_helper
+from feat.database import emu
+
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS documents (
+      doc_id TEXT PRIMARY KEY,
+      body TEXT NOT NULL,
+      updated INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS documents_updated_idx
+      ON documents(updated)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS attachments (
+      doc_id TEXT NOT NULL,
+      name TEXT NOT NULL,
+      body BLOB,
+      PRIMARY KEY (doc_id, name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS changes (
+      seq INTEGER PRIMARY KEY,
+      body TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS views (
+      name TEXT PRIMARY KEY,
+      signature TEXT,
+      updated INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS view_rows (
+      name TEXT NOT NULL,
+      doc_id TEXT NOT NULL,
+      rows BLOB NOT NULL,
+      PRIMARY KEY (name, doc_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS counters (
+      doc_type TEXT PRIMARY KEY,
+      value INTEGER NOT NULL
+    )
+    """]
+
+
+class Database(emu.Database):
+    '''
+    Emulated database keeping the documents, attachments, the changes feed
+    and the rows of the view indexes in the SQLite file, so that they can
+    be reused by the next run. The documents and attachments don't have
+    to fit in memory, but the view indexes do: each view queried is loaded
+    into an in-memory L{emu.ViewIndex}, which serves the queries.
+
+    The queries are performed synchronously, like the emulated database
+    does. Each write operation is committed when it is done. Rows of the
+    view indexes are stored with the source code of the map function,
+    the index is rebuilt if the view has changed. Otherwise only the
+    documents updated since the index was stored are remapped.
+    '''
+
+    log_category = "sqlite-database"
+
+    def __init__(self, filename=":memory:"):
+        emu.Database.__init__(self)
+        self._filename = filename
+        self._db = sqlite3.connect(filename)
+        self._db.execute("PRAGMA synchronous = OFF")
+        if filename != ":memory:":
+            self._db.execute("PRAGMA journal_mode = WAL")
+        for command in SCHEMA:
+            self._db.execute(text_helper.format_block(command))
+        self._db.commit()
+
+        self._update_seq = self._fetch_value(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM changes")
+        # incremented every time a document is stored, used to tell
+        # which documents have been updated since the view was indexed
+        self._doc_counter = self._fetch_value(
+            "SELECT COALESCE(MAX(updated), 0) FROM documents")
+        self._doc_type_counters.update(
+            self._db.execute("SELECT doc_type, value FROM counters"))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    ### IDatabaseDriver ###
+
+    def save_doc(self, doc, doc_id=None):
+        d = emu.Database.save_doc(self, doc, doc_id)
+        self._db.commit()
+        return d
+
+    def delete_doc(self, doc_id, revision):
+        d = emu.Database.delete_doc(self, doc_id, revision)
+        self._db.commit()
+        return d
+
+    def save_attachment(self, doc_id, revision, attachment):
+        d = emu.Database.save_attachment(self, doc_id, revision, attachment)
+        self._db.commit()
+        return d
+
+    def query_view(self, factory, **options):
+        d = emu.Database.query_view(self, factory, **options)
+        self._db.commit()
+        return d
+
+    ### public used in tests ###
+
+    def load_fixture(self, body, attachment_bodies={}):
+        emu.Database.load_fixture(self, body, attachment_bodies)
+        self._db.commit()
+
+    ### storage ###
+
+    def _find_doc(self, doc_id):
+        body = self._fetch_value(
+            "SELECT body FROM documents WHERE doc_id = ?", doc_id)
+        return body and json.loads(body)
+
+    def _copy_doc(self, doc):
+        # every document is decoded from its own body
+        return doc
+
+    def _store_doc(self, doc):
+        self._doc_counter += 1
+        self._db.execute(
+            "INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+            (doc['_id'], json.dumps(doc), self._doc_counter))
+
+    def _iter_doc_ids(self):
+        cursor = self._db.execute("SELECT doc_id FROM documents")
+        return [doc_id for doc_id, in cursor.fetchall()]
+
+    def _create_view_index(self, factory):
+        index = emu.ViewIndex(factory)
+        signature = self._get_view_signature(factory)
+        cursor = self._db.execute(
+            "SELECT signature, updated FROM views WHERE name = ?",
+            (factory.name, ))
+        stored = cursor.fetchone()
+        if stored is not None and signature is not None and \
+           stored[0] == signature:
+            cursor = self._db.execute(
+                "SELECT doc_id, rows FROM view_rows WHERE name = ?",
+                (factory.name, ))
+            index.load((doc_id, cPickle.loads(str(rows)))
+                       for doc_id, rows in cursor)
+            cursor = self._db.execute(
+                "SELECT doc_id FROM documents WHERE updated > ?",
+                (stored[1], ))
+            index.expire(*(doc_id for doc_id, in cursor.fetchall()))
+            self.log("Loaded index of the view %s", factory.name)
+        else:
+            self._db.execute("DELETE FROM view_rows WHERE name = ?",
+                             (factory.name, ))
+            self._db.execute("INSERT OR REPLACE INTO views VALUES (?, ?, ?)",
+                             (factory.name, signature, 0))
+            index.expire(*self._iter_doc_ids())
+        return index
+
+    def _store_view_rows(self, index, remapped):
+        name = index.factory.name
+        self._db.executemany(
+            "INSERT OR REPLACE INTO view_rows VALUES (?, ?, ?)",
+            ((name, doc_id, self._pickle(rows))
+             for doc_id, rows in remapped if rows))
+        self._db.executemany(
+            "DELETE FROM view_rows WHERE name = ? AND doc_id = ?",
+            ((name, doc_id) for doc_id, rows in remapped if not rows))
+        self._db.execute("UPDATE views SET updated = ? WHERE name = ?",
+                         (self._doc_counter, name))
+
+    def _list_attachments(self, doc_id):
+        cursor = self._db.execute(
+            "SELECT name FROM attachments WHERE doc_id = ?", (doc_id, ))
+        return [name for name, in cursor.fetchall()]
+
+    def _get_attachment(self, doc_id, name):
+        body = self._fetch_value(
+            "SELECT body FROM attachments WHERE doc_id = ? AND name = ?",
+            doc_id, name)
+        if isinstance(body, buffer):
+            body = str(body)
+        return body
+
+    def _store_attachment(self, doc_id, name, body):
+        if isinstance(body, str):
+            body = sqlite3.Binary(body)
+        self._db.execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)",
+                         (doc_id, name, body))
+
+    def _delete_attachments(self, doc_id, names=None):
+        if names is None:
+            self._db.execute("DELETE FROM attachments WHERE doc_id = ?",
+                             (doc_id, ))
+            return
+        self._db.executemany(
+            "DELETE FROM attachments WHERE doc_id = ? AND name = ?",
+            ((doc_id, name) for name in names))
+
+    def _append_change(self, doc):
+        self._db.execute("INSERT INTO changes VALUES (?, ?)",
+                         (self._update_seq, json.dumps(doc)))
+        self._update_seq += 1
+
+    def _iter_changes(self, since):
+        cursor = self._db.execute(
+            "SELECT seq, body FROM changes WHERE seq >= ? ORDER BY seq",
+            (since, ))
+        for seq, body in cursor.fetchall():
+            yield seq, json.loads(body)
+
+    def _get_update_seq(self):
+        return self._update_seq
+
+    ### private ###
+
+    def _generate_id(self, doc):
+        doc_id = emu.Database._generate_id(self, doc)
+        doc_type = doc.get('.type', None)
+        if doc_type:
+            self._db.execute(
+                "INSERT OR REPLACE INTO counters VALUES (?, ?)",
+                (doc_type, self._doc_type_counters[doc_type]))
+        return doc_id
+
+    def _get_view_signature(self, factory):
+        get_code = getattr(factory, 'get_code', None)
+        if get_code is None:
+            # we cannot tell if the map function has changed
+            return None
+        return get_code('map')
+
+    def _fetch_value(self, query, *params):
+        row = self._db.execute(query, params).fetchone()
+        return row[0] if row is not None else None
+
+    def _pickle(self, rows):
+        return sqlite3.Binary(
+            cPickle.dumps(rows, cPickle.HIGHEST_PROTOCOL))
@@ -353,6 +353,18 @@ class Journaler(model.Model):
     model.attribute('state', value.Enum(journaler.State),
                     getter=getter.source_attr('state'),
                     label='Connection state')
+    model.attribute('overflow_policy', value.Enum(journaler.OverflowPolicy),
+                    getter=getter.source_attr('_overflow_policy'),
+                    label='Overflow policy')
+    model.attribute('max_cache_size', value.Integer(),
+                    getter=getter.source_attr('_max_cache_size'),
+                    label='Cache high-water mark')
+    model.attribute('dropped_entries', value.Integer(),
+                    getter=getter.source_attr('_dropped_entries'),
+                    label='Dropped entries')
+    model.attribute('spilled_entries', value.Integer(),
+                    getter=getter.source_attr('_spilled_entries'),
+                    label='Spilled entries')
     model.collection('possible_targets',
                      child_names=getter.source_list_names('possible_targets'),
                      child_view=getter.source_list_get('possible_targets'),
@@ -367,7 +379,7 @@ class Journaler(model.Model):
                 label='Journal writer')
 
     def get_pending(self):
-        return len(self.source._cache)
+        return self.source.get_pending()
 
 
 @featmodels.register_model
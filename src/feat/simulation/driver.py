@@ -26,7 +26,7 @@ import uuid
 
 from feat.common import log, manhole, defer, reflect, time
 from feat.agencies import journaler
-from feat.database import document, emu as database, tools
+from feat.database import document, emu as database, sqlite, tools
 from feat.agencies.messaging import emu, rabbitmq, tunneling
 from feat.test import factories
 from feat.agents.shard import shard_agent
@@ -204,7 +204,8 @@ class Driver(log.Logger, log.LogProxy, Commands):
     log_category = 'simulation-driver'
 
     def __init__(self, jourfile=None,
-                 tunneling_version=None, tunneling_bridge=None):
+                 tunneling_version=None, tunneling_bridge=None,
+                 dbfile=None):
         log_keeper = log.get_default() or log.FluLogKeeper()
         log.LogProxy.__init__(self, log_keeper)
         log.Logger.__init__(self, self)
@@ -213,7 +214,10 @@ class Driver(log.Logger, log.LogProxy, Commands):
         self._messaging = emu.RabbitMQ()
         self._tunneling_version = tunneling_version
         self._tunneling_bridge = tunneling_bridge or tunneling.Bridge()
-        self._database = database.Database()
+        if dbfile:
+            self._database = sqlite.Database(dbfile)
+        else:
+            self._database = database.Database()
         jouropts = dict()
         if jourfile:
             jouropts['filename'] = jourfile
@@ -280,10 +280,12 @@ class OverrideConfigMixin(object):
 
 class SimulationTest(common.TestCase, OverrideConfigMixin):
 
-    configurable_attributes = ['skip_replayability', 'jourfile', 'save_stats']
+    configurable_attributes = ['skip_replayability', 'jourfile', 'save_stats',
+                               'dbfile']
     skip_replayability = False
     skip_coverage = True
     jourfile = None
+    dbfile = None
     save_stats = False
 
     def __init__(self, *args, **kwargs):
@@ -299,7 +301,8 @@ class SimulationTest(common.TestCase, OverrideConfigMixin):
     def setUp(self):
         self.assert_not_skipped()
         yield common.TestCase.setUp(self)
-        self.driver = driver.Driver(jourfile=self.jourfile)
+        self.driver = driver.Driver(jourfile=self.jourfile,
+                                    dbfile=self.dbfile)
         yield self.driver.initiate()
         yield self.prolog()
 
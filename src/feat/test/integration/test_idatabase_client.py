@@ -31,7 +31,7 @@ except ImportError as e:
     database = None
     import_error = e
 
-from feat.database import emu, view, document, query
+from feat.database import emu, sqlite, view, document, query
 from feat.process import couchdb
 from feat.process.base import DependencyError
 from feat.common import serialization, defer
@@ -370,6 +370,54 @@ class TestCase(object):
         self.assertEqual(doc.rev, fetched_doc.rev)
         self.assertEqual(doc.doc_id, fetched_doc.doc_id)
 
+    @defer.inlineCallbacks
+    def testBatchingWrites(self):
+        requests = list()
+        save_docs = self.database.save_docs
+
+        def counting_save_docs(docs):
+            requests.append(len(docs))
+            return save_docs(docs)
+
+        self.patch(self.database, 'save_docs', counting_save_docs)
+
+        stale = DummyDocument(field=u'stale')
+        yield self.connection.save_document(stale)
+        updated = yield self.connection.get_document(stale.doc_id)
+        updated.field = u'updated'
+        yield self.connection.save_document(updated)
+        self.assertEqual([], requests)
+
+        connection = self.database.get_connection()
+        connection.write_batch_window = 0.01
+        docs = [DummyDocument(field=unicode(x)) for x in range(5)]
+        docs.append(stale)
+        results = yield defer.DeferredList(
+            [connection.save_document(x) for x in docs], consumeErrors=True)
+        self.assertEqual([6], requests)
+
+        for doc, (success, result) in zip(docs[:-1], results):
+            self.assertTrue(success)
+            self.assertIs(doc, result)
+            fetched = yield self.connection.get_document(doc.doc_id)
+            self.assertEqual(doc.rev, fetched.rev)
+            self.assertEqual(doc.field, fetched.field)
+        success, result = results[-1]
+        self.assertFalse(success)
+        self.assertTrue(result.check(ConflictError))
+
+        # saving the same document again starts the new request
+        docs[0].field = u'again'
+        docs[1].field = u'again'
+        d1 = connection.save_document(docs[0])
+        d2 = connection.save_document(docs[1])
+        d3 = connection.save_document(docs[0])
+        yield defer.DeferredList([d1, d2], consumeErrors=True)
+        self.assertEqual([6, 2], requests)
+        self.assertFailure(d3, ConflictError)
+        yield d3
+        yield connection.disconnect()
+
     @defer.inlineCallbacks
     def testCreatingAndUpdatingTheDocument(self):
         doc = DummyDocument(field=u'something')
@@ -399,6 +447,39 @@ class TestCase(object):
         fetched_doc = yield self.connection.reload_document(fetched_doc)
         self.assertEqual(u'something else', fetched_doc.field)
 
+    @defer.inlineCallbacks
+    def testCachingDocuments(self):
+        connection = self.database.get_connection(document_cache_size=2)
+        doc = yield self.connection.save_document(
+            DummyDocument(field=u'something'))
+        rev = yield connection.get_revision(doc.doc_id)
+        self.assertEqual(doc.rev, rev)
+
+        fetched_doc = yield connection.get_document(doc.doc_id)
+        self.assertEqual(u'something', fetched_doc.field)
+        # served from the cache after revalidating the revision
+        cached_doc = yield connection.get_document(doc.doc_id)
+        self.assertEqual(fetched_doc, cached_doc)
+        self.assertIsNot(fetched_doc, cached_doc)
+
+        # modified by the other connection
+        doc.field = u'something else'
+        doc = yield self.connection.save_document(doc)
+        fetched_doc = yield connection.reload_document(fetched_doc)
+        self.assertEqual(u'something else', fetched_doc.field)
+        self.assertEqual(doc.rev, fetched_doc.rev)
+
+        for x in range(3):
+            other = yield self.connection.save_document(DummyDocument())
+            yield connection.get_document(other.doc_id)
+        self.assertEqual(2, len(connection._document_cache))
+        self.assertNotIn(doc.doc_id, connection._document_cache)
+
+        yield self.connection.delete_document(doc)
+        d = connection.get_revision(doc.doc_id)
+        self.assertFailure(d, NotFoundError)
+        yield d
+
     @defer.inlineCallbacks
     def testDeletingDocumentThanSavingAgain(self):
         doc = DummyDocument(field='something')
@@ -614,6 +695,28 @@ class TestCase(object):
         self.assertEquals(docs[1:], gets[1:])
         self.assertIsInstance(gets[0], NotFoundError)
 
+    @defer.inlineCallbacks
+    def testIterBulkGet(self):
+        docs = []
+        for x in range(3):
+            doc = yield self.connection.save_document(DummyDocument())
+            docs.append(doc)
+        yield self.connection.delete_document(docs[0])
+
+        doc_ids = ['notexistant'] + [x.doc_id for x in docs]
+        gets = yield self.connection.iter_bulk_get(doc_ids)
+        self.assertFalse(isinstance(gets, list))
+        self.assertEqual(docs[1], gets.next())
+        self.assertEqual(docs[2:], list(gets))
+
+        gets = yield self.connection.iter_bulk_get(doc_ids,
+                                                   consume_errors=False)
+        gets = list(gets)
+        self.assertEqual(4, len(gets))
+        self.assertIsInstance(gets[0], NotFoundError)
+        self.assertIsInstance(gets[1], NotFoundError)
+        self.assertEqual(docs[1:], gets[2:])
+
     @defer.inlineCallbacks
     def testUsingQueryView(self):
         views = (QueryView, )
@@ -654,6 +757,127 @@ class TestCase(object):
                                sorting=[('field1', D.DESC)])
         yield self._query_test([5, 7, 9], c1, O.AND, c4, O.AND, q)
 
+    @defer.inlineCallbacks
+    def testQueryCacheInvalidation(self):
+        views = (QueryView, )
+        design_doc = view.DesignDocument.generate_from_views(views)[0]
+        yield self.connection.save_document(design_doc)
+
+        docs = list()
+        for x in range(10):
+            doc = yield self.connection.save_document(
+                QueryDoc(field1=x, field2=x % 5, field3=u"A"))
+            docs.append(doc)
+
+        C = query.Condition
+        E = query.Evaluator
+
+        c1 = C('field1', E.le, 4)
+        c2 = C('field3', E.equals, u'A')
+        res = yield self._select_field1(c1)
+        self.assertEqual([0, 1, 2, 3, 4], res)
+        res = yield self._select_field1(c2)
+        self.assertEqual(range(10), res)
+        self.assertCacheStats(hits=0, misses=2, invalidations=0)
+
+        # the new document is outside of the range of both subqueries
+        yield self.connection.save_document(
+            QueryDoc(field1=100, field2=0, field3=u"B"))
+        res = yield self._select_field1(c1)
+        self.assertEqual([0, 1, 2, 3, 4], res)
+        res = yield self._select_field1(c2)
+        self.assertEqual(range(10), res)
+        self.assertCacheStats(hits=2, misses=2, invalidations=0)
+
+        # the document which was part of the responses expires them
+        docs[3].field1 = 30
+        yield self.connection.save_document(docs[3])
+        res = yield self._select_field1(c1)
+        self.assertEqual([0, 1, 2, 4], res)
+        res = yield self._select_field1(c2)
+        self.assertEqual([0, 1, 2, 4, 5, 6, 7, 8, 9, 30], res)
+        self.assertCacheStats(hits=2, misses=4, invalidations=2)
+
+        # the document entering the range expires the subquery
+        yield self.connection.save_document(
+            QueryDoc(field1=-1, field2=0, field3=u"B"))
+        res = yield self._select_field1(c1)
+        self.assertEqual([-1, 0, 1, 2, 4], res)
+        res = yield self._select_field1(c2)
+        self.assertEqual([0, 1, 2, 4, 5, 6, 7, 8, 9, 30], res)
+        self.assertCacheStats(hits=3, misses=5, invalidations=3)
+
+    @defer.inlineCallbacks
+    def testUsingCompoundIndex(self):
+        views = (CompoundQueryView, )
+        design_doc = view.DesignDocument.generate_from_views(views)[0]
+        yield self.connection.save_document(design_doc)
+
+        for x in range(20):
+            if x % 2 == 0:
+                field3 = u"A"
+            else:
+                field3 = u"B"
+            yield self.connection.save_document(
+                QueryDoc(field1=x, field2=x % 10, field3=field3))
+
+        C = query.Condition
+        E = query.Evaluator
+        O = query.Operator
+        Q = query.Query
+        D = query.Direction
+
+        c1 = C('field3', E.equals, u'B')
+        c2 = C('field1', E.between, (5, 14))
+        c3 = C('field2', E.equals, 3)
+        c4 = C('field1', E.ge, 10)
+
+        # the conditions on field3 and field1 are a single request
+        res = yield self._select_compound(c1, O.AND, c2)
+        self.assertEqual([5, 7, 9, 11, 13], res)
+        self.assertCacheStats(misses=1)
+        res = yield self._select_compound(
+            c2, O.AND, c1, sorting=[('field1', D.DESC)])
+        self.assertEqual([13, 11, 9, 7, 5], res)
+        self.assertCacheStats(hits=1, misses=1)
+
+        res = yield self._select_compound(c3, O.AND, c4)
+        self.assertEqual([13], res)
+        res = yield self._select_compound(
+            Q(CompoundQueryView, c1, O.AND, c2), O.OR, c3, O.AND, c4)
+        self.assertEqual([11, 13], res)
+        res = yield self._select_compound(
+            c3, O.AND, c4, O.OR, Q(CompoundQueryView, c1, O.AND, c2),
+            sorting=[('field1', D.ASC)])
+        self.assertEqual([5, 7, 9, 11, 13], res)
+        count = yield query.count(
+            self.connection, Q(CompoundQueryView, c1, O.AND, c2))
+        self.assertEqual(5, count)
+
+        # the new document expires the cached compound response
+        yield self.connection.save_document(
+            QueryDoc(field1=6, field2=6, field3=u"B"))
+        res = yield self._select_compound(c1, O.AND, c2)
+        self.assertEqual([5, 6, 7, 9, 11, 13], res)
+
+    def assertCacheStats(self, **expected):
+        stats = self.connection.get_query_cache_stats()
+        self.assertEqual(expected,
+                         dict((k, stats[k]) for k in expected))
+
+    @defer.inlineCallbacks
+    def _select_field1(self, *parts):
+        q = query.Query(QueryView, *parts, sorting=[])
+        res = yield query.select(self.connection, q)
+        defer.returnValue(sorted(x.field1 for x in res))
+
+    @defer.inlineCallbacks
+    def _select_compound(self, *parts, **kwargs):
+        q = query.Query(CompoundQueryView, *parts,
+                        sorting=kwargs.pop('sorting', None))
+        res = yield query.select(self.connection, q)
+        defer.returnValue([x.field1 for x in res])
+
     @defer.inlineCallbacks
     def _query_test(self, result, *parts, **kwargs):
         q = query.Query(QueryView, *parts, sorting=kwargs.pop('sorting', None))
@@ -704,6 +928,27 @@ class QueryView(query.QueryView):
     query.document_types(['query'])
 
 
+class CompoundQueryView(query.QueryView):
+
+    name = 'compound_query_view'
+
+    def extract_field1(doc):
+        yield doc.get('field1')
+
+    def extract_field2(doc):
+        yield doc.get('field2')
+
+    def extract_field3(doc):
+        yield doc.get('field3')
+
+    query.field('field1', extract_field1)
+    query.field('field2', extract_field2)
+    query.field('field3', extract_field3)
+    query.document_types(['query'])
+    query.compound_index('field3', 'field1')
+    query.compound_index('field2', 'field1')
+
+
 class CallbacksReceiver(Mock):
 
     @Mock.stub
@@ -771,6 +1016,19 @@ class EmuDatabaseIntegrationTest(common.IntegrationTest, TestCase):
         self.connection = self.database.get_connection()
 
 
+class SQLiteDatabaseIntegrationTest(common.IntegrationTest, TestCase):
+    skip_coverage = False
+
+    def setUp(self):
+        common.IntegrationTest.setUp(self)
+        self.database = sqlite.Database()
+        self.connection = self.database.get_connection()
+
+    def tearDown(self):
+        self.database.close()
+        return common.IntegrationTest.tearDown(self)
+
+
 @attr('slow')
 class PaisleyIntegrationTest(common.IntegrationTest, TestCase,
                              PaisleySpecific):
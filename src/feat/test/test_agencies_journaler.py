@@ -19,7 +19,9 @@
 # See "LICENSE.GPL" in the source distribution for more information.
 
 # Headers in this file shall remain intact.
+import inspect
 import signal
+import shutil
 import tempfile
 import os
 import uuid
@@ -33,6 +35,7 @@ from feat.agencies import journaler
 from feat.agencies.net import broker
 from feat.common.serialization import banana
 from feat.gateway import models
+from feat.interface.log import LogLevel
 
 
 class GenerateEntryMixin(object):
@@ -302,6 +305,27 @@ class DBTests(common.TestCase, ModelTestMixin, GenerateEntryMixin):
         self.assertTrue(len(logs) >= 200)
         yield writer.close()
 
+    @defer.inlineCallbacks
+    def testInsertingInBatches(self):
+        writer = journaler.SqliteWriter(self, max_batch_size=7)
+        data = [self._generate_entry(function_id='fun%d' % (x, ))
+                for x in range(30)]
+        data += [self._generate_log(message='m%d' % (x, ))
+                 for x in range(15)]
+        yield writer.initiate()
+        yield writer.insert_entries(data)
+        self.assertTrue(writer.is_idle())
+
+        histories = yield writer.get_histories()
+        self.assertEqual(1, len(histories))
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual(['fun%d' % (x, ) for x in range(30)],
+                         [x['function_id'] for x in entries])
+        logs = yield writer.get_log_entries()
+        self.assertEqual(['m%d' % (x, ) for x in range(15)],
+                         [x['message'] for x in logs])
+        yield writer.close()
+
     def _get_tmp_file(self):
         fd, name = tempfile.mkstemp(suffix='_journal.sqlite')
         self.addCleanup(os.remove, name)
@@ -330,6 +354,306 @@ class DBTests(common.TestCase, ModelTestMixin, GenerateEntryMixin):
             defer.returnValue(0)
 
 
+class TestJournalerOverflow(common.TestCase, GenerateEntryMixin):
+
+    @defer.inlineCallbacks
+    def testDroppingLogs(self):
+        jour = journaler.Journaler(
+            max_cache_size=10,
+            overflow_policy=journaler.OverflowPolicy.drop_logs)
+        for x in range(5):
+            jour.insert_entry(**self._generate_entry())
+        for x in range(8):
+            jour.insert_entry(**self._generate_log(message='m%d' % (x, )))
+        self.assertEqual(10, jour.get_pending())
+        self.assertEqual(3, jour.get_overflow_stats()['dropped_entries'])
+
+        # journal entries are never dropped, they push out cached logs
+        for x in range(3):
+            jour.insert_entry(**self._generate_entry())
+        self.assertEqual(9, jour.get_pending())
+        self.assertEqual(7, jour.get_overflow_stats()['dropped_entries'])
+
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        yield jour.insert_entry(**self._generate_log(message='last'))
+
+        entries = yield writer.get_bare_journal_entries()
+        self.assertEqual(8, len(entries))
+        logs = yield writer.get_log_entries()
+        self.assertEqual(['m4', 'last'], [x['message'] for x in logs])
+        yield jour.close()
+
+    @defer.inlineCallbacks
+    def testSpillingEntries(self):
+        jour = journaler.Journaler(
+            max_cache_size=10,
+            overflow_policy=journaler.OverflowPolicy.spill)
+        for x in range(25):
+            jour.insert_entry(**self._generate_log(message='m%d' % (x, )))
+        self.assertEqual(10, len(jour._cache))
+        self.assertEqual(25, jour.get_pending())
+        stats = jour.get_overflow_stats()
+        self.assertEqual(15, stats['spilled'])
+        self.assertEqual(15, stats['spilled_entries'])
+        self.assertEqual(0, stats['dropped_entries'])
+
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        yield self.wait_for(jour.is_idle, 5, freq=0.05)
+
+        logs = yield writer.get_log_entries()
+        self.assertEqual(['m%d' % (x, ) for x in range(25)],
+                         [x['message'] for x in logs])
+        self.assertEqual(0, jour.get_overflow_stats()['spilled'])
+        yield jour.close()
+
+
+class TestSpool(common.TestCase, GenerateEntryMixin):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def testAppendingAndDiscarding(self):
+        spool = journaler.Spool(self.directory, segment_size=1024)
+        for x in range(50):
+            spool.append(self._generate_log(message='m%d' % (x, )))
+        self.assertEqual(50, len(spool))
+        segments = os.listdir(self.directory)
+        self.assertTrue(len(segments) > 1)
+
+        entries = spool.peek(20)
+        self.assertEqual(['m%d' % (x, ) for x in range(20)],
+                         [x['message'] for x in entries])
+        # peek() doesn't remove anything
+        self.assertEqual(entries, spool.peek(20))
+
+        spool.discard(20)
+        self.assertEqual(30, len(spool))
+        self.assertEqual('m20', spool.peek(1)[0]['message'])
+        self.assertTrue(len(os.listdir(self.directory)) < len(segments))
+
+        spool.discard(30)
+        self.assertEqual(0, len(spool))
+        self.assertEqual([], spool.peek(10))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def testEntryBiggerThanSegment(self):
+        spool = journaler.Spool(self.directory, segment_size=64)
+        spool.append(self._generate_log(message='x' * 1000))
+        spool.append(self._generate_log(message='y'))
+        self.assertEqual(['x' * 1000, 'y'],
+                         [x['message'] for x in spool.peek(5)])
+
+    def testLoadingExistingSegments(self):
+        spool = journaler.Spool(self.directory, segment_size=1024)
+        for x in range(30):
+            spool.append(self._generate_log(message='m%d' % (x, )))
+        spool.discard(5)
+        spool.close()
+        self.assertTrue(os.listdir(self.directory))
+
+        spool = journaler.Spool(self.directory, segment_size=1024)
+        self.assertEqual(25, len(spool))
+        self.assertEqual('m5', spool.peek(1)[0]['message'])
+        spool.append(self._generate_log(message='new'))
+        self.assertEqual('new', spool.peek(26)[-1]['message'])
+
+    def testSkippingTruncatedSegments(self):
+        spool = journaler.Spool(self.directory, segment_size=1024)
+        spool.append(self._generate_log(message='m0'))
+        spool.close()
+        # segments created just before a crash, empty or without
+        # the complete header
+        open(os.path.join(self.directory, 'journal-00000005.spool'),
+             'w').close()
+        with open(os.path.join(self.directory, 'journal-00000006.spool'),
+                  'w') as f:
+            f.write('\x00' * 5)
+
+        spool = journaler.Spool(self.directory, segment_size=1024)
+        self.assertEqual(1, len(spool))
+        self.assertEqual(['journal-00000000.spool'],
+                         os.listdir(self.directory))
+        spool.append(self._generate_log(message='m1'))
+        spool.discard(1)
+        self.assertEqual(['m1'], [x['message'] for x in spool.peek(5)])
+
+    def testBinaryFormat(self):
+        spool = journaler.Spool(self.directory, segment_size=1024)
+        spool.append(self._generate_log(message='banana'))
+        spool.close()
+        spool = journaler.Spool(self.directory, segment_size=1024,
+                                use_binary=True)
+        spool.append(self._generate_log(message='binary'))
+        self.assertEqual(['banana', 'binary'],
+                         [x['message'] for x in spool.peek(5)])
+
+    def testTemporaryDirectory(self):
+        spool = journaler.Spool()
+        self.assertTrue(spool.temporary)
+        spool.append(self._generate_entry())
+        directory = spool.directory
+        self.assertTrue(os.path.isdir(directory))
+        spool.close()
+        self.assertFalse(os.path.exists(directory))
+
+
+class TestJournalerSpooling(common.TestCase, GenerateEntryMixin):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    @defer.inlineCallbacks
+    def testSpoolingWhileDisconnected(self):
+        jour = journaler.Journaler(spool_dir=self.directory)
+        for x in range(20):
+            jour.insert_entry(**self._generate_log(message='m%d' % (x, )))
+        self.assertEqual(0, len(jour._cache))
+        self.assertEqual(20, jour.get_pending())
+
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        yield self.wait_for(jour.is_idle, 5, freq=0.05)
+
+        logs = yield writer.get_log_entries()
+        self.assertEqual(['m%d' % (x, ) for x in range(20)],
+                         [x['message'] for x in logs])
+        # once connected entries are kept in memory again
+        jour.insert_entry(**self._generate_log())
+        self.assertEqual(1, len(jour._cache))
+        yield jour.close()
+
+    @defer.inlineCallbacks
+    def testReplayingEntriesOfPreviousRun(self):
+        jour = journaler.Journaler(spool_dir=self.directory)
+        for x in range(10):
+            jour.insert_entry(**self._generate_entry())
+        del jour
+
+        jour = journaler.Journaler(spool_dir=self.directory)
+        self.assertEqual(10, jour.get_pending())
+
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        yield self.wait_for(jour.is_idle, 5, freq=0.05)
+        entries = yield writer.get_bare_journal_entries()
+        self.assertEqual(10, len(entries))
+        yield jour.close()
+
+
+class TestLogRecord(common.TestCase):
+
+    def testLazyFormatting(self):
+        record = journaler.LogRecord(
+            LogLevel.info, 'name', 'feat', 'some %s %d', ('message', 3),
+            file_path='file.py', line_num=10, timestamp=5)
+        self.assertEqual(None, record._message)
+        self.assertEqual('log', record['entry_type'])
+        self.assertEqual('some message 3', record['message'])
+        self.assertEqual(dict(entry_type='log', level=LogLevel.info,
+                              log_name='name', category='feat',
+                              file_path='file.py', line_num=10,
+                              message='some message 3', timestamp=5),
+                         record.as_dict())
+        self.assertRaises(KeyError, record.__getitem__, 'agent_id')
+
+    def testFormattingFailure(self):
+        record = journaler.LogRecord(LogLevel.info, None, 'feat',
+                                     'some %s %s', ('message', ))
+        self.assertIn('some %s %s', record['message'])
+
+    def testResolvingFileAndLine(self):
+        jour = journaler.Journaler()
+        jour.do_log(LogLevel.error, 'name', 'feat', 'msg', (), depth=0)
+        line = inspect.currentframe().f_lineno - 1
+        record = jour._cache.fetch()[0]
+        self.assertIsInstance(record, journaler.LogRecord)
+        self.assertEqual(line, record['line_num'])
+        self.assertTrue(record['file_path'].endswith(
+            'test_agencies_journaler.py'))
+
+    @defer.inlineCallbacks
+    def testStoringRecords(self):
+        jour = journaler.Journaler()
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        jour.do_log(LogLevel.error, 'name', 'feat', 'some %s', ('msg', ))
+        yield self.wait_for(jour.is_idle, 5, freq=0.05)
+        logs = yield writer.get_log_entries()
+        self.assertTrue(first(x for x in logs if x['message'] == 'some msg'))
+        yield jour.close()
+
+
+@common.attr('slow')
+class TestLoggingOverhead(common.TestCase):
+
+    calls = 20000
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        debug = log.FluLogKeeper.get_debug()
+        self.addCleanup(log.FluLogKeeper.set_debug, debug)
+        log.FluLogKeeper.set_debug('journaler_benchmark:%d'
+                                   % (int(LogLevel.info), ))
+
+    def testCallTimePerLevel(self):
+        jour = journaler.Journaler(max_cache_size=self.calls * 10)
+        do_log = jour.do_log
+        args = ('message', 42)
+        for level in LogLevel:
+            start = time.time()
+            for x in xrange(self.calls):
+                do_log(level, 'name', 'journaler_benchmark', 'some %s %d',
+                       args, depth=0)
+            elapsed = time.time() - start
+            self.info("%s: %.0f ns/call", level.name,
+                      elapsed * 1e9 / self.calls)
+        # levels below the threshold are not stored at all
+        self.assertEqual(3 * self.calls, len(jour._cache))
+
+
+@common.attr('slow')
+class TestSqliteInsertThroughput(common.TestCase, GenerateEntryMixin):
+
+    timeout = 120
+
+    @defer.inlineCallbacks
+    def testBatchSizes(self):
+        # batch size of 1 reproduces the old per-row insert path,
+        # the rest of them are inserted with executemany()
+        rows = 3000
+        results = list()
+        for batch_size in (1, 100, journaler.SqliteWriter.max_batch_size):
+            fd, filename = tempfile.mkstemp(suffix='_journal.sqlite')
+            os.close(fd)
+            self.addCleanup(os.remove, filename)
+            writer = journaler.SqliteWriter(self, filename=filename,
+                                            max_batch_size=batch_size)
+            yield writer.initiate()
+            data = [self._generate_entry() for x in range(rows / 2)]
+            data += [self._generate_log() for x in range(rows / 2)]
+
+            start = time.time()
+            yield writer.insert_entries(data)
+            elapsed = time.time() - start
+            yield writer.close()
+
+            results.append((batch_size, rows / elapsed))
+
+        for batch_size, rate in results:
+            self.info("max_batch_size=%d: %.0f rows/sec", batch_size, rate)
+
+
 class TestSqliteAsIJournalReader(common.TestCase, GenerateEntryMixin):
 
     @defer.inlineCallbacks
@@ -0,0 +1,93 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+import uuid
+
+from feat.agencies.messaging import envelope
+from feat.agencies import message, recipient
+from feat.common.serialization import banana, binary
+
+from . import common
+
+
+class CountingSerializer(binary.Serializer):
+
+    def __init__(self):
+        binary.Serializer.__init__(self)
+        self.converted = []
+
+    def convert(self, data):
+        self.converted.append(data)
+        return binary.Serializer.convert(self, data)
+
+
+def announcement():
+    msg = message.Announcement(payload=dict(value=range(10)))
+    msg.message_id = str(uuid.uuid1())
+    msg.traversal_id = str(uuid.uuid1())
+    return msg
+
+
+class TestCodec(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.serializer = CountingSerializer()
+        self.codec = envelope.Codec(self.serializer, binary.Unserializer(),
+                                    cache_size=2, use_envelopes=True)
+
+    def testFanOut(self):
+        msg = announcement()
+        recipients = [recipient.Agent('agent%d' % x, 'shard')
+                      for x in range(3)]
+        data = [self.codec.encode(msg.readdress(r)) for r in recipients]
+        # the first copy as a whole, the body and the two envelopes
+        self.assertEqual(4, len(self.serializer.converted))
+        self.assertEqual(recipients[0], self.serializer.converted[0].recipient)
+        self.assertEqual(None, self.serializer.converted[1].recipient)
+        # the first copy is understood by the agencies without the envelopes
+        self.assertEqual(msg.readdress(recipients[0]),
+                         binary.Unserializer().convert(data[0]))
+
+        for recp, encoded in zip(recipients, data):
+            decoded = self.codec.decode(encoded)
+            self.assertEqual(msg.readdress(recp), decoded)
+            self.assertEqual(msg.message_id, decoded.message_id)
+        # the message itself is not modified
+        self.assertEqual(None, msg.recipient)
+
+    def testCachingLastBodies(self):
+        messages = [announcement() for x in range(3)]
+        for msg in messages:
+            self.codec.encode(msg)
+        del self.serializer.converted[:]
+        self.codec.encode(messages[2])
+        self.assertEqual(2, len(self.serializer.converted))
+        self.codec.encode(messages[2])
+        self.assertEqual(3, len(self.serializer.converted))
+        self.codec.encode(messages[1])
+        self.assertEqual(5, len(self.serializer.converted))
+        # the first message has been forgotten, so it is sent as a whole
+        self.codec.encode(messages[0])
+        self.assertEqual(6, len(self.serializer.converted))
+        self.assertIs(messages[0], self.serializer.converted[5])
+
+    def testEnvelopesDisabled(self):
+        codec = envelope.Codec(self.serializer, binary.Unserializer())
+        msg = announcement()
+        recipients = [recipient.Agent('agent%d' % x, 'shard')
+                      for x in range(3)]
+        for recp in recipients:
+            data = codec.encode(msg.readdress(recp))
+            self.assertEqual(msg.readdress(recp),
+                             binary.Unserializer().convert(data))
+        self.assertEqual(3, len(self.serializer.converted))
+
+    def testDecodingWholeMessages(self):
+        msg = announcement().readdress(recipient.Agent('agent', 'shard'))
+        data = binary.Serializer().convert(msg)
+        self.assertEqual(msg, self.codec.decode(data))
+        codec = envelope.Codec(banana.Serializer(), banana.Unserializer(),
+                               use_envelopes=True)
+        self.assertEqual(msg, codec.decode(banana.Serializer().convert(msg)))
+        self.assertEqual(msg, codec.decode(codec.encode(msg)))
+        self.assertEqual(msg, codec.decode(codec.encode(msg)))
@@ -0,0 +1,319 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+import os
+import time
+import uuid
+
+from twisted.internet import protocol, reactor
+
+from feat.agencies.messaging import emu, net
+from feat.agencies import message, recipient
+from feat.common import defer
+from feat.extern.txamqp import spec
+from feat.extern.txamqp.connection import Frame, Method, Header, Body
+from feat.extern.txamqp.protocol import FrameReceiver
+
+from . import common
+
+
+class FakeAMQPProtocol(FrameReceiver):
+    '''
+    Server side of the AMQP 0-8 connection. It understands just enough
+    of the protocol for the net.Channel to define queues, bind them,
+    consume and publish transactionally.
+    '''
+
+    def __init__(self, broker):
+        FrameReceiver.__init__(self, broker.spec)
+        self.broker = broker
+        self.lost = defer.Deferred()
+        self._init_string = ''
+        # channel -> [Method, Header, [body parts]]
+        self._contents = dict()
+        # channel -> [(exchange, routing key, body)]
+        self._transactions = dict()
+        self._delivery_tag = 0
+
+    def connectionLost(self, reason):
+        self.broker.connections.remove(self)
+        self.lost.callback(None)
+
+    def rawDataReceived(self, data):
+        self._init_string += data
+        if len(self._init_string) >= 8:
+            extra = self._init_string[8:]
+            self.send(0, 'connection.start', version_major=0,
+                      version_minor=8, mechanisms='AMQPLAIN',
+                      locales='en_US')
+            self.setFrameMode(extra)
+
+    def frameReceived(self, frame):
+        payload = frame.payload
+        if payload.type == Frame.HEARTBEAT:
+            return
+        if payload.type == Frame.METHOD:
+            if payload.method.content:
+                self._contents[frame.channel] = [payload, None, []]
+            else:
+                self.methodReceived(frame.channel, payload)
+            return
+
+        content = self._contents[frame.channel]
+        if payload.type == Frame.HEADER:
+            content[1] = payload
+        else:
+            content[2].append(payload.content)
+        body = ''.join(content[2])
+        if len(body) >= content[1].size:
+            del self._contents[frame.channel]
+            args = self._get_args(content[0])
+            self._transactions.setdefault(frame.channel, []).append(
+                (args['exchange'], args['routing_key'], body))
+
+    def methodReceived(self, channel, payload):
+        name = "%s_%s" % (payload.method.klass.name, payload.method.name)
+        handler = getattr(self, "do_" + spec.pythonize(name), None)
+        if handler is not None:
+            handler(channel, **self._get_args(payload))
+
+    def send(self, channel, name, **kwargs):
+        method = self.spec.parse_method(name)
+        defaults = spec.Method.DEFAULTS
+        args = [kwargs.get(spec.pythonize(f.name), defaults[f.type])
+                for f in method.fields]
+        self.sendFrame(Frame(channel, Method(method, *args)))
+
+    def deliver(self, channel, consumer_tag, exchange, routing_key, body):
+        self._delivery_tag += 1
+        self.send(channel, 'basic.deliver', consumer_tag=consumer_tag,
+                  delivery_tag=self._delivery_tag, exchange=exchange,
+                  routing_key=routing_key)
+        klass = self.spec.classes.byname['basic']
+        self.sendFrame(Frame(channel, Header(klass, 0, len(body))))
+        self.sendFrame(Frame(channel, Body(body)))
+
+    ### handlers of the methods ###
+
+    def do_connection_start_ok(self, channel, **_):
+        self.send(channel, 'connection.tune', frame_max=131072)
+
+    def do_connection_open(self, channel, **_):
+        self.send(channel, 'connection.open-ok')
+
+    def do_connection_close(self, channel, **_):
+        self.send(channel, 'connection.close-ok')
+        self.transport.loseConnection()
+
+    def do_channel_open(self, channel, **_):
+        self.send(channel, 'channel.open-ok')
+
+    def do_channel_close(self, channel, **_):
+        self._transactions.pop(channel, None)
+        self.send(channel, 'channel.close-ok')
+
+    def do_tx_select(self, channel, **_):
+        self.send(channel, 'tx.select-ok')
+
+    def do_tx_commit(self, channel, **_):
+        messages = self._transactions.pop(channel, [])
+        self.broker.commit(messages)
+        self.send(channel, 'tx.commit-ok')
+
+    def do_exchange_declare(self, channel, exchange, type, **_):
+        self.broker.exchanges.setdefault(exchange, type)
+        self.send(channel, 'exchange.declare-ok')
+
+    def do_queue_declare(self, channel, queue, **_):
+        self.broker.queues.setdefault(queue, [])
+        self.send(channel, 'queue.declare-ok', queue=queue)
+
+    def do_queue_bind(self, channel, queue, exchange, routing_key, **_):
+        self.broker.bindings.add((exchange, routing_key, queue))
+        self.send(channel, 'queue.bind-ok')
+
+    def do_queue_unbind(self, channel, queue, exchange, routing_key, **_):
+        self.broker.bindings.discard((exchange, routing_key, queue))
+        self.send(channel, 'queue.unbind-ok')
+
+    def do_basic_consume(self, channel, queue, **_):
+        consumer_tag = str(uuid.uuid1())
+        self.send(channel, 'basic.consume-ok', consumer_tag=consumer_tag)
+        self.broker.consume(queue, self, channel, consumer_tag)
+
+    ### private ###
+
+    def _get_args(self, payload):
+        return dict((spec.pythonize(f.name), value)
+                    for f, value in zip(payload.method.fields, payload.args))
+
+
+class FakeAMQPServer(protocol.ServerFactory):
+    '''
+    In-process broker routing the committed messages to the consumers.
+    '''
+
+    def __init__(self):
+        self.spec = spec.load(os.path.join(os.path.dirname(net.__file__),
+                                           'amqp0-8.xml'))
+        self.connections = []
+        self.exchanges = dict()
+        # queue name -> [(exchange, routing key, body)]
+        self.queues = dict()
+        # set((exchange, routing key, queue name))
+        self.bindings = set()
+        # queue name -> (protocol, channel, consumer tag)
+        self.consumers = dict()
+        # number of messages published in each transaction
+        self.transactions = []
+
+    def buildProtocol(self, addr):
+        connection = FakeAMQPProtocol(self)
+        self.connections.append(connection)
+        return connection
+
+    def commit(self, messages):
+        if messages:
+            self.transactions.append(len(messages))
+        for exchange, routing_key, body in messages:
+            fanout = self.exchanges.get(exchange) == 'fanout'
+            for e, key, queue in self.bindings:
+                if e == exchange and (fanout or key == routing_key):
+                    self.queues[queue].append((exchange, routing_key, body))
+                    self._dispatch(queue)
+
+    def consume(self, queue, connection, channel, consumer_tag):
+        self.consumers[queue] = (connection, channel, consumer_tag)
+        self._dispatch(queue)
+
+    def _dispatch(self, queue):
+        consumer = self.consumers.get(queue)
+        if consumer is None:
+            return
+        connection, channel, consumer_tag = consumer
+        if connection not in self.connections:
+            return
+        messages = self.queues[queue]
+        while messages:
+            connection.deliver(channel, consumer_tag, *messages.pop(0))
+
+
+def m(payload):
+    return message.BaseMessage(payload=payload, message_id=str(uuid.uuid1()),
+                               expiration_time=time.time() + 30)
+
+
+class MessagingMixin(object):
+
+    @defer.inlineCallbacks
+    def init_agents(self, messaging, number_of_agents=2):
+        self.agents = [common.StubAgent() for x in range(number_of_agents)]
+        self.connections = []
+        for agent in self.agents:
+            connection = messaging.new_channel(agent, agent.get_agent_id())
+            yield connection.initiate()
+            self.connections.append(connection)
+            pb = connection.bind('lobby', agent.get_agent_id())
+            yield pb.wait_created()
+
+    def recipient(self, index):
+        agent_id = self.agents[index].get_agent_id()
+        return recipient.Recipient(agent_id, 'lobby')
+
+    def wait_for_messages(self, index, number, timeout=10):
+
+        def check():
+            return len(self.agents[index].messages) >= number
+
+        return self.wait_for(check, timeout, freq=0.01)
+
+    @defer.inlineCallbacks
+    def connect_fake_server(self, **kwargs):
+        self.server = FakeAMQPServer()
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.messaging = net.RabbitMQ(
+            '127.0.0.1', self.port.getHost().port, **kwargs)
+        yield self.messaging.connect()
+        yield self.init_agents(self.messaging)
+
+    @defer.inlineCallbacks
+    def disconnect_fake_server(self):
+        lost = [c.lost for c in self.server.connections]
+        yield defer.DeferredList([c.release() for c in self.connections])
+        self.messaging.disconnect()
+        yield defer.DeferredList(lost)
+        yield self.port.stopListening()
+
+
+class TestBatchedPublishing(common.TestCase, MessagingMixin):
+
+    timeout = 20
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.disconnect_fake_server()
+        yield common.TestCase.tearDown(self)
+
+    @defer.inlineCallbacks
+    def testPublishingInBatches(self):
+        yield self.connect_fake_server(publish_batch_size=10)
+        messages = [m(x) for x in range(25)]
+        yield defer.DeferredList([self.connections[0].post(self.recipient(1),
+                                                           msg)
+                                  for msg in messages])
+        yield self.wait_for_messages(1, 25)
+        self.assertEqual(messages, self.agents[1].messages)
+        self.assertEqual([10, 10, 5], self.server.transactions)
+
+    @defer.inlineCallbacks
+    def testCommittingAfterLatency(self):
+        yield self.connect_fake_server(publish_batch_latency=0.5)
+        d = self.connections[0].post(self.recipient(1), m(1))
+        yield common.delay(None, 0.01)
+        self.connections[1].post(self.recipient(0), m(2))
+        self.connections[0].post(self.recipient(1), m(3))
+        yield d
+        yield self.wait_for_messages(1, 2)
+        yield self.wait_for_messages(0, 1)
+        # the messages of each channel are committed together
+        self.assertEqual([2, 1], self.server.transactions)
+
+    @defer.inlineCallbacks
+    def testPublishingEachMessage(self):
+        yield self.connect_fake_server(publish_batch_size=1)
+        yield defer.DeferredList([self.connections[0].post(self.recipient(1),
+                                                           m(x))
+                                  for x in range(5)])
+        yield self.wait_for_messages(1, 5)
+        self.assertEqual([1] * 5, self.server.transactions)
+
+
+@common.attr('slow')
+class TestPublishingBenchmark(common.TestCase, MessagingMixin):
+
+    timeout = 120
+
+    messages = 5000
+
+    @defer.inlineCallbacks
+    def benchmark(self, name):
+        messages = [m(x) for x in xrange(self.messages)]
+        start = time.time()
+        yield defer.DeferredList([self.connections[0].post(self.recipient(1),
+                                                           msg)
+                                  for msg in messages])
+        self.info("%s: %.0f messages/s published", name,
+                  self.messages / (time.time() - start))
+        yield self.wait_for_messages(1, self.messages, timeout=60)
+
+    @defer.inlineCallbacks
+    def testEmulatedBroker(self):
+        yield self.init_agents(emu.RabbitMQ())
+        yield self.benchmark("Emulated broker")
+
+    @defer.inlineCallbacks
+    def testFakeServer(self):
+        for batch_size in (1, 10, 100):
+            yield self.connect_fake_server(publish_batch_size=batch_size)
+            yield self.benchmark("Fake AMQP server, batch size %d"
+                                 % (batch_size, ))
+            yield self.disconnect_fake_server()
@@ -426,3 +426,104 @@ class TestRouting(common.TestCase):
         m_id = msg.message_id
         m_ids = [msg.message_id for msg in sink.messages]
         self.assertFalse(m_id in m_ids, "Messages are: %r" % (sink.messages, ))
+
+    def testRemovingRoutes(self):
+        table = self.hosts[0].master.table
+        agent = self.hosts[0].agents[0]
+        key = ('public-protocol', 'shard')
+        agent.public_interest('public-protocol')
+        other = BaseDummySink(self, table, key=key)
+        table.append_route(other.create_route(priority=5))
+
+        m = broadcast('public-protocol')
+        table.dispatch(m, outgoing=False)
+        self.assert_delivered(agent, m)
+        self.assert_delivered(other, m)
+
+        table.remove_sink(agent)
+        m = broadcast('public-protocol')
+        table.dispatch(m, outgoing=False)
+        self.assert_not_delivered(agent, m)
+        self.assert_delivered(other, m)
+        m = direct(agent.key)
+        table.dispatch(m, outgoing=False)
+        self.assert_not_delivered(agent, m)
+
+        table.remove_route(other.create_route(priority=5))
+        m = broadcast('public-protocol')
+        table.dispatch(m, outgoing=False)
+        self.assert_not_delivered(other, m)
+
+
+class TestMessageStore(common.TestCase):
+
+    implements(ITimeProvider)
+
+    def get_time(self):
+        return self._time
+
+    def setUp(self):
+        self._time = 100
+        self.store = routing.MessageStore(self)
+        self.sink = BaseDummySink(self)
+
+    def testMatchingMessagesToRoutes(self):
+        keys = [('agent%d' % x, 'shard') for x in range(3)]
+        messages = [direct(keys[x % 3], expiration_time=110 + x)
+                    for x in range(9)]
+        for m in messages:
+            self.store.insert(m)
+        # already expired messages are not stored
+        self.store.insert(direct(keys[0], expiration_time=100))
+        self.assertEqual(3, len(self.store._store))
+
+        route = self.sink.create_route(key=keys[0], final=False)
+        self.assertEqual(messages[0::3], self.store.match_to_route(route))
+        self.store.remove(messages[3])
+        route = self.sink.create_route(key=keys[0])
+        self.assertEqual([messages[0], messages[6]],
+                         self.store.match_to_route(route))
+        self.assertEqual([], self.store.match_to_route(route))
+
+        self._time = 112
+        route = self.sink.create_route(key=keys[1])
+        self.assertEqual([messages[4], messages[7]],
+                         self.store.match_to_route(route))
+
+        # expired messages are dropped with their keys
+        self._time = 120
+        self.store.insert(direct(keys[1], expiration_time=130))
+        self.assertEqual([keys[1]], self.store._store.keys())
+        self.assertEqual(1, len(self.store._expirations))
+
+
+@common.attr('slow')
+class TestRoutingBenchmark(common.TestCase):
+
+    messages = 20000
+
+    def testDispatchingWithManyBindings(self):
+        for bindings in (10, 100, 1000):
+            table = routing.Table(self)
+            sinks = list()
+            for x in xrange(bindings):
+                sink = BaseDummySink(self, table, key=('agent%d' % x, 'shard'))
+                table.append_route(sink.create_route())
+                # interest in the broadcast protocol
+                table.append_route(sink.create_route(
+                    key=('protocol', 'shard'), final=False))
+                sinks.append(sink)
+            messages = [direct(sinks[x % bindings].key)
+                        for x in xrange(self.messages)]
+
+            start = time.time()
+            for message in messages:
+                table.dispatch(message, outgoing=False)
+            self.info("Dispatching with %d bindings: %.0f messages/s",
+                      bindings * 2, self.messages / (time.time() - start))
+            self.assertEqual(self.messages,
+                             sum(len(x.messages) for x in sinks))
+
+            table.dispatch(broadcast('protocol'), outgoing=False)
+            self.assertEqual(self.messages + bindings,
+                             sum(len(x.messages) for x in sinks))
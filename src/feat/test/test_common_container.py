@@ -585,6 +585,169 @@ class TestExpQueue(common.TestCase):
                                          (None, 1)])))
 
 
+class TestHeapExpDict(common.TestCase):
+
+    def check_iterator(self, iter, expected):
+        values = list(iter)
+        values.sort()
+        expected.sort()
+        self.assertEqual(values, expected)
+
+    def testBasicOperations(self):
+        d = HeapExpDict(self)
+        d["spam"] = 42
+        d.set("bacon", 18)
+        self.assertTrue("spam" in d)
+        self.assertEqual(len(d), 2)
+        self.assertEqual(d["spam"], 42)
+        self.assertEqual(d.get("bacon"), 18)
+        self.assertEqual(d.get("beans", 66), 66)
+        self.assertEqual(d.pop("beans", 66), 66)
+        self.assertRaises(KeyError, d.pop, "beans")
+        self.assertEqual(d.remove("spam"), 42)
+        self.assertFalse("spam" in d)
+        del d["bacon"]
+        self.assertEqual(len(d), 0)
+        d["eggs"] = 77
+        self.check_iterator(d.iteritems(), [("eggs", 77)])
+        d.clear()
+        self.assertEqual(len(d), 0)
+
+    def testComparison(self):
+        a = HeapExpDict(self)
+        b = HeapExpDict(self)
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, 12)
+        self.assertNotEqual(a, ExpDict(self))
+        a["spam"] = 12
+        self.assertNotEqual(a, b)
+        b["spam"] = 12
+        self.assertEqual(a, b)
+
+    def testExpiration(self):
+        t = DummyTimeProvider(0)
+        d = HeapExpDict(t, max_size=2)
+        d.set("spam", 42, 0) # Expire right away
+        self.assertEqual(len(d), 0)
+        d.set("spam", 42, 10)
+        d.set("bacon", 18, 5, relative=True)
+        d.set("eggs", 77)
+        self.assertEqual(len(d), 3)
+        self.assertEqual(d.get_expiration("spam"), 10)
+
+        t.time = 5
+        self.assertEqual(len(d), 2)
+        self.check_iterator(iter(d), ["spam", "eggs"])
+
+        # setting again replaces the previous expiration
+        d.set("spam", 43, 20)
+        t.time = 10
+        self.assertEqual(d["spam"], 43)
+        d["spam"] = 44
+        t.time = 20
+        self.assertEqual(d["spam"], 44)
+
+        # the outdated entries of the heap are dropped
+        for x in range(10):
+            d.set("bacon", x, 30 + x)
+        self.assertEqual(len(d), 3)
+        self.assertTrue(len(d._heap) <= 2 * len(d) + 2)
+        t.time = 100
+        self.check_iterator(d.iterkeys(), ["spam", "eggs"])
+        self.assertEqual(len(d._heap), 0)
+
+    def testSerialization(self):
+        t = DummyTimeProvider(0)
+        serialize = pytree.serialize
+        unserialize = pytree.unserialize
+        Ins = pytree.Instance
+        size = HeapExpDict.DEFAULT_MAX_SIZE
+
+        d = HeapExpDict(t)
+        self.assertEqual(serialize(d),
+                         Ins("xheapdict", (Ins("dummy-time-provider", 0),
+                                           size, {})))
+        self.assertEqual(d, unserialize(serialize(d)))
+        d["foo"] = 1
+        d.set("bar", 2, 5)
+        d.set("spam", 3, 8.001)
+        self.assertEqual(d, unserialize(serialize(d)))
+        self.assertEqual(serialize(d),
+                         Ins("xheapdict", (Ins("dummy-time-provider", 0),
+                                           size,
+                                           {"foo": (None, 1),
+                                            "bar": (5000, 2),
+                                            "spam": (8001, 3)})))
+        # the restored heap expires the items
+        copy = unserialize(serialize(d))
+        copy._time.time = 6
+        self.assertEqual(["foo", "spam"], sorted(copy.keys()))
+
+
+class TestHeapExpQueue(common.TestCase):
+
+    def testBasicOperations(self):
+        q = HeapExpQueue(self)
+        self.assertRaises(Empty, q.pop)
+        q.add("spam")
+        q.add("bacon")
+        self.assertEqual(len(q), 2)
+        self.assertTrue(q.pop() in ["spam", "bacon"])
+        self.assertEqual(len(q), 1)
+        q.clear()
+        self.assertEqual(len(q), 0)
+        self.assertRaises(Empty, q.pop)
+
+    def testComparison(self):
+        a = HeapExpQueue(self)
+        b = HeapExpQueue(self)
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, ExpQueue(self))
+        a.add("foo")
+        self.assertNotEqual(a, b)
+        b.add("foo")
+        self.assertEqual(a, b)
+
+    def testExpiration(self):
+        t = DummyTimeProvider(0)
+        q = HeapExpQueue(t)
+        q.add(1, 0) # Expire right away
+        self.assertEqual(len(q), 0)
+        q.add(1)
+        q.add(2, 10)
+        q.add(3, 5, relative=True)
+        q.add(4, 20)
+        self.assertEqual(len(q), 4)
+        t.time = 10
+        self.assertEqual(len(q), 2)
+        self.assertEqual(q.pop(), 4)
+        t.time = 30
+        self.assertEqual(len(q), 1)
+        self.assertEqual(q.pop(), 1)
+
+    def testSerialization(self):
+        t = DummyTimeProvider(0)
+        serialize = pytree.serialize
+        unserialize = pytree.unserialize
+        Ins = pytree.Instance
+
+        d = HeapExpQueue(t)
+        self.assertEqual(serialize(d),
+                         Ins("xheapqueue",
+                             (Ins("dummy-time-provider", 0), [])))
+        d.add(1)
+        d.add(2, 5)
+        d.add(3, 9.001)
+        d.add(4, 8.0012)
+        self.assertEqual(d, unserialize(serialize(d)))
+        self.assertEqual(serialize(d),
+                         Ins("xheapqueue", (Ins("dummy-time-provider", 0),
+                                            [(5000, 2),
+                                             (8001, 4),
+                                             (9001, 3),
+                                             (None, 1)])))
+
+
 class TestReplayability(common.TestCase):
 
     def setUp(self):
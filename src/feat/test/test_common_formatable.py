@@ -112,3 +112,26 @@ class TestFormatable(common.TestCase):
         self.assertEqual(2, a.element)
 
         self.assertRaises(AttributeError, PropertyTest, readonly=2)
+
+    def testSnapshotPlan(self):
+        self.assertEqual((('field1', 'field1'),
+                          ('field2', 'custom_serializable')),
+                         Base._get_snapshot_plan())
+        self.assertEqual((('field2', 'custom_serializable'),
+                          ('field1', 'field1'),
+                          ('field3', 'field3')),
+                         Child._get_snapshot_plan())
+
+        # Registering a field resets the plan of the class
+
+        class Redefined(Base):
+            pass
+
+        self.assertEqual(Base._get_snapshot_plan(),
+                         Redefined._get_snapshot_plan())
+        Redefined._register_field(formatable.Field('field4', None))
+        self.assertEqual(3, len(Redefined._get_snapshot_plan()))
+        self.assertEqual(2, len(Base._get_snapshot_plan()))
+        self.assertEqual({'field1': 1, 'custom_serializable': 5,
+                          'field4': 4},
+                         Redefined(field1=1, field4=4).snapshot())
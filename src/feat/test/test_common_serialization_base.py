@@ -23,10 +23,15 @@
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import gc
+import time
+
 from twisted.spread import jelly
 
-from feat.common import serialization
-from feat.common.serialization import base
+from feat.agencies import recipient
+from feat.agents.base import descriptor, partners
+from feat.common import reflect, serialization
+from feat.common.serialization import base, banana, json, pytree, sexp
 from feat.interface.serialization import *
 
 from . import common
@@ -304,3 +309,151 @@ class TestVersionAdapter(common.TestCase):
 
         self.check_combinations(DummyVerAdapter2, range(1, 10), expected)
         self.check_combinations(DummyVerAdapter2(), range(1, 10), expected)
+
+
+class TwoPassSexpSerializer(sexp.Serializer):
+
+    single_pass = False
+
+
+class TwoPassJSONSerializer(json.Serializer):
+
+    single_pass = False
+
+
+class TwoPassBananaSerializer(banana.Serializer):
+
+    single_pass = False
+
+
+class OverridingSerializer(sexp.Serializer):
+
+    def flatten_instance(self, value, caps, freezing):
+        return sexp.Serializer.flatten_instance(self, value, caps, freezing)
+
+
+def generate_descriptor(index):
+    desc = descriptor.Descriptor(doc_id=u"agent_%d" % index,
+                                 shard=u"lobby", instance_id=index)
+    desc.partners = [partners.BasePartner(recipient.Agent("host_%d" % i,
+                                                          u"lobby"),
+                                          allocation_id=i, role="host")
+                     for i in range(5)]
+    desc.resources = {"core": 2, "mem": 1024, "epu": 300}
+    return desc
+
+
+class TestSinglePass(common.TestCase):
+
+    serializers = ((sexp.Serializer, TwoPassSexpSerializer),
+                   (json.Serializer, TwoPassJSONSerializer),
+                   (banana.Serializer, TwoPassBananaSerializer))
+
+    def check_values(self, *values):
+        for single_cls, two_cls in self.serializers:
+            single, two = single_cls(), two_cls()
+            self.assertTrue(single._single_pass)
+            self.assertFalse(two._single_pass)
+            for value in values:
+                for name in ("convert", "freeze"):
+                    self.assertEqual(self.call(getattr(single, name), value),
+                                     self.call(getattr(two, name), value))
+
+    def call(self, method, value):
+        # Both modes should fail the same way
+        try:
+            return method(value)
+        except (TypeError, ValueError), e:
+            return type(e)
+
+    def testSelection(self):
+        self.assertFalse(base.Serializer()._single_pass)
+        self.assertFalse(pytree.Serializer()._single_pass)
+        self.assertTrue(json.PreSerializer()._single_pass)
+        self.assertTrue(sexp.Serializer()._single_pass)
+        self.assertTrue(banana.Serializer()._single_pass)
+        self.assertFalse(OverridingSerializer()._single_pass)
+
+    def testSameOutput(self):
+        self.check_values(None, True, 42, 2**66, 3.14, "spam", u"bacon",
+                          [1, [2, [3]]], {"a": [1, {"b": None}]},
+                          set([1, 2]), A(42), B(1, [2, 3]), D(u"x"),
+                          {"spam": A(B(1, 2))}, generate_descriptor(1))
+
+    def testReferences(self):
+        a = [1, 2]
+        b = A(None)
+        b.x = b
+        c = {"x": A(42)}
+        c["y"] = c["x"]
+        d = []
+        d.append(d)
+        self.check_values([a, a], b, c, d, [c, c])
+
+    def testFallbackRestoresReferences(self):
+        a = [1, 2]
+        value = {"x": a, "y": a}
+        data = sexp.Serializer().convert(value)
+        result = sexp.Unserializer().convert(data)
+        self.assertEqual(result, value)
+        self.assertTrue(result["x"] is result["y"])
+
+    def testSnapshotPlans(self):
+        serializer = json.Serializer()
+        desc = generate_descriptor(1)
+        expected = TwoPassJSONSerializer().convert(desc)
+        self.assertEqual(expected, serializer.convert(desc))
+        plan = serializer._plans[False][descriptor.Descriptor]
+        self.assertEqual(u"_id", plan["_id"])
+        self.assertTrue("partners" in plan)
+        # Serializing again uses the packed keys from the plan
+        self.assertEqual(expected, serializer.convert(desc))
+        # Only string keys are taken from the plan
+        self.check_values(A({"x": 1, 2: 3}), A({"x": 1, u"y": 3}))
+        serializer.convert(A({"x": 1}))
+        self.assertRaises(TypeError, serializer.convert, A({u"x": 1}))
+
+    def testRedefinedClassPlan(self):
+        serializer = json.Serializer()
+
+        class Redefined(serialization.Serializable):
+            pass
+
+        value = Redefined()
+        value.x = 1
+        serializer.convert(value)
+        self.assertEqual(1, len(serializer._plans[False]))
+
+        del value, Redefined
+        gc.collect()
+        self.assertEqual(0, len(serializer._plans[False]))
+
+    def testUnsupportedValue(self):
+        serializer = json.Serializer()
+        self.assertRaises(TypeError, serializer.convert, object())
+        self.assertRaises(TypeError, serializer.convert, {1: 2})
+        # The serializer state should have been reset
+        self.assertEqual(serializer.convert([42]), "[42]")
+
+
+@common.attr('slow')
+class TestSerializerBenchmark(common.TestCase):
+
+    iterations = 200
+
+    def testDescriptors(self):
+        values = [generate_descriptor(i) for i in range(20)]
+        for single_cls, two_cls in TestSinglePass.serializers:
+            results = []
+            for cls in (two_cls, single_cls):
+                serializer = cls()
+                start = time.time()
+                for x in xrange(self.iterations):
+                    for value in values:
+                        serializer.convert(value)
+                elapsed = time.time() - start
+                results.append(elapsed * 1e6
+                               / (self.iterations * len(values)))
+            self.info("%s: two pass %.0f us/descriptor, "
+                      "single pass %.0f us/descriptor",
+                      reflect.canonical_name(single_cls), *results)
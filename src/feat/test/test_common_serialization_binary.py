@@ -0,0 +1,139 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+# -*- coding: utf-8 -*-
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import time
+
+from feat.common.serialization import banana, binary, json
+from feat.interface.serialization import *
+
+from . import common, common_serialization
+from .test_common_serialization_base import generate_descriptor
+
+
+class BinaryConvertersTest(common_serialization.ConverterTest):
+
+    def setUp(self):
+        common_serialization.ConverterTest.setUp(self)
+        ext = self.externalizer
+        self.serializer = binary.Serializer(externalizer=ext,
+                                            use_binary=True)
+        self.unserializer = binary.Unserializer(externalizer=ext)
+
+    def testHelperFunctions(self):
+        self.checkSymmetry(binary.serialize, binary.unserialize)
+
+    def testBananaByDefault(self):
+        value = {"spam": [1, 2L, u"bacon", (3.5, None)]}
+        data = binary.Serializer().convert(value)
+        self.assertFalse(binary.is_binary(data))
+        self.assertEqual(data, banana.serialize(value))
+        self.assertEqual(value, binary.unserialize(data))
+        data = self.serializer.convert(value)
+        self.assertTrue(binary.is_binary(data))
+        self.assertEqual(value, binary.unserialize(data))
+
+
+class BinaryCodecTest(common.TestCase):
+
+    def setUp(self):
+        self.codec = binary.BinaryCodec()
+
+    def check(self, value):
+        data = self.codec.encode(value)
+        self.assertTrue(binary.is_binary(data))
+        result = self.codec.decode(data)
+        self.assertEqual(value, result)
+        self.assertEqual(type(value), type(result))
+        return data
+
+    def testValues(self):
+        for value in (0, 1, 127, 128, 300, -1, -128, 2 ** 31, -2 ** 40,
+                      0L, 5L, -5L, 2 ** 66, -2 ** 66, 0.0, 3.14, -1e300,
+                      "", "spam", "x" * 1000, "\xff\x01\x00",
+                      [], [[]], [1, "a", [2.5, ["b", 3L]]]):
+            self.check(value)
+
+    def testInterning(self):
+        data = self.check(["some_atom", "some_atom", ["some_atom"]])
+        self.assertEqual(1, data.count("some_atom"))
+        long_string = "x" * (binary.MAX_INTERNED_SIZE + 1)
+        data = self.check([long_string, long_string])
+        self.assertEqual(2, data.count(long_string))
+        # the table is per stream
+        data = self.check(["some_atom"])
+        self.assertEqual(1, data.count("some_atom"))
+
+    def testUnsupported(self):
+        self.assertRaises(TypeError, self.codec.encode, [u"unicode"])
+        self.assertRaises(TypeError, self.codec.encode, [None])
+
+    def testInvalidData(self):
+        data = self.codec.encode([1, "spam", 2.5])
+        self.assertRaises(ValueError, self.codec.decode, data[:-1])
+        self.assertRaises(ValueError, self.codec.decode, data[:-4])
+        self.assertRaises(ValueError, self.codec.decode, data + "\x00")
+        self.assertRaises(ValueError, self.codec.decode, binary.MAGIC + "\x7f")
+
+    def testDecodingBanana(self):
+        value = {"spam": [1, 2L, u"bacon", (3.5, None)]}
+        data = banana.serialize(value)
+        self.assertFalse(binary.is_binary(data))
+        self.assertEqual(value, binary.unserialize(data))
+
+    def testSmallerThanBanana(self):
+        desc = generate_descriptor(1)
+        serializer = binary.Serializer(use_binary=True)
+        self.assertTrue(len(serializer.convert(desc))
+                        < len(banana.serialize(desc)))
+
+
+@common.attr('slow')
+class TestCodecBenchmark(common.TestCase):
+
+    iterations = 200
+
+    def testDescriptors(self):
+        values = [generate_descriptor(i) for i in range(20)]
+        for module in (json, banana, binary):
+            serializer = module.Serializer()
+            if module is binary:
+                serializer.use_binary = True
+            unserializer = module.Unserializer()
+            blobs = []
+            start = time.time()
+            for x in xrange(self.iterations):
+                blobs = [serializer.convert(v) for v in values]
+            encoding = time.time() - start
+            start = time.time()
+            for x in xrange(self.iterations):
+                for blob in blobs:
+                    unserializer.convert(blob)
+            decoding = time.time() - start
+            total = self.iterations * len(values)
+            size = sum(len(b) for b in blobs) / len(blobs)
+            self.info("%s: %d bytes/descriptor, encoding %.0f us, "
+                      "decoding %.0f us", module.__name__,
+                      size, encoding * 1e6 / total, decoding * 1e6 / total)
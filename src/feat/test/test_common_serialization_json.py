@@ -128,6 +128,35 @@ class PaisleyUnserializerTest(common.TestCase):
         self.assertTrue(unserialized.nested[1].has_migrated)
 
 
+class IterRowsTest(common.TestCase):
+
+    def testDecodingRows(self):
+        rows = [{u"id": u"a", u"doc": {u"x": [1, 2]}}, {u"id": u"b"}]
+        data = json.json.dumps({"total_rows": 2, "offset": 0, "rows": rows})
+        self.assertEqual(rows, list(json.iter_rows(data)))
+
+        data = ' { "rows" : [ 1 ,\n 2, {"a": "]"} ] , "offset": 0 } '
+        self.assertEqual([1, 2, {u"a": u"]"}], list(json.iter_rows(data)))
+
+        data = '{"total_rows": 0, "rows": []}'
+        self.assertEqual([], list(json.iter_rows(data)))
+
+        data = '{"results": [1], "last_seq": 1}'
+        self.assertEqual([1], list(json.iter_rows(data, "results")))
+
+    def testDecodingIncrementally(self):
+        data = '{"rows": [1, 2, {"broken": ]}'
+        rows = json.iter_rows(data)
+        self.assertEqual(1, rows.next())
+        self.assertEqual(2, rows.next())
+        self.assertRaises(ValueError, rows.next)
+
+    def testInvalidData(self):
+        for data in ('[]', '{"error": "not_found"}', '{"rows": 1}',
+                     '{"rows": [1 2]}', '{"a" 1, "rows": []}'):
+            self.assertRaises(ValueError, list, json.iter_rows(data))
+
+
 class JSONConvertersTest(common_serialization.ConverterTest):
 
     def setUp(self):
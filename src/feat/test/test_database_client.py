@@ -0,0 +1,148 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+from feat.common import defer
+from feat.database import client, document, emu
+from feat.test import common
+from feat.test.test_common_container import DummyTimeProvider
+
+from feat.database.interface import DatabaseError, NotFoundError
+
+
+class TestKnownRevisions(common.TestCase):
+
+    def testExpiration(self):
+        t = DummyTimeProvider(0)
+        revs = client.KnownRevisions(t, 10, 100)
+        revs['a'] = (1, 'hash')
+        t.time = 5
+        revs['b'] = (1, 'hash')
+        self.assertEqual((1, 'hash'), revs['a'])
+        self.assertEqual(10, revs.get_expiration('a'))
+
+        t.time = 11
+        self.assertNotIn('a', revs)
+        self.assertIn('b', revs)
+        # storing the entry releases the expired ones
+        revs['c'] = (1, 'hash')
+        self.assertEqual(2, revs.size())
+        self.assertEqual(['b', 'c'], list(revs._order))
+
+        # storing the revision again extends its lifetime
+        t.time = 15
+        revs['b'] = (2, 'hash')
+        self.assertEqual(['c', 'b'], list(revs._order))
+        t.time = 22
+        self.assertEqual((2, 'hash'), revs['b'])
+        self.assertNotIn('c', revs)
+
+    def testLimit(self):
+        t = DummyTimeProvider(0)
+        revs = client.KnownRevisions(t, 10, 100)
+        for x in range(1000):
+            revs[x] = (1, 'hash')
+            self.assertTrue(revs.size() <= 100)
+            self.assertTrue(len(revs._order) <= 100)
+        self.assertEqual(range(900, 1000), sorted(revs.keys()))
+
+        # the least recently stored are dropped first
+        revs[900] = (2, 'hash')
+        revs[1000] = (1, 'hash')
+        self.assertIn(900, revs)
+        self.assertNotIn(901, revs)
+
+        del revs[900]
+        self.assertNotIn(900, revs)
+        self.assertEqual(99, len(revs._order))
+
+    def testPoppingAndSetting(self):
+        t = DummyTimeProvider(0)
+        revs = client.KnownRevisions(t, 10, 100)
+        revs['a'] = (1, 'hash')
+        revs['b'] = (1, 'hash')
+        self.assertEqual((1, 'hash'), revs.pop('a'))
+        self.assertEqual((1, 'hash'), revs.remove('b'))
+        self.assertEqual([], list(revs._order))
+
+        t.time = 5
+        revs.set('a', (2, 'hash'), 10, relative=True)
+        revs['b'] = (2, 'hash')
+        self.assertEqual(['a', 'b'], list(revs._order))
+        # the entries removed before don't expire the new ones
+        t.time = 11
+        revs['c'] = (1, 'hash')
+        self.assertEqual((2, 'hash'), revs['a'])
+        self.assertEqual((2, 'hash'), revs['b'])
+        self.assertEqual(None, revs.pop('d', None))
+
+        # the entries stored without expiration get the default one
+        revs.set('d', (1, 'hash'))
+        self.assertEqual(21, revs.get_expiration('d'))
+        revs['e'] = (1, 'hash')
+        self.assertIn('d', revs)
+
+
+class BoundedConnection(client.Connection):
+
+    KNOWN_REVISIONS_SIZE = 50
+
+
+class TestConnectionMemory(common.TestCase):
+
+    @defer.inlineCallbacks
+    def testKnownRevisionsAreBounded(self):
+        database = emu.Database()
+        connection = BoundedConnection(database)
+        changes = list()
+        analytic = client.RevisionAnalytic(
+            connection, lambda *args: changes.append(args))
+
+        docs = list()
+        for x in range(500):
+            doc = yield connection.save_document(document.Document())
+            docs.append(doc)
+        self.assertEqual(50, connection.known_revisions.size())
+
+        # the own changes are still recognized for the recent documents
+        analytic.on_change(docs[-1].doc_id, docs[-1].rev, False)
+        # the notification of a forgotten document is passed as foreign
+        analytic.on_change(docs[0].doc_id, docs[0].rev, False)
+        self.assertEqual([(docs[-1].doc_id, docs[-1].rev, False, True),
+                          (docs[0].doc_id, docs[0].rev, False, False)],
+                         changes)
+
+
+class TestBulkGet(common.TestCase):
+
+    @defer.inlineCallbacks
+    def testMalformedRows(self):
+        database = emu.Database()
+        connection = client.Connection(database)
+        rows = [dict(error='not_found'), dict(key=u'broken')]
+        database.bulk_get = lambda doc_ids: defer.succeed(dict(rows=rows))
+
+        gets = yield connection.iter_bulk_get([u'missing', u'broken'],
+                                              consume_errors=False)
+        self.assertIsInstance(gets.next(), NotFoundError)
+        self.assertRaises(DatabaseError, gets.next)
+        d = connection.bulk_get_raw([u'missing', u'broken'])
+        self.assertFailure(d, DatabaseError)
+        yield d
@@ -0,0 +1,319 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import json
+
+from twisted.internet import reactor
+from twisted.web import resource
+from twisted.web.client import Agent
+
+from feat.common import defer, time
+from feat.database import client, driver
+from feat.test import common
+from feat.test.test_web_httpclient import CountingSite
+from feat.test.integration.test_idatabase_client import FilteringView
+
+from feat.database.interface import NotFoundError, DatabaseError
+
+
+class StubCouchDB(resource.Resource):
+    '''
+    Mimics the part of CouchDB API used by the driver to open and save
+    the documents of the single database.
+    '''
+
+    isLeaf = True
+
+    def __init__(self, db_name):
+        resource.Resource.__init__(self)
+        self.db_name = db_name
+        self.docs = dict()
+        self.update_seq = 0
+
+    def render(self, request):
+        if not self._accepts_json(request):
+            return self._error(request, 406, 'not_acceptable')
+        request.setHeader('content-type', 'application/json')
+        parts = request.path.strip('/').split('/', 1)
+        if parts == ['']:
+            return json.dumps(dict(couchdb='Welcome', version='1.2.0'))
+        if parts == ['_all_dbs']:
+            return json.dumps([self.db_name])
+        if parts[0] != self.db_name:
+            return self._error(request, 404, 'not_found')
+        if len(parts) == 1:
+            return json.dumps(dict(db_name=self.db_name,
+                                   update_seq=self.update_seq))
+
+        doc_id = parts[1]
+        if request.method in ('GET', 'HEAD'):
+            if doc_id not in self.docs:
+                return self._error(request, 404, 'not_found')
+            etag = '"%s"' % (self.docs[doc_id]['_rev'], )
+            request.setHeader('etag', etag)
+            if request.getHeader('if-none-match') == etag:
+                request.setResponseCode(304)
+                return ''
+            return json.dumps(self.docs[doc_id])
+        if request.method == 'PUT':
+            doc = json.loads(request.content.read())
+            current = self.docs.get(doc_id)
+            if current is not None and current['_rev'] != doc.get('_rev'):
+                return self._error(request, 409, 'conflict')
+            seq = int(current['_rev'].split('-')[0]) if current else 0
+            self.update_seq += 1
+            doc['_id'] = doc_id
+            doc['_rev'] = '%d-%032x' % (seq + 1, self.update_seq)
+            self.docs[doc_id] = doc
+            request.setResponseCode(201)
+            return json.dumps(dict(ok=True, id=doc_id, rev=doc['_rev']))
+        return self._error(request, 405, 'method_not_allowed')
+
+    def _accepts_json(self, request):
+        accept = request.getHeader('accept')
+        if accept is None:
+            return True
+        ranges = [x.split(';')[0].strip() for x in accept.split(',')]
+        return 'application/json' in ranges or '*/*' in ranges
+
+    def _error(self, request, code, error):
+        request.setResponseCode(code)
+        return json.dumps(dict(error=error, reason=error))
+
+
+class DriverTestMixin(object):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.couchdb = StubCouchDB('test')
+        self.site = CountingSite(self.couchdb)
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.database = driver.Database(
+            '127.0.0.1', self.port.getHost().port, 'test')
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.database.disconnect()
+        yield self.wait_for(lambda: not self.site.get_open_connections(),
+                            2, freq=0.01)
+        yield self.port.stopListening()
+        yield common.TestCase.tearDown(self)
+
+    def use_connection_per_request(self):
+        # the Agent used by paisley by default
+        self.database.paisley.client = Agent(reactor)
+
+
+class DummyChangeNotifier(object):
+
+    def __init__(self, db, db_name):
+        self.params = None
+        self.started = 0
+        self.listeners = list()
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def isRunning(self):
+        return self.params is not None
+
+    def start(self, **params):
+        self.params = params
+        self.started += 1
+
+    def stop(self):
+        self.params = None
+
+    def change(self, doc_id, seq):
+        change = dict(id=doc_id, seq=seq, changes=[dict(rev='1-' + doc_id)])
+        for listener in self.listeners:
+            listener.changed(change)
+
+
+class TestDriver(DriverTestMixin, common.TestCase):
+
+    @defer.inlineCallbacks
+    def testSavingAndOpeningDocuments(self):
+        for x in range(10):
+            resp = yield self.database.save_doc(
+                json.dumps(dict(value=x)), u'doc%d' % (x, ))
+            self.assertEqual(u'doc%d' % (x, ), resp['id'])
+        docs = yield defer.join(*[self.database.open_doc(u'doc%d' % (x, ))
+                                  for x in range(10)])
+        self.assertEqual(range(10), [x['value'] for x in docs])
+        d = self.database.open_doc(u'unknown')
+        self.assertFailure(d, NotFoundError)
+        yield d
+
+        seq = yield self.database.get_update_seq()
+        self.assertEqual(10, seq)
+        # the requests have been sent through the pool
+        self.assertTrue(
+            len(self.site.connections) <= self.database.connection_pool_size)
+
+    @defer.inlineCallbacks
+    def testConditionalRequests(self):
+        resp = yield self.database.save_doc(json.dumps(dict(value=1)), u'doc')
+        rev = yield self.database.get_revision(u'doc')
+        self.assertEqual(resp['rev'], rev)
+        doc = yield self.database.open_doc_if_modified(u'doc', rev)
+        self.assertIs(None, doc)
+
+        yield self.database.save_doc(
+            json.dumps(dict(value=2, _rev=rev)), u'doc')
+        doc = yield self.database.open_doc_if_modified(u'doc', rev)
+        self.assertEqual(2, doc['value'])
+
+        d = self.database.get_revision(u'unknown')
+        self.assertFailure(d, NotFoundError)
+        yield d
+        d = self.database.open_doc_if_modified(u'unknown', rev)
+        self.assertFailure(d, NotFoundError)
+        yield d
+
+    def testMalformedBulkGetResponse(self):
+        rows = self.database._parse_bulk_result('{"rows": [{"id": "a"}, {')
+        rows = rows['rows']
+        self.assertEqual(dict(id='a'), rows.next())
+        self.assertRaises(DatabaseError, rows.next)
+        rows = self.database._parse_bulk_result('{"error": "not_found"}')
+        self.assertRaises(DatabaseError, list, rows['rows'])
+
+    @defer.inlineCallbacks
+    def testSharingDocIdsFeed(self):
+        yield self.database.wait_connected()
+        self.assertTrue(self.database.doc_ids_filter)
+        feeds = list()
+
+        def create_feed(db, db_name):
+            feeds.append(DummyChangeNotifier(db, db_name))
+            return feeds[-1]
+
+        self.patch(driver, 'ChangeNotifier', create_feed)
+        self.patch(driver.Notifier, 'restart_delay', 0.01)
+        calls = list()
+
+        def change_cb(name):
+            return lambda *args: calls.append((name, ) + args)
+
+        # the document ids are filtered by CouchDB
+        l1 = yield self.database.listen_changes(['b', 'a'], change_cb('l1'))
+        l2 = yield self.database.listen_changes(['a'], change_cb('l2'))
+        self.assertEqual(1, len(feeds))
+        doc_ids = feeds[0]
+        self.assertEqual(dict(filter='_doc_ids', doc_ids='["a", "b"]',
+                              heartbeat=1000), doc_ids.params)
+        # the second listener didn't change the set of watched documents
+        self.assertEqual(1, doc_ids.started)
+
+        # the listeners registered together share the restart,
+        # which resumes from the last change
+        doc_ids.change('a', 5)
+        l3, l4 = yield defer.join(
+            self.database.listen_changes(['c'], change_cb('l3')),
+            self.database.listen_changes(['d'], change_cb('l4')))
+        self.assertEqual(2, doc_ids.started)
+        self.assertEqual(dict(filter='_doc_ids',
+                              doc_ids='["a", "b", "c", "d"]',
+                              heartbeat=1000, since=5), doc_ids.params)
+
+        # the view filter has its own feed
+        l5 = yield self.database.listen_changes(
+            FilteringView, change_cb('l5'), dict(field='x'))
+        self.assertEqual(2, len(feeds))
+        view = feeds[1]
+        self.assertEqual(
+            dict(filter='%s/%s' % (FilteringView.design_doc_id,
+                                   FilteringView.name),
+                 field='x', heartbeat=1000), view.params)
+        self.assertEqual(2, doc_ids.started)
+
+        del calls[:]
+        doc_ids.change('a', 6)
+        doc_ids.change('z', 7)
+        view.change('x', 8)
+        yield common.delay(None, 0.01)
+        self.assertEqual(sorted([('l1', 'a', '1-a', False),
+                                 ('l2', 'a', '1-a', False),
+                                 ('l5', 'x', '1-x', False)]), sorted(calls))
+
+        # cancelling the listeners doesn't restart the feed
+        yield self.database.cancel_listener(l1)
+        yield self.database.cancel_listener(l3)
+        self.assertEqual(2, doc_ids.started)
+        self.assertTrue(doc_ids.isRunning())
+        yield self.database.cancel_listener(l2)
+        yield self.database.cancel_listener(l4)
+        self.assertFalse(doc_ids.isRunning())
+        yield self.database.cancel_listener(l5)
+        self.assertFalse(view.isRunning())
+
+    @defer.inlineCallbacks
+    def testTooManyDocIdsAreFilteredLocally(self):
+        yield self.database.wait_connected()
+        changes = DummyChangeNotifier(None, None)
+        self.patch(driver, 'ChangeNotifier', lambda *_: changes)
+        self.patch(driver.Notifier, 'restart_delay', 0.01)
+        self.patch(client.DocIdFilter, 'MAX_FILTERED_IDS', 2)
+
+        l1 = yield self.database.listen_changes(['a', 'b'], lambda *_: None)
+        yield self.database.listen_changes(['c'], lambda *_: None)
+        self.assertEqual(dict(heartbeat=1000), changes.params)
+        yield self.database.listen_changes(['d'], lambda *_: None)
+        yield self.database.cancel_listener(l1)
+        self.assertEqual(dict(heartbeat=1000), changes.params)
+        self.assertEqual(2, changes.started)
+
+
+@common.attr('slow')
+class TestDriverBenchmark(DriverTestMixin, common.TestCase):
+
+    requests = 500
+
+    @defer.inlineCallbacks
+    def testPooledConnections(self):
+        yield self._benchmark("pooled connections")
+        self.assertTrue(
+            len(self.site.connections) <= self.database.connection_pool_size)
+
+    @defer.inlineCallbacks
+    def testConnectionPerRequest(self):
+        self.use_connection_per_request()
+        yield self._benchmark("connection per request")
+
+    @defer.inlineCallbacks
+    def _benchmark(self, name):
+        doc = json.dumps(dict(field=u'value'))
+        yield self.database.save_doc(doc, u'doc')
+
+        start = time.time()
+        for x in xrange(self.requests):
+            yield self.database.open_doc(u'doc')
+        self.info("%s, latency: %.0f us/request", name,
+                  (time.time() - start) * 1e6 / self.requests)
+
+        start = time.time()
+        yield defer.join(*[self.database.open_doc(u'doc')
+                           for x in xrange(self.requests)])
+        self.info("%s, throughput: %.0f requests/s", name,
+                  self.requests / (time.time() - start))
+        self.info("%s, connections opened: %d", name,
+                  len(self.site.connections))
@@ -20,10 +20,12 @@
 
 # Headers in this file shall remain intact.
 import json
+import random
+import time
 
 from twisted.internet import defer
 
-from feat.database import emu
+from feat.database import emu, view
 from feat.database.interface import ConflictError, NotFoundError
 
 from . import common
@@ -198,8 +200,268 @@ class TestDatabaseIntegration(common.TestCase):
         yield self.database.delete_doc(doc_id, rev)
         self.assertEqual(1, len(self.calls))
 
+    @defer.inlineCallbacks
+    def testCancellingOneOfListeners(self):
+        self.calls = list()
+
+        d = self.cb_after(None, self, 'change_cb')
+        l1 = yield self.database.listen_changes(
+            ('id1', 'id2'), self.change_cb)
+        yield self.database.listen_changes(('id2', ), self.change_cb)
+        yield self.database.cancel_listener(l1)
+
+        yield self.database.save_doc(self._gen_doc('id1'))
+        yield self.database.save_doc(self._gen_doc('id2'))
+        yield d
+        self.assertEqual(['id2'], [x[0] for x in self.calls])
+
     def change_cb(self, doc_id, rev, deleted):
         self.calls.append((doc_id, rev, deleted))
 
     def _gen_doc(self, doc_id):
         return json.dumps({'_id': doc_id})
+
+
+class IndexedView(view.BaseView):
+
+    name = 'indexed_view'
+    use_reduce = True
+
+    def map(doc):
+        if doc.get('.type') == 'indexed':
+            for tag in doc.get('tags', []):
+                yield (doc['field'], tag), doc['value']
+
+    reduce = "_sum"
+
+
+class FailingView(view.BaseView):
+
+    name = 'failing_view'
+
+    def map(doc):
+        if doc.get('fail'):
+            raise ValueError("Cannot map %s" % (doc['_id'], ))
+        yield doc['_id'], None
+
+
+class TestViewIndex(common.TestCase):
+
+    def setUp(self):
+        self.database = emu.Database()
+        self.revs = dict()
+
+    @defer.inlineCallbacks
+    def testQueryingRanges(self):
+        yield self.save('a', u'A', 1, tags=[1, 2])
+        yield self.save('b', u'B', 2)
+        yield self.save('c', u'C', 3)
+        yield self.save('d', u'B', 4, tags=[0])
+
+        res = yield self.query(reduce=False)
+        self.assertEqual([((u'A', 1), 1, 'a'), ((u'A', 2), 1, 'a'),
+                          ((u'B', 0), 4, 'd'), ((u'B', 1), 2, 'b'),
+                          ((u'C', 1), 3, 'c')], res)
+
+        res = yield self.query(reduce=False, startkey=(u'B', ),
+                               endkey=(u'B', {}))
+        self.assertEqual(['d', 'b'], [x[2] for x in res])
+        res = yield self.query(reduce=False, startkey=(u'B', {}),
+                               endkey=(u'B', ), descending=True)
+        self.assertEqual(['b', 'd'], [x[2] for x in res])
+        res = yield self.query(reduce=False, key=(u'A', 2))
+        self.assertEqual([((u'A', 2), 1, 'a')], res)
+        res = yield self.query(reduce=False, skip=1, limit=2)
+        self.assertEqual([((u'A', 2), 1, 'a'), ((u'B', 0), 4, 'd')], res)
+        res = yield self.query(reduce=False, skip=3)
+        self.assertEqual(['b', 'c'], [x[2] for x in res])
+        res = yield self.query(reduce=False, descending=True, limit=1)
+        self.assertEqual([((u'C', 1), 3, 'c')], res)
+        res = yield self.query(
+            reduce=False, keys=[(u'C', 1), (u'A', 1), (u'X', 1), (u'C', 1)])
+        self.assertEqual(['a', 'c'], [x[2] for x in res])
+
+        res = yield self.query(reduce=False, key=(u'B', 1),
+                               include_docs=True)
+        self.assertEqual(1, len(res))
+        self.assertEqual(u'B', res[0][3]['field'])
+
+        # updating and deleting the documents updates the index
+        yield self.save('b', u'C', 5)
+        yield self.delete('a')
+        res = yield self.query(reduce=False)
+        self.assertEqual([((u'B', 0), 4, 'd'), ((u'C', 1), 5, 'b'),
+                          ((u'C', 1), 3, 'c')], res)
+
+    @defer.inlineCallbacks
+    def testReducing(self):
+        yield self.save('a', u'A', 1, tags=[1, 2])
+        yield self.save('b', u'B', 2)
+
+        res = yield self.query()
+        self.assertEqual([(None, 4)], res)
+        res = yield self.query(group=True)
+        self.assertEqual([((u'A', 1), 1), ((u'A', 2), 1), ((u'B', 1), 2)],
+                         res)
+        res = yield self.query(group_level=1)
+        self.assertEqual([((u'A', ), 2), ((u'B', ), 2)], res)
+        res = yield self.query(group_level=1, descending=True, limit=1)
+        self.assertEqual([((u'B', ), 2)], res)
+        res = yield self.query(group_level=1, startkey=(u'B', ))
+        self.assertEqual([((u'B', ), 2)], res)
+
+        # only the groups of the changed documents are recalculated
+        reduce_calls = self.count_reduce_calls()
+        yield self.save('c', u'C', 3)
+        res = yield self.query(group_level=1)
+        self.assertEqual([((u'A', ), 2), ((u'B', ), 2), ((u'C', ), 3)], res)
+        self.assertEqual(1, len(reduce_calls))
+        yield self.delete('b')
+        res = yield self.query(group_level=1)
+        self.assertEqual([((u'A', ), 2), ((u'C', ), 3)], res)
+        self.assertEqual(2, len(reduce_calls))
+        res = yield self.query()
+        self.assertEqual([(None, 5)], res)
+        yield self.delete('a')
+        yield self.delete('c')
+        res = yield self.query()
+        self.assertEqual([], res)
+        res = yield self.query(group=True)
+        self.assertEqual([], res)
+
+    @defer.inlineCallbacks
+    def testRandomOperations(self):
+        rand = random.Random(42)
+        docs = dict()
+        for x in range(300):
+            doc_id = 'doc%d' % (rand.randint(0, 40), )
+            if doc_id in docs and rand.random() < 0.3:
+                yield self.delete(doc_id)
+                del docs[doc_id]
+            else:
+                field = rand.choice([u'A', u'B', u'C', u'D'])
+                tags = [rand.randint(0, 5)
+                        for _ in range(rand.randint(0, 3))]
+                value = rand.randint(0, 10)
+                yield self.save(doc_id, field, value, tags=tags)
+                docs[doc_id] = (field, value, tags)
+            if x % 10:
+                continue
+
+            rows = sorted((((field, tag), value, doc_id)
+                           for doc_id, (field, value, tags) in docs.items()
+                           for tag in tags),
+                          key=lambda row: (row[0], row[2]))
+            res = yield self.query(reduce=False)
+            self.assertEqual(rows, res)
+
+            start, end = (u'B', 2), (u'C', 3)
+            expected = [row for row in rows if start <= row[0] <= end]
+            res = yield self.query(reduce=False, startkey=start, endkey=end)
+            self.assertEqual(expected, res)
+            res = yield self.query(reduce=False, startkey=end, endkey=start,
+                                   descending=True, skip=1, limit=5)
+            self.assertEqual(expected[::-1][1:6], res)
+
+            groups = dict()
+            for key, value, _ in rows:
+                groups[key[:1]] = groups.get(key[:1], 0) + value
+            res = yield self.query(group_level=1)
+            self.assertEqual(sorted(groups.items()), res)
+            total = sum(row[1] for row in rows)
+            res = yield self.query()
+            self.assertEqual([(None, total)] if rows else [], res)
+
+    @defer.inlineCallbacks
+    def testFailingMap(self):
+        yield self.save('a', u'A', 1)
+        resp = yield self.database.save_doc(json.dumps(
+            {'_id': 'b', 'fail': True}))
+        d = self.database.query_view(FailingView)
+        self.assertFailure(d, ValueError)
+        yield d
+        # the document is mapped again by the next query
+        yield self.database.delete_doc('b', resp['rev'])
+        res = yield self.database.query_view(FailingView)
+        self.assertEqual([('a', None, 'a')], res)
+
+    def save(self, doc_id, field, value, tags=[1]):
+        doc = {'_id': doc_id, '.type': 'indexed', 'field': field,
+               'value': value, 'tags': tags}
+        if doc_id in self.revs:
+            doc['_rev'] = self.revs[doc_id]
+        d = self.database.save_doc(json.dumps(doc))
+        d.addCallback(self._store_rev)
+        return d
+
+    def delete(self, doc_id):
+        d = self.database.delete_doc(doc_id, self.revs[doc_id])
+        d.addCallback(self._store_rev)
+        return d
+
+    def query(self, **options):
+        d = self.database.query_view(IndexedView, **options)
+        d.addCallback(lambda rows: [self._tuplify(row) for row in rows])
+        return d
+
+    def count_reduce_calls(self):
+        calls = list()
+        index = self.database._views[IndexedView.name]
+
+        def reduce_group(group_key, positions):
+            calls.append(group_key)
+            return original(group_key, positions)
+
+        original = index._reduce_group
+        index._reduce_group = reduce_group
+        return calls
+
+    def _store_rev(self, resp):
+        self.revs[resp['id']] = resp['rev']
+
+    def _tuplify(self, row):
+        # keys emitted as tuples come out of json as lists
+        key = row[0]
+        if isinstance(key, list):
+            key = tuple(key)
+        return (key, ) + tuple(row[1:])
+
+
+@common.attr('slow')
+class TestViewIndexBenchmark(common.TestCase):
+
+    documents = 20000
+    queries = 200
+
+    @defer.inlineCallbacks
+    def testQueryingManyDocuments(self):
+        database = emu.Database()
+        for x in xrange(self.documents):
+            doc = {'_id': 'doc%d' % (x, ), '.type': 'indexed',
+                   'field': u'F%d' % (x % 100, ), 'value': x, 'tags': [x]}
+            yield database.save_doc(json.dumps(doc))
+
+        start = time.time()
+        yield database.query_view(IndexedView, reduce=False)
+        self.info("Building index of %d documents: %.3f s",
+                  self.documents, time.time() - start)
+
+        start = time.time()
+        for x in xrange(self.queries):
+            field = u'F%d' % (x % 100, )
+            rows = yield database.query_view(
+                IndexedView, reduce=False, startkey=(field, ),
+                endkey=(field, {}), limit=10)
+            self.assertEqual(10, len(rows))
+        self.info("Range query: %.0f us/query",
+                  (time.time() - start) * 1e6 / self.queries)
+
+        start = time.time()
+        for x in xrange(self.queries):
+            doc = {'_id': 'new%d' % (x, ), '.type': 'indexed',
+                   'field': u'F%d' % (x % 100, ), 'value': x, 'tags': [x]}
+            yield database.save_doc(json.dumps(doc))
+            rows = yield database.query_view(IndexedView, group_level=1)
+            self.assertEqual(100, len(rows))
+        self.info("Save and grouped reduce: %.0f us/query",
+                  (time.time() - start) * 1e6 / self.queries)
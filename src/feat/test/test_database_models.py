@@ -148,6 +148,31 @@ class TestDoingSelectsViaApi(common.TestCase, ModelTestMixin):
             'select', query=q, limit=3, skip=3, sorting=[('field1', 'DESC')])
         yield self._asserts_on_select([12, 10, 8], res)
 
+    @defer.inlineCallbacks
+    def testPaginationWithToken(self):
+        q = []
+        res = yield self.model.perform_action('select', query=q, limit=4)
+        yield self._asserts_on_select([0, 2, 4, 6], res)
+        token = self._get_next_token(res)
+        self.assertIsNot(None, token)
+
+        res = yield self.model.perform_action('select', query=q, limit=4,
+                                              token=token)
+        yield self._asserts_on_select([8, 10, 12, 14], res)
+        token = self._get_next_token(res)
+
+        res = yield self.model.perform_action('select', query=q, limit=4,
+                                              token=token)
+        yield self._asserts_on_select([16, 18], res)
+        self.assertIs(None, self._get_next_token(res))
+
+        res = yield self.model.perform_action('select', query=q)
+        self.assertIs(None, self._get_next_token(res))
+
+    def _get_next_token(self, res):
+        items = res.get_meta('next_token')
+        return items[0].value if items else None
+
     @defer.inlineCallbacks
     def testJsonSerialization(self):
         q = []
@@ -1,3 +1,6 @@
+import random
+import sys
+import time
 import uuid
 
 from zope.interface import classProvides
@@ -103,6 +106,104 @@ class TestWithDummyCache(common.TestCase):
         yield self._test(['id2', 'id1'], C('field1', E.equals, 2),
                          O.OR, subquery)
 
+        # operators are applied from left to right
+        yield self._test(['id4'], C('field1', E.le, 2), O.OR,
+                         C('field2', E.equals, 'other'), O.AND,
+                         C('field1', E.equals, 4))
+        yield self._test(['id2'], C('field1', E.none, None), O.AND,
+                         C('field2', E.equals, 'other'), O.AND,
+                         C('field1', E.le, 2))
+        yield self._test(['id2', 'id3'], C('field1', E.none, None), O.AND,
+                         C('field1', E.equals, 2), O.OR,
+                         C('field1', E.equals, 3), O.AND,
+                         C('field2', E.equals, 'string'), O.OR,
+                         C('field1', E.equals, 2))
+
+    def testSubqueriesAreRunConcurrently(self):
+        E = query.Evaluator
+        C = query.Condition
+        O = query.Operator
+
+        calls = list()
+
+        def query_cache(connection, factory, subquery):
+            d = defer.Deferred()
+            calls.append((subquery, d))
+            return d
+
+        self.cache.query = query_cache
+        nested = query.Query(DummyView, C('field1', E.le, 2), O.OR,
+                             C('field2', E.equals, 'other'))
+        q = query.Query(DummyView, C('field1', E.le, 2), O.AND, nested,
+                        O.AND, C('field2', E.equals, 'other'))
+        d = query.select_ids(self.connection, q)
+
+        # each distinct subquery is run once, without waiting for the others
+        self.assertEqual([('field1', E.le, 2), ('field2', E.equals, 'other')],
+                         [subquery for subquery, _ in calls])
+        self.assertFalse(d.called)
+        for subquery, call in reversed(calls):
+            call.callback(self.cache.stubs[subquery])
+        self.assertTrue(d.called)
+        d.addCallback(self.assertEqual, ['id2'])
+        return d
+
+    @defer.inlineCallbacks
+    def testSelectIter(self):
+        E = query.Evaluator
+        C = query.Condition
+        D = query.Direction
+
+        q = query.Query(DummyView, C('field1', E.none, None),
+                        sorting=[('field1', D.DESC)])
+        cursor = query.select_iter(self.connection, q, page_size=3)
+        page = yield cursor.next_page()
+        self.assertEqual(['id4', 'id3', 'id2'], page)
+        token = cursor.token
+        page = yield cursor.next_page()
+        self.assertEqual(['id1'], page)
+        self.assertIs(None, cursor.token)
+        page = yield cursor.next_page()
+        self.assertEqual([], page)
+
+        # resuming with the token
+        cursor = query.select_iter(self.connection, q, page_size=3,
+                                   token=token)
+        page = yield cursor.next_page()
+        self.assertEqual(['id1'], page)
+
+        # the page continues after the last document returned,
+        # even if the documents before it have disappeared
+        cursor = query.select_iter(self.connection, q, page_size=2)
+        page = yield cursor.next_page()
+        self.assertEqual(['id4', 'id3'], page)
+        self.cache.stubs[('field1', E.none, None)] = ['id1', 'id3', 'id5']
+        cursor = query.select_iter(self.connection, q, page_size=2,
+                                   token=cursor.token)
+        page = yield cursor.next_page()
+        self.assertEqual(['id1'], page)
+
+        # empty page doesn't move the cursor
+        cursor = query.select_iter(self.connection, q, page_size=0)
+        page = yield cursor.next_page()
+        self.assertEqual([], page)
+        cursor = query.select_iter(self.connection, q, page_size=2,
+                                   token=cursor.token)
+        page = yield cursor.next_page()
+        self.assertEqual(['id5', 'id3'], page)
+        self.assertRaises(ValueError, query.select_iter,
+                          self.connection, q, page_size=-1)
+
+        cursor = query.select_iter(self.connection, q, skip=1,
+                                   include_docs=False)
+        page = yield cursor.next_page()
+        self.assertEqual(['id3', 'id1'], page)
+
+        cursor = query.select_iter(self.connection, q, token='invalid')
+        d = cursor.next_page()
+        self.assertFailure(d, ValueError)
+        yield d
+
     @defer.inlineCallbacks
     def _test(self, result, *parts, **kwargs):
         q = query.Query(DummyView, *parts, sorting=kwargs.pop('sorting', None))
@@ -112,6 +213,48 @@ class TestWithDummyCache(common.TestCase):
         self.assertEquals(result, res)
 
 
+@common.attr('slow')
+class TestSortingBenchmark(common.TestCase):
+
+    documents = 50000
+
+    def setUp(self):
+        E = query.Evaluator
+        ids = ['id%d' % (x, ) for x in xrange(self.documents)]
+        random.seed(5)
+        by_field1 = list(ids)
+        random.shuffle(by_field1)
+        self.cache = DummyCache({
+            ('field1', E.none, None): by_field1,
+            ('field2', E.equals, 'odd'): ids[1::2],
+            ('field2', E.equals, 'even'): ids[0::2]})
+        self.connection = DummyConnection(self.cache)
+
+    @defer.inlineCallbacks
+    def testSortedSelect(self):
+        E = query.Evaluator
+        C = query.Condition
+        O = query.Operator
+        D = query.Direction
+
+        q = query.Query(DummyView, C('field2', E.equals, 'odd'), O.OR,
+                        C('field2', E.equals, 'even'),
+                        sorting=[('field1', D.DESC), ('field2', D.ASC)])
+        start = time.time()
+        count = yield query.count(self.connection, q)
+        self.info("Sorted count of %d documents: %.3f s",
+                  self.documents, time.time() - start)
+        self.assertEqual(self.documents, count)
+
+        start = time.time()
+        res = yield query.select(self.connection, q)
+        self.info("Sorted select of %d documents: %.3f s",
+                  self.documents, time.time() - start)
+        expected = list(self.cache.stubs[('field1', E.none, None)])
+        expected.reverse()
+        self.assertEqual(expected, res)
+
+
 class TestQueryObject(common.TestCase):
 
     def testValidation(self):
@@ -170,6 +313,23 @@ class QueryView(query.QueryView):
     query.field('name', extract_name)
 
 
+class CompoundView(query.QueryView):
+    name = 'compound'
+
+    query.document_types(['type1'])
+
+    def extract_name(doc):
+        yield doc.get('name')
+
+    def extract_tags(doc):
+        for tag in doc.get('tags', []):
+            yield tag
+
+    query.field('name', extract_name)
+    query.field('tags', extract_tags)
+    query.compound_index('name', 'tags')
+
+
 class TestQueryCache(common.TestCase):
     '''
     This test uses private methods of query.Cache(), beware!
@@ -194,6 +354,65 @@ class TestQueryCache(common.TestCase):
                 expected_present.remove(entry.seq_num)
             self.assertEqual([], expected_present)
 
+    def testLeastRecentlyUsedIsReleased(self):
+        cache = query.Cache(self)
+        subqueries = [('field%d' % (x, ), query.Evaluator.none, None)
+                      for x in range(3)]
+        for subquery in subqueries:
+            cache._cache_response(range(100), DummyView, subquery, 0)
+        size = cache.get_cache_size()
+        self.assertEqual(3, cache.get_stats()['entries'])
+
+        # using the first entry makes the second one the oldest
+        cache._get_entry(DummyView, subqueries[0])
+        cache.CACHE_LIMIT = size - 1
+        cache._check_size_limit()
+        self.assertEqual([subqueries[0], subqueries[2]],
+                         sorted(cache._cache[DummyView.name].keys()))
+        stats = cache.get_stats()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(cache.get_cache_size(), stats['size'])
+        self.assertTrue(size > stats['size'])
+
+        cache.empty()
+        self.assertEqual(0, cache.get_cache_size())
+
+    def testPositionsAreAccounted(self):
+        cache = query.Cache(self)
+        entries = ['doc%d' % (x, ) for x in range(1000)]
+        response = cache._cache_response(
+            entries, DummyView, ('field', query.Evaluator.none, None), 0)
+        positions = response.get_positions()
+        self.assertEqual(1000, len(positions))
+        self.assertEqual(sys.getsizeof(entries) + sys.getsizeof(positions),
+                         cache.get_cache_size())
+
+    def testMayMatch(self):
+        E = query.Evaluator
+        m = query._may_match
+
+        self.assertTrue(m(E.equals, 5, 5))
+        self.assertFalse(m(E.equals, 5, 6))
+        self.assertTrue(m(E.le, 5, 5))
+        self.assertFalse(m(E.le, 5, 6))
+        self.assertTrue(m(E.ge, 5, 6))
+        self.assertFalse(m(E.ge, 5, None))
+        self.assertTrue(m(E.between, (1, 3), 2))
+        self.assertFalse(m(E.between, (1, 3), 4))
+        self.assertTrue(m(E.inside, [1, 3], 3))
+        self.assertFalse(m(E.inside, [1, 3], 2))
+        self.assertTrue(m(E.none, None, 'anything'))
+        self.assertFalse(m(E.le, u'abc', u'abd'))
+        self.assertFalse(m(E.equals, u'a', u'b'))
+        self.assertFalse(m(E.between, ([1, 1], [1, 5]), [1, 6]))
+
+        # CouchDB and python disagree, the answer is conservative
+        self.assertTrue(m(E.le, u'a', u'B'))
+        self.assertTrue(m(E.ge, u'B', u'a'))
+        self.assertTrue(m(E.le, u'a', u'a_b'))
+        self.assertTrue(m(E.le, u'a', u'\xe9'))
+        self.assertTrue(m(E.le, u'a', {}))
+
 
 class TestQueryView(common.TestCase):
 
@@ -225,6 +444,87 @@ class TestQueryView(common.TestCase):
             {'_id': 'id1', '.type': 'type3', 'name': 'John'}))
         self.assertEqual(0, len(r))
 
+    def testCompoundIndex(self):
+        self.assertNotIn("COMPOUND_INDEXES", QueryView.get_code('map'))
+        code = CompoundView.get_code('map')
+        self.assertIn("COMPOUND_INDEXES = [('name', 'tags')]", code)
+
+        r = list(CompoundView.map({'_id': 'id1', '.type': 'type1',
+                                   'name': 'John', 'tags': ['a', 'b']}))
+        self.assertEqual(5, len(r))
+        self.assertIn(((('name', 'tags'), 'John', 'a'), None), r)
+        self.assertIn(((('name', 'tags'), 'John', 'b'), None), r)
+
+        def declare():
+
+            class BadView(query.QueryView):
+                name = 'bad'
+
+                def extract_name(doc):
+                    yield doc.get('name')
+
+                query.field('name', extract_name)
+                query.compound_index('name', 'unknown')
+
+        self.assertRaises(ValueError, declare)
+
+        def declare_with_map():
+
+            class CustomMapView(query.QueryView):
+                name = 'custom_map'
+
+                def map(doc):
+                    yield doc.get('name'), None
+
+                def extract_name(doc):
+                    yield doc.get('name')
+
+                def extract_tags(doc):
+                    return doc.get('tags', [])
+
+                query.field('name', extract_name)
+                query.field('tags', extract_tags)
+                query.compound_index('name', 'tags')
+
+        self.assertRaises(ValueError, declare_with_map)
+
+    def testPlanningCompoundIndex(self):
+        E = query.Evaluator
+        C = query.Condition
+        O = query.Operator
+
+        c1 = C('tags', E.between, ('a', 'c'))
+        c2 = C('name', E.equals, 'John')
+        q = query.Query(CompoundView, c1, O.AND, c2)
+        planned = query._plan_query(q)
+        self.assertEqual(
+            [(('name', 'tags'), E.between, ('John', ('a', 'c')))],
+            planned.get_basic_queries())
+        # the original query is not changed
+        self.assertEqual([c1, c2], q.parts)
+
+        # the query sorted by the other field needs its full range
+        q.set_sorting([('name', query.Direction.ASC),
+                       ('tags', query.Direction.DESC)])
+        self.assertEqual(1, len(query._plan_query(q).get_basic_queries()))
+
+        # or cannot be combined
+        q = query.Query(CompoundView, c1, O.OR, c2)
+        self.assertIs(q, query._plan_query(q))
+
+        # neither the range on the first field
+        q = query.Query(CompoundView, C('name', E.le, 'John'), O.AND,
+                        C('tags', E.equals, 'a'))
+        self.assertIs(q, query._plan_query(q))
+
+        # the nested query is planned separately
+        nested = query.Query(CompoundView, c2, O.AND, c1)
+        q = query.Query(CompoundView, C('tags', E.equals, 'z'), O.OR, nested)
+        planned = query._plan_query(q)
+        self.assertEqual([('tags', E.equals, 'z'),
+                          (('name', 'tags'), E.between, ('John', ('a', 'c')))],
+                         planned.get_basic_queries())
+
     def testFilter(self):
         code = QueryView.get_code('filter')
         self.assertIn("DOCUMENT_TYPES = ['type1', 'type2']", code)
@@ -0,0 +1,157 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import json
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+
+from feat.database import sqlite, view
+from feat.database.interface import NotFoundError
+
+from . import common
+
+
+class CountingView(view.BaseView):
+
+    name = 'sqlite_counting'
+    use_reduce = True
+
+    def map(doc):
+        if doc.get('.type') == 'counted':
+            yield doc['field'], 1
+
+    reduce = "_count"
+
+
+class TestDatabase(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.filename = os.path.join(self.directory, 'test.sqlite3')
+        self.database = self.open()
+
+    def tearDown(self):
+        self.database.close()
+        return common.TestCase.tearDown(self)
+
+    @defer.inlineCallbacks
+    def testReopeningDatabase(self):
+        resp = yield self.database.save_doc(
+            json.dumps({'.type': 'counted', 'field': 'a'}))
+        self.assertEqual(u'counted_1', resp['id'])
+        deleted = yield self.database.save_doc(json.dumps({'_id': 'gone'}))
+        yield self.database.delete_doc('gone', deleted['rev'])
+
+        self.reopen()
+
+        doc = yield self.database.open_doc(resp['id'])
+        self.assertEqual('a', doc['field'])
+        self.assertEqual(resp['rev'], doc['_rev'])
+        d = self.database.open_doc('gone')
+        self.assertFailure(d, NotFoundError)
+        yield d
+
+        seq = yield self.database.get_update_seq()
+        self.assertEqual(3, seq)
+        changes = yield self.database.get_changes(None, since=1)
+        self.assertEqual([1, 2], [x['seq'] for x in changes['results']])
+        self.assertEqual(3, changes['last_seq'])
+
+        # the counter of generated ids is not reset
+        resp = yield self.database.save_doc(
+            json.dumps({'.type': 'counted', 'field': 'b'}))
+        self.assertEqual(u'counted_2', resp['id'])
+
+    @defer.inlineCallbacks
+    def testAttachments(self):
+        yield self.database.save_doc(json.dumps({'_id': 'doc'}))
+        self.database.load_fixture(
+            json.dumps({'_id': 'fixture', '_rev': '1-a',
+                        '_attachments': {'file': {}}}),
+            {'file': 'body\x00'})
+
+        self.reopen()
+
+        body = yield self.database.get_attachment('fixture', 'file')
+        self.assertEqual('body\x00', body)
+        d = self.database.get_attachment('fixture', 'other')
+        self.assertFailure(d, NotFoundError)
+        yield d
+        d = self.database.get_attachment('doc', 'file')
+        self.assertFailure(d, NotFoundError)
+        yield d
+
+    @defer.inlineCallbacks
+    def testReusingViewIndex(self):
+        for field in ['a', 'b', 'a']:
+            yield self.database.save_doc(
+                json.dumps({'.type': 'counted', 'field': field}))
+        res = yield self.database.query_view(CountingView, group=True)
+        self.assertEqual([(u'a', 2), (u'b', 1)], res)
+
+        self.reopen()
+        calls = self.count_map_calls()
+
+        res = yield self.database.query_view(CountingView, group=True)
+        self.assertEqual([(u'a', 2), (u'b', 1)], res)
+        self.assertEqual(0, len(calls))
+
+        # only the documents updated since are mapped again
+        yield self.database.save_doc(
+            json.dumps({'.type': 'counted', 'field': 'c'}))
+        self.reopen()
+        calls = self.count_map_calls()
+        res = yield self.database.query_view(CountingView, reduce=False)
+        self.assertEqual([u'a', u'a', u'b', u'c'], [x[0] for x in res])
+        self.assertEqual(1, len(calls))
+
+        # changing the view rebuilds the index
+        self.reopen()
+        calls = self.count_map_calls()
+        self.patch(CountingView, 'get_code', classmethod(
+            lambda cls, name: u'changed'))
+        res = yield self.database.query_view(CountingView)
+        self.assertEqual([(None, 4)], res)
+        self.assertEqual(4, len(calls))
+
+    def open(self):
+        return sqlite.Database(self.filename)
+
+    def reopen(self):
+        self.database.close()
+        self.database = self.open()
+
+    def count_map_calls(self):
+        calls = list()
+        original = CountingView.map
+
+        def map(doc):
+            calls.append(doc['_id'])
+            return original(doc)
+
+        map.source = original.source
+        self.patch(CountingView, 'map', staticmethod(map))
+        return calls
@@ -0,0 +1,173 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+from twisted.internet import reactor
+from twisted.web import server, resource
+
+from feat.common import defer, time
+from feat.test import common
+from feat.web import http, httpclient
+
+
+class CountingSite(server.Site):
+
+    def __init__(self, *args, **kwargs):
+        server.Site.__init__(self, *args, **kwargs)
+        self.connections = list()
+
+    def buildProtocol(self, addr):
+        protocol = server.Site.buildProtocol(self, addr)
+        self.connections.append(protocol)
+        return protocol
+
+    def get_open_connections(self):
+        return [x for x in self.connections if x.transport.connected]
+
+
+class EchoResource(resource.Resource):
+    '''
+    Responds with the path of the request, the paths starting with /slow
+    are answered after a short delay, /not_modified with 304 status.
+    '''
+
+    isLeaf = True
+
+    def render(self, request):
+        if request.path == '/not_modified':
+            request.setResponseCode(304)
+            return ''
+        if request.path.startswith('/slow'):
+            time.callLater(0.05, self._respond, request)
+            return server.NOT_DONE_YET
+        return request.method + ' ' + request.path
+
+    def _respond(self, request):
+        request.write(request.method + ' ' + request.path)
+        request.finish()
+
+
+class TestConnectionPool(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.site = CountingSite(EchoResource())
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.pool = None
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.disconnect()
+        yield self.wait_for(lambda: not self.site.get_open_connections(),
+                            1, freq=0.01)
+        yield self.port.stopListening()
+        yield common.TestCase.tearDown(self)
+
+    @defer.inlineCallbacks
+    def testReusingConnections(self):
+        self.pool = self._create_pool(max_connections=2)
+        for x in range(10):
+            response = yield self.pool.request(http.Methods.GET, '/%d' % x)
+            self.assertEqual(http.Status.OK, response.status)
+            self.assertEqual('GET /%d' % x, response.body)
+        self.assertEqual(1, len(self.site.connections))
+        self.assertEqual(dict(connections=1, pending=0, queued=0),
+                         self.pool.get_stats())
+
+    @defer.inlineCallbacks
+    def testResponsesWithoutBody(self):
+        self.pool = self._create_pool(max_connections=1)
+        response = yield self.pool.request(http.Methods.HEAD, '/head')
+        self.assertEqual(http.Status.OK, response.status)
+        self.assertEqual(len('HEAD /head'), response.length)
+        self.assertIs(None, response.body)
+        response = yield self.pool.request(http.Methods.GET, '/not_modified')
+        self.assertEqual(http.Status.NOT_MODIFIED, response.status)
+        # the connection is still usable
+        response = yield self.pool.request(http.Methods.GET, '/')
+        self.assertEqual('GET /', response.body)
+        self.assertEqual(1, len(self.site.connections))
+
+    @defer.inlineCallbacks
+    def testQueueingRequests(self):
+        self.pool = self._create_pool(max_connections=2)
+        defers = [self.pool.request(http.Methods.POST, '/slow/%d' % x,
+                                    body='body')
+                  for x in range(6)]
+        self.assertEqual(dict(connections=2, pending=2, queued=4),
+                         self.pool.get_stats())
+        responses = yield defer.join(*defers)
+        self.assertEqual(['POST /slow/%d' % x for x in range(6)],
+                         [x.body for x in responses])
+        self.assertEqual(2, len(self.site.connections))
+
+    @defer.inlineCallbacks
+    def testPipeliningIdempotentRequests(self):
+        self.pool = self._create_pool(max_connections=1, max_pipeline=2)
+        yield self.pool.request(http.Methods.GET, '/')
+
+        defers = [self.pool.request(http.Methods.GET, '/slow/%d' % x)
+                  for x in range(3)]
+        self.assertEqual(dict(connections=1, pending=2, queued=1),
+                         self.pool.get_stats())
+        # the POST is not pipelined
+        defers.append(self.pool.request(http.Methods.POST, '/slow/post'))
+        self.assertEqual(dict(connections=1, pending=2, queued=2),
+                         self.pool.get_stats())
+
+        responses = yield defer.join(*defers)
+        self.assertEqual(['GET /slow/0', 'GET /slow/1', 'GET /slow/2',
+                          'POST /slow/post'],
+                         [x.body for x in responses])
+        self.assertEqual(1, len(self.site.connections))
+
+    @defer.inlineCallbacks
+    def testClosingIdleConnections(self):
+        self.pool = self._create_pool(max_idle_time=0.1)
+        yield self.pool.request(http.Methods.GET, '/')
+        self.assertEqual(1, self.pool.get_stats()['connections'])
+
+        yield self.wait_for(lambda: not self.site.get_open_connections(),
+                            1, freq=0.01)
+        self.assertEqual(0, self.pool.get_stats()['connections'])
+
+        response = yield self.pool.request(http.Methods.GET, '/again')
+        self.assertEqual('GET /again', response.body)
+        self.assertEqual(2, len(self.site.connections))
+
+    @defer.inlineCallbacks
+    def testDisconnecting(self):
+        self.pool = self._create_pool(max_connections=1)
+        d1 = self.pool.request(http.Methods.GET, '/slow')
+        d2 = self.pool.request(http.Methods.GET, '/slow')
+        self.pool.disconnect()
+        self.assertFailure(d2, httpclient.RequestCanceled)
+        yield d2
+        # the request sent while connecting is finished,
+        # but the connection is not kept
+        response = yield d1
+        self.assertEqual('GET /slow', response.body)
+        yield self.wait_for(lambda: not self.site.get_open_connections(),
+                            1, freq=0.01)
+
+    def _create_pool(self, **kwargs):
+        return httpclient.ConnectionPool(
+            '127.0.0.1', self.port.getHost().port, logger=self, **kwargs)
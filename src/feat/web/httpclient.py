@@ -73,6 +73,8 @@ class Protocol(http.BaseProtocol):
 
         self._response = None
         self._requests = []
+        # methods of the requests waiting for the response
+        self._methods = []
 
         self.debug("HTTP client protocol created")
 
@@ -86,7 +88,8 @@ class Protocol(http.BaseProtocol):
             # without typecast to str, in case of unicode input
             # the server just breaks connection with me
             # TODO: think if it cannot be fixed better
-            body = body.encode('utf-8')
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
             headers["content-length"] = len(body)
         lines = []
         http.compose_request(method, location, protocol, buffer=lines)
@@ -105,6 +108,7 @@ class Protocol(http.BaseProtocol):
 
         d = defer.Deferred()
         self._requests.append(d)
+        self._methods.append(method)
 
         self.transport.writeSequence(seq)
 
@@ -123,6 +127,7 @@ class Protocol(http.BaseProtocol):
         for d in self._requests:
             d.errback(RequestError())
         self._requests = None
+        self._methods = None
 
     def process_reset(self):
         self._response = None
@@ -169,6 +174,16 @@ class Protocol(http.BaseProtocol):
         assert self._response is not None, "No response information"
         self._response.headers[name] = value
 
+    def process_body_start(self):
+        assert self._response is not None, "No response information"
+        # the responses to HEAD requests and the 1xx, 204 and 304
+        # responses never have a body, even if they specify its length
+        status = self._response.status
+        if (self._methods[0] == http.Methods.HEAD or
+            status < 200 or
+            status in (http.Status.NO_CONTENT, http.Status.NOT_MODIFIED)):
+            self._body_decoder = None
+
     def process_body_data(self, data):
         assert self._response is not None, "No response information"
         if self._response.body is None:
@@ -177,6 +192,7 @@ class Protocol(http.BaseProtocol):
 
     def process_body_finished(self):
         d = self._requests.pop(0)
+        self._methods.pop(0)
         d.callback(self._response)
 
     def process_timeout(self):
@@ -190,6 +206,7 @@ class Protocol(http.BaseProtocol):
     def _client_error(self, exception):
         if self._requests:
             d = self._requests.pop(0)
+            self._methods.pop(0)
             d.errback(exception)
         self.transport.loseConnection()
 
@@ -286,6 +303,9 @@ class Connection(log.LogProxy, log.Logger):
     def is_idle(self):
         return self._protocol is None or self._protocol.is_idle()
 
+    def is_connected(self):
+        return self._protocol is not None
+
     def request(self, method, location, headers=None, body=None):
         self.debug('%s-ing on %s', method.name, location)
         self.log('Headers: %r', headers)
@@ -355,3 +375,145 @@ class Connection(log.LogProxy, log.Logger):
     def _request_done(self, param):
         self._pending -= 1
         return param
+
+
+class ConnectionPool(log.LogProxy, log.Logger):
+    '''
+    I keep up to max_connections persistent connections to the host.
+    The requests are sent using the idle connection or a new one, above
+    the limit they wait in the queue. The idempotent requests (GET, HEAD)
+    can also be pipelined on the busy connections, up to max_pipeline
+    requests per connection. The connections unused for max_idle_time
+    seconds are closed.
+    '''
+
+    connection_factory = Connection
+
+    max_connections = 4
+    max_pipeline = 2
+    max_idle_time = 60
+
+    safe_methods = (http.Methods.GET, http.Methods.HEAD)
+
+    def __init__(self, host, port=None, protocol=None,
+                 security_policy=None, logger=None, max_connections=None,
+                 max_pipeline=None, max_idle_time=None):
+        logger = logger or log.get_default() or log.FluLogKeeper()
+        log.LogProxy.__init__(self, logger)
+        log.Logger.__init__(self, logger)
+
+        self._host = host
+        self._port = port
+        self._protocol = protocol
+        self._security_policy = security_policy
+
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_pipeline is not None:
+            self.max_pipeline = max_pipeline
+        if max_idle_time is not None:
+            self.max_idle_time = max_idle_time
+
+        self._connections = list()
+        # Connection -> number of requests in progress
+        self._pending = dict()
+        # Connection -> time when the last request has finished
+        self._last_used = dict()
+        # [(Deferred, method, location, headers, body)]
+        self._queue = list()
+        self._reaper = None
+
+    ### public ###
+
+    def request(self, method, location, headers=None, body=None):
+        d = defer.Deferred()
+        self._queue.append((d, method, location, headers, body))
+        self._process_queue()
+        return d
+
+    def disconnect(self):
+        self._cancel_reaper()
+        for connection in self._connections:
+            connection.disconnect()
+        del self._connections[:]
+        self._pending.clear()
+        self._last_used.clear()
+        queue, self._queue = self._queue, list()
+        for d, _, _, _, _ in queue:
+            d.errback(RequestCanceled("Connection pool disconnected"))
+
+    def get_stats(self):
+        return dict(connections=len(self._connections),
+                    pending=sum(self._pending.itervalues()),
+                    queued=len(self._queue))
+
+    ### private ###
+
+    def _process_queue(self):
+        while self._queue:
+            d, method, location, headers, body = self._queue[0]
+            connection = self._get_connection(method)
+            if connection is None:
+                return
+            del self._queue[0]
+            self._pending[connection] += 1
+            request = connection.request(method, location, headers, body)
+            request.addBoth(self._request_done, connection)
+            request.chainDeferred(d)
+
+    def _get_connection(self, method):
+        for connection in self._connections:
+            if not self._pending[connection]:
+                return connection
+
+        if len(self._connections) < self.max_connections:
+            connection = self.connection_factory(
+                self._host, self._port, protocol=self._protocol,
+                security_policy=self._security_policy, logger=self)
+            self._connections.append(connection)
+            self._pending[connection] = 0
+            return connection
+
+        if method in self.safe_methods:
+            busy = [(self._pending[x], x) for x in self._connections
+                    if x.is_connected()
+                    and self._pending[x] < self.max_pipeline]
+            if busy:
+                return min(busy)[1]
+
+    def _request_done(self, param, connection):
+        if connection not in self._pending:
+            # the pool has been disconnected while connecting
+            connection.disconnect()
+            return param
+        self._pending[connection] -= 1
+        self._last_used[connection] = time.time()
+        if self._reaper is None:
+            self._reaper = time.callLater(self.max_idle_time, self._reap)
+        if self._queue:
+            # the response is still being processed by the protocol
+            time.call_next(self._process_queue)
+        return param
+
+    def _reap(self):
+        self._reaper = None
+        now = time.time()
+        for connection in list(self._connections):
+            if self._pending[connection]:
+                continue
+            if now - self._last_used.get(connection, now) < self.max_idle_time:
+                continue
+            self.debug("Closing connection idle for %d seconds",
+                       now - self._last_used[connection])
+            connection.disconnect()
+            self._connections.remove(connection)
+            del self._pending[connection]
+            del self._last_used[connection]
+        if self._connections:
+            self._reaper = time.callLater(self.max_idle_time, self._reap)
+
+    def _cancel_reaper(self):
+        if self._reaper is not None:
+            if self._reaper.active():
+                self._reaper.cancel()
+            self._reaper = None